@@ -47,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первым, чтобы время обработки запроса включало остальные промежуточные слои
+    "mailing.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -137,7 +139,8 @@ MEDIA_ROOT = BASE_DIR / "media"  # добавил
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+# SMTP-бэкенд Django, который дополнительно передаёт время SMTP-команд в метрики /metrics
+EMAIL_BACKEND = "mailing.smtp_backend.EmailBackend"
 EMAIL_HOST = os.getenv("EMAIL_HOST")
 EMAIL_PORT = os.getenv("EMAIL_PORT")
 EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", False) == "True"
@@ -147,18 +150,92 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 SERVER_EMAIL = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Отправка рассылок: сколько писем отправляется пачкой через одно SMTP-соединение
+MAILING_SEND_BATCH_SIZE = int(os.getenv("MAILING_SEND_BATCH_SIZE", 100))
+# Число потоков отправки, у каждого потока своё SMTP-соединение (1 - последовательная отправка)
+MAILING_SEND_WORKERS = int(os.getenv("MAILING_SEND_WORKERS", 4))
+# Режим отправки: sequential - одно соединение, threads - пул потоков, async - asyncio
+MAILING_SEND_MODE = os.getenv("MAILING_SEND_MODE", "threads")
+# Сколько SMTP-сессий одновременно держит режим async
+MAILING_ASYNC_CONNECTIONS = int(os.getenv("MAILING_ASYNC_CONNECTIONS", 100))
+# Сколько попыток рассылки накапливается в памяти перед записью в БД одним bulk_create
+MAILING_ATTEMPT_CHUNK_SIZE = int(os.getenv("MAILING_ATTEMPT_CHUNK_SIZE", 500))
+# Домены, получателям которых одинаковое письмо (без подстановок) отправляется одной SMTP-транзакцией
+# с несколькими RCPT TO, через запятую ("*" - все домены), и наибольшее число получателей в такой транзакции
+MAILING_MULTI_RCPT_DOMAINS = [
+    domain.strip().lower() for domain in os.getenv("MAILING_MULTI_RCPT_DOMAINS", "").split(",") if domain.strip()
+]
+MAILING_MAX_RCPT_PER_TRANSACTION = int(os.getenv("MAILING_MAX_RCPT_PER_TRANSACTION", 50))
+# Сколько получателей читается из БД за один запрос при потоковой выборке
+MAILING_RECIPIENT_CHUNK_SIZE = int(os.getenv("MAILING_RECIPIENT_CHUNK_SIZE", 2000))
+# Очередь заданий: через сколько секунд без сигнала от обработчика задание забирается повторно
+MAILING_JOB_LEASE = int(os.getenv("MAILING_JOB_LEASE", 300))
+# Сколько раз задание может быть перезапущено после падения обработчика
+MAILING_JOB_MAX_ATTEMPTS = int(os.getenv("MAILING_JOB_MAX_ATTEMPTS", 3))
+# Лимит скорости отправки на SMTP-сервер: писем в секунду (0 - без ограничения) и допустимый всплеск.
+# Лимит общий для всех обработчиков и узлов, если кеш на Redis
+MAILING_RELAY_RATE_LIMIT = float(os.getenv("MAILING_RELAY_RATE_LIMIT", 0))
+MAILING_RELAY_BURST = int(os.getenv("MAILING_RELAY_BURST", 20))
+# SMTP-серверы для рассылок через запятую в виде host, host:port или host:port:вес. Если список пуст,
+# используется EMAIL_HOST. Учётные данные и TLS у всех серверов общие (EMAIL_HOST_USER, EMAIL_USE_TLS и др.)
+MAILING_RELAYS = [relay.strip() for relay in os.getenv("MAILING_RELAYS", "").split(",") if relay.strip()]
+# Сервер исключается из пула, если доля ошибок транзакций выше MAILING_RELAY_MAX_ERROR_RATE или средняя
+# задержка транзакции выше MAILING_RELAY_MAX_LATENCY секунд (0 - не ограничена), и через
+# MAILING_RELAY_PROBE_INTERVAL секунд получает пробную транзакцию
+MAILING_RELAY_MAX_ERROR_RATE = float(os.getenv("MAILING_RELAY_MAX_ERROR_RATE", 0.5))
+MAILING_RELAY_MAX_LATENCY = float(os.getenv("MAILING_RELAY_MAX_LATENCY", 0))
+MAILING_RELAY_PROBE_INTERVAL = int(os.getenv("MAILING_RELAY_PROBE_INTERVAL", 30))
+# Лимиты на домены получателей: {"домен": (писем в секунду, всплеск)}, например {"gmail.com": (20, 40)}
+MAILING_DOMAIN_RATE_LIMITS = {}
+# Повторные отправки при временных ошибках: число попыток до записи в недоставленные,
+# начальная и наибольшая задержка между попытками (секунд) и размер пачки обработки
+MAILING_RETRY_MAX_ATTEMPTS = int(os.getenv("MAILING_RETRY_MAX_ATTEMPTS", 5))
+MAILING_RETRY_BASE_DELAY = int(os.getenv("MAILING_RETRY_BASE_DELAY", 60))
+MAILING_RETRY_MAX_DELAY = int(os.getenv("MAILING_RETRY_MAX_DELAY", 3600))
+MAILING_RETRY_BATCH_SIZE = int(os.getenv("MAILING_RETRY_BATCH_SIZE", 100))
+# Прогресс отправки: как часто (секунд) обработчик обновляет счётчики и сколько секунд они хранятся
+MAILING_PROGRESS_INTERVAL = float(os.getenv("MAILING_PROGRESS_INTERVAL", 1))
+MAILING_PROGRESS_TTL = int(os.getenv("MAILING_PROGRESS_TTL", 86400))
+# Как часто (секунд) идущая отправка проверяет флаг отмены рассылки перед транзакциями
+MAILING_CANCEL_CHECK_INTERVAL = float(os.getenv("MAILING_CANCEL_CHECK_INTERVAL", 1))
+
+# Метрики /metrics: как часто (секунд) процесс прибавляет накопленные значения к общим в Redis и токен,
+# который Prometheus передаёт в заголовке Authorization: Bearer <токен> (пусто - доступ только с METRICS_ALLOWED_IPS)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 10))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Адреса и подсети, с которых /metrics доступен без токена (по умолчанию таких нет). За обратным прокси
+# (nginx перед gunicorn) все запросы приходят с адреса прокси, поэтому его адрес (127.0.0.1) указывать нельзя:
+# /metrics станет доступен всем
+METRICS_ALLOWED_IPS = [
+    network.strip() for network in os.getenv("METRICS_ALLOWED_IPS", "").split(",") if network.strip()
+]
+
 AUTH_USER_MODEL = "users.CustomUser"
 
+# Права пользователя загружаются одним запросом за запрос к сайту и хранятся в памяти процесса (users.access)
+AUTHENTICATION_BACKENDS = ["users.backends.CachedModelBackend"]
+# Для скольких пользователей процесс хранит загруженные группы и права
+USER_ACCESS_CACHE_SIZE = int(os.getenv("USER_ACCESS_CACHE_SIZE", 1000))
+
 LOGIN_URL = "users:login"  # Пользователь, пытающийся зайти на защищенную страницу, будет перенаправлен
 
 LOGIN_REDIRECT_URL = "mailing:home"  # Пользователь попадёт сюда после авторизации
 LOGOUT_REDIRECT_URL = "mailing:home"  # Пользователь попадёт сюда после выхода
 
 CACHE_ENABLED = True
+# Сколько секунд хранятся списки получателей, сообщений и рассылок в кеше. Изменения видны сразу:
+# при сохранении и удалении объектов меняется версия списка
+LIST_CACHE_TTL = int(os.getenv("LIST_CACHE_TTL", 3600))
 if CACHE_ENABLED:
     CACHES = {
         "default": {
-            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            # Redis с кешем в памяти процесса (L1) для ключей с номером версии в имени (mailing.cache_backends)
+            "BACKEND": "mailing.cache_backends.TwoTierRedisCache",
             "LOCATION": os.getenv("LOCATION"),
+            # Сколько записей хранит L1 процесса и сколько секунд хранится запись
+            "L1_MAX_ENTRIES": int(os.getenv("L1_CACHE_MAX_ENTRIES", 1000)),
+            "L1_TIMEOUT": int(os.getenv("L1_CACHE_TIMEOUT", 60)),
+            # Списки и карточки объектов: версия объекта входит в ключ, поэтому запись L1 не устаревает
+            "L1_KEY_PREFIXES": ("subscriber_list:", "message_list:", "mailing_list:", "detail_card:"),
         }
     }
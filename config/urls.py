@@ -19,11 +19,13 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from mailing.views import MetricsView
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path('mailing/', include('mailing.urls', namespace='mailing')),
     path('users/', include('users.urls', namespace='users')),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
 
 if settings.DEBUG:
@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Subscriber, Message, MailingModel, MailingAttempt
+from .models import (
+    Subscriber, Message, MailingModel, MailingAttempt, MailingJob, MailingRetry, MailingDeadLetter, SuppressedAddress,
+    MailingStats,
+)
 
 
 @admin.register(Subscriber)
@@ -25,5 +28,34 @@ class MailingModelAdmin(admin.ModelAdmin):
 # admin.site.register(MailingAttempt)
 @admin.register(MailingAttempt)
 class MailingAttemptAdmin(admin.ModelAdmin):
-    list_display = ('id', 'date_and_time', 'status',)
+    list_display = ('id', 'date_and_time', 'status', 'mailing', 'subscriber')
     list_filter = ('status',)
+
+
+@admin.register(MailingJob)
+class MailingJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'mailing', 'status', 'created_at', 'started_at', 'finished_at', 'worker', 'attempts')
+    list_filter = ('status',)
+
+
+@admin.register(MailingRetry)
+class MailingRetryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'mailing', 'subscriber', 'attempts', 'next_attempt_at', 'last_error')
+
+
+@admin.register(MailingDeadLetter)
+class MailingDeadLetterAdmin(admin.ModelAdmin):
+    list_display = ('id', 'mailing', 'email', 'attempts', 'created_at', 'last_error')
+    search_fields = ('email',)
+
+
+@admin.register(SuppressedAddress)
+class SuppressedAddressAdmin(admin.ModelAdmin):
+    list_display = ('id', 'email', 'owner', 'reason', 'created_at')
+    list_filter = ('reason',)
+    search_fields = ('email',)
+
+
+@admin.register(MailingStats)
+class MailingStatsAdmin(admin.ModelAdmin):
+    list_display = ('id', 'owner', 'total_mailings', 'active_mailings', 'unique_subscribers', 'updated_at')
@@ -4,3 +4,38 @@ from django.apps import AppConfig
 class MailingConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "mailing"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+        from mailing.metrics import install_query_observer
+        from mailing.models import Subscriber, Message, MailingModel
+        from mailing.detail_cache import invalidate_detail_cache
+        from mailing.services import invalidate_list_cache, remember_list_owners
+        from mailing import stats
+
+        # Время и число запросов к БД учитываются в метриках для всех соединений процесса
+        connection_created.connect(install_query_observer, dispatch_uid='mailing_metrics_query_observer')
+
+        # Изменение получателей, сообщений и рассылок сразу меняет версии кешированных списков
+        # и сбрасывает кешированные карточки объектов
+        for handler in (invalidate_list_cache, invalidate_detail_cache):
+            for model in (Subscriber, Message, MailingModel):
+                uid = f'{handler.__name__}_{model.__name__}'
+                post_save.connect(handler, sender=model, dispatch_uid=f'{uid}_save')
+                post_delete.connect(handler, sender=model, dispatch_uid=f'{uid}_delete')
+            m2m_changed.connect(
+                handler, sender=MailingModel.subscriber.through, dispatch_uid=f'{handler.__name__}_recipients'
+            )
+
+        pre_delete.connect(remember_list_owners, sender=Subscriber, dispatch_uid='remember_list_owners_Subscriber')
+
+        # Счётчики главной страницы меняются на разницу при изменении рассылок и получателей
+        pre_save.connect(stats.remember_mailing_state, sender=MailingModel, dispatch_uid='stats_mailing_pre_save')
+        post_save.connect(stats.mailing_saved, sender=MailingModel, dispatch_uid='stats_mailing_save')
+        pre_delete.connect(stats.mailing_deleting, sender=MailingModel, dispatch_uid='stats_mailing_delete')
+        post_save.connect(stats.subscriber_saved, sender=Subscriber, dispatch_uid='stats_subscriber_save')
+        pre_delete.connect(stats.subscriber_deleting, sender=Subscriber, dispatch_uid='stats_subscriber_delete')
+        m2m_changed.connect(
+            stats.recipients_changed, sender=MailingModel.subscriber.through, dispatch_uid='stats_recipients'
+        )
@@ -0,0 +1,134 @@
+import asyncio
+import base64
+import re
+import smtplib
+import ssl
+from mailing.metrics import smtp_command_seconds
+
+
+class AsyncSMTPClient:
+    '''Минимальный SMTP-клиент на asyncio: EHLO, STARTTLS/SSL, AUTH PLAIN/LOGIN, MAIL/RCPT/DATA.
+    Ошибки сервера поднимаются теми же исключениями, что и в smtplib'''
+
+    def __init__(self, host, port, username=None, password=None, use_tls=False, use_ssl=False, timeout=None,
+                 local_hostname='localhost'):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.local_hostname = local_hostname
+        self.reader = None
+        self.writer = None
+        self.extensions = {}
+
+    @property
+    def is_connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self):
+        '''Открывает сессию: приветствие, EHLO, при необходимости STARTTLS и авторизация'''
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        with smtp_command_seconds.time('connect'):
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=ssl_context), self.timeout
+            )
+            await self.expect_reply((220,))
+        await self.ehlo()
+        if self.use_tls:
+            with smtp_command_seconds.time('starttls'):
+                await self.command('STARTTLS', (220,))
+                await self.writer.start_tls(ssl.create_default_context(), server_hostname=self.host)
+            await self.ehlo()
+        if self.username and self.password:
+            with smtp_command_seconds.time('auth'):
+                await self.login()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+        self.reader = self.writer = None
+
+    async def quit(self):
+        if self.is_connected:
+            try:
+                await self.command('QUIT', (221,))
+            except (smtplib.SMTPException, OSError):
+                pass
+        await self.close()
+
+    async def read_reply(self):
+        '''Читает (возможно многострочный) ответ сервера и возвращает (код, текст)'''
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                await self.close()
+                raise smtplib.SMTPServerDisconnected('Соединение закрыто сервером')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+    async def expect_reply(self, expected):
+        code, message = await self.read_reply()
+        if code not in expected:
+            raise smtplib.SMTPResponseException(code, message)
+        return code, message
+
+    async def command(self, line, expected=(250,)):
+        if not self.is_connected:
+            raise smtplib.SMTPServerDisconnected('Нет соединения с сервером')
+        self.writer.write(line.encode() + b'\r\n')
+        await self.writer.drain()
+        return await self.expect_reply(expected)
+
+    async def ehlo(self):
+        _, message = await self.command(f'EHLO {self.local_hostname}')
+        self.extensions = {}
+        for line in message.decode(errors='replace').split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            self.extensions[name.upper()] = params
+
+    async def login(self):
+        mechanisms = self.extensions.get('AUTH', '').upper().split()
+        if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+            token = base64.b64encode(f'\0{self.username}\0{self.password}'.encode()).decode()
+            await self.command(f'AUTH PLAIN {token}', (235,))
+        else:
+            await self.command('AUTH LOGIN', (334,))
+            await self.command(base64.b64encode(self.username.encode()).decode(), (334,))
+            await self.command(base64.b64encode(self.password.encode()).decode(), (235,))
+
+    async def sendmail(self, from_addr, recipients, data):
+        '''Отправляет одно письмо (data - байты с переводами строк CRLF) в рамках открытой сессии'''
+        try:
+            with smtp_command_seconds.time('mail'):
+                await self.command(f'MAIL FROM:<{from_addr}>')
+            refused = {}
+            for recipient in recipients:
+                with smtp_command_seconds.time('rcpt'):
+                    code, message = await self.command(f'RCPT TO:<{recipient}>', range(200, 600))
+                if code not in (250, 251):
+                    refused[recipient] = (code, message)
+            if len(refused) == len(recipients):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            # Строки, начинающиеся с точки, удваиваются (RFC 5321, 4.5.2)
+            data = re.sub(rb'(?m)^\.', b'..', data)
+            if not data.endswith(b'\r\n'):
+                data += b'\r\n'
+            with smtp_command_seconds.time('data'):
+                await self.command('DATA', (354,))
+                self.writer.write(data + b'.\r\n')
+                await self.writer.drain()
+                await self.expect_reply((250,))
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # Сбрасываем транзакцию, чтобы сессию можно было использовать для следующих писем
+            await self.command('RSET')
+            raise
+        return refused
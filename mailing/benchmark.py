@@ -0,0 +1,170 @@
+'''Нагрузочный тест отправки рассылки: локальная SMTP-заглушка с заданными задержками и долей отказов,
+N подписчиков в тестовой рассылке и полный прогон send_mailing. Результат сравнивается с сохранённым
+эталоном, чтобы изменения в отправке не замедляли её незаметно'''
+import json
+import math
+import resource
+import sys
+import time
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from mailing.models import MailingModel, Message, Subscriber
+from mailing.sending import send_mailing
+from mailing.smtp_sink import SMTPSink
+from users.models import CustomUser
+
+# Показатели результата: True - чем больше, тем лучше, False - чем меньше, тем лучше
+METRICS = {
+    'messages_per_second': True,
+    'latency_p50_ms': False,
+    'latency_p99_ms': False,
+    'queries_per_message': False,
+    'peak_rss_mb': False,
+}
+
+BENCHMARK_DOMAINS = ('example.com', 'example.org', 'example.net', 'mail.test', 'inbox.test')
+
+
+def percentile(values, percent):
+    '''Перцентиль percent (0-100) по ближайшему рангу. Для пустого списка - 0'''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def get_peak_rss_mb():
+    '''Пиковый объём резидентной памяти процесса в МБ (ru_maxrss в Linux - в КБ, в macOS - в байтах)'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class QueryCounter:
+    '''Считает SQL-запросы соединения с БД текущего потока, не сохраняя их текст'''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def create_benchmark_mailing(recipients, personalized=False, domains=BENCHMARK_DOMAINS):
+    '''Создаёт владельца, письмо и рассылку с recipients подписчиками, адреса которых распределены
+    по domains. Возвращает рассылку'''
+    token = uuid.uuid4().hex[:12]
+    owner = CustomUser.objects.create(username=f'benchmark-{token}', email=f'benchmark-{token}@example.com')
+    body = 'Проверка скорости отправки.\n' * 20
+    message = Message.objects.create(
+        subject='Здравствуйте, {{ full_name }}' if personalized else 'Нагрузочный тест рассылки',
+        body='Здравствуйте, {{ full_name }}!\n' + body if personalized else body,
+        owner=owner,
+    )
+    now = timezone.now()
+    mailing = MailingModel.objects.create(
+        beginning_sending=now, end_sending=now + timedelta(days=1), message=message, owner=owner
+    )
+    subscribers = Subscriber.objects.bulk_create(
+        [
+            Subscriber(
+                email=f'bench-{token}-{i}@{domains[i % len(domains)]}', full_name=f'Подписчик {i}', owner=owner
+            )
+            for i in range(recipients)
+        ],
+        batch_size=1000,
+    )
+    Through = MailingModel.subscriber.through
+    Through.objects.bulk_create(
+        [Through(mailingmodel_id=mailing.pk, subscriber_id=subscriber.pk) for subscriber in subscribers],
+        batch_size=1000,
+    )
+    return mailing
+
+
+def delete_benchmark_mailing(mailing):
+    '''Удаляет всё, что создала create_benchmark_mailing, вместе с попытками и повторами отправки'''
+    owner = mailing.owner
+    mailing.delete()
+    Subscriber.objects.filter(owner=owner).delete()
+    Message.objects.filter(owner=owner).delete()
+    owner.delete()
+
+
+def run_benchmark(recipients=1000, mode=None, workers=None, latency=None, failure_rates=None,
+                  max_recipients=None, personalized=False, seed=0):
+    '''Отправляет тестовую рассылку recipients подписчикам в локальную SMTP-заглушку и возвращает
+    словарь с показателями METRICS и сводкой прогона. Ограничения скорости отправки на время
+    прогона отключаются, созданные данные удаляются после прогона.
+    Задержка письма - время SMTP-транзакции от MAIL FROM до ответа на DATA, измеренное заглушкой'''
+    sink = SMTPSink(
+        port=0, max_recipients=max_recipients, latency=latency, failure_rates=failure_rates,
+        track_latency=True, seed=seed,
+    ).start_in_thread()
+    mailing = create_benchmark_mailing(recipients, personalized=personalized)
+    counter = QueryCounter()
+    try:
+        with override_settings(
+            EMAIL_BACKEND='mailing.smtp_backend.EmailBackend',
+            EMAIL_HOST=sink.host,
+            EMAIL_PORT=sink.port,
+            # Адрес отправителя сохраняется, без пароля SMTP-бэкенд не выполняет вход на сервер
+            EMAIL_HOST_USER=settings.EMAIL_HOST_USER or 'benchmark@example.com',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            MAILING_RELAY_RATE_LIMIT=0,
+            MAILING_DOMAIN_RATE_LIMITS={},
+        ), connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            sent, failed, _ = send_mailing(mailing, mode=mode, workers=workers)
+            elapsed = time.perf_counter() - started
+    finally:
+        sink.stop()
+        delete_benchmark_mailing(mailing)
+
+    total = sent + failed
+    return {
+        'messages_per_second': total / elapsed if elapsed else 0.0,
+        'latency_p50_ms': percentile(sink.latencies, 50) * 1000,
+        'latency_p99_ms': percentile(sink.latencies, 99) * 1000,
+        'queries_per_message': counter.count / total if total else 0.0,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'recipients': recipients,
+        'mode': mode or settings.MAILING_SEND_MODE,
+        'sent': sent,
+        'failed': failed,
+        'transactions': sink.messages,
+        'elapsed': elapsed,
+    }
+
+
+def find_regressions(result, baseline, tolerance=0.1):
+    '''Сравнивает результат с эталоном. Показатель считается ухудшившимся, если он хуже эталонного
+    больше чем на долю tolerance. Возвращает список описаний ухудшений'''
+    regressions = []
+    for metric, higher_is_better in METRICS.items():
+        if metric not in baseline:
+            continue
+        expected, actual = baseline[metric], result[metric]
+        if higher_is_better:
+            worse = actual < expected * (1 - tolerance)
+        else:
+            worse = actual > expected * (1 + tolerance)
+        if worse:
+            regressions.append(f'{metric}: {actual:.2f} (эталон {expected:.2f}, допуск {tolerance:.0%})')
+    return regressions
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_baseline(path, result):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({metric: result[metric] for metric in METRICS}, file, indent=2)
@@ -0,0 +1,186 @@
+'''Двухуровневый кеш: память процесса (L1) перед Redis (L2).
+
+В L1 попадают только ключи с префиксами L1_KEY_PREFIXES. Это ключи, в имени которых есть номер версии
+(списки объектов, карточки объектов): после изменения объекта читается новый номер версии из Redis и
+новый ключ, поэтому запись L1 не может устареть, и рассылать другим процессам сообщения о сбросе не нужно.
+Номера версий, состояния объектов, флаги отмены и прочие изменяемые ключи всегда читаются из Redis.
+
+L1 общий для всех потоков процесса, ограничен числом записей (L1_MAX_ENTRIES, вытесняются давно
+не читавшиеся) и временем жизни записи (L1_TIMEOUT секунд, но не дольше времени жизни ключа в Redis).
+Значения из L1 отдаются без копирования, поэтому изменять их нельзя. Попадания и промахи L1 учитываются
+в метрике cache_l1_requests_total, вытеснения - в cache_l1_evictions_total'''
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.redis import RedisCache
+from mailing.metrics import Counter
+
+cache_l1_requests = Counter('cache_l1_requests', 'Чтения ключей L1 кеша по результату (hit, miss)', ['result'])
+cache_l1_evictions = Counter('cache_l1_evictions', 'Записи L1 кеша, вытесненные из-за ограничения размера')
+
+MISSING = object()
+
+
+class LocalCache:
+    '''Ограниченный по числу записей LRU с временем жизни записи'''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        evicted = 0
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            cache_l1_evictions.inc(amount=evicted)
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# L1 процесса для каждого сервера Redis и префикса ключей: Django создаёт объект кеша в каждом потоке
+local_caches = {}
+local_caches_lock = threading.Lock()
+
+
+class TwoTierRedisCache(RedisCache):
+    '''RedisCache с L1 в памяти процесса для ключей с префиксами L1_KEY_PREFIXES.
+    Параметры в CACHES: L1_MAX_ENTRIES - сколько записей хранит L1, L1_TIMEOUT - сколько секунд
+    хранится запись L1, L1_KEY_PREFIXES - префиксы ключей с номером версии в имени'''
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self.l1_timeout = int(params.get('L1_TIMEOUT', 60))
+        self.l1_key_prefixes = tuple(params.get('L1_KEY_PREFIXES', ()))
+        with local_caches_lock:
+            self.l1 = local_caches.setdefault(
+                (tuple(self._servers), self.key_prefix), LocalCache(int(params.get('L1_MAX_ENTRIES', 1000)))
+            )
+
+    def in_l1(self, key):
+        return bool(self.l1_key_prefixes) and key.startswith(self.l1_key_prefixes)
+
+    def get_l1_timeout(self, timeout):
+        '''Время жизни записи L1: не дольше L1_TIMEOUT и времени жизни ключа в Redis'''
+        timeout = self.get_backend_timeout(timeout)
+        return self.l1_timeout if timeout is None else min(timeout, self.l1_timeout)
+
+    def get_with_ttl(self, made_key):
+        '''Значение ключа из Redis и оставшееся время его жизни в секундах (None - без ограничения).
+        GET и PTTL выполняются одной транзакцией MULTI/EXEC за один запрос к Redis'''
+        pipeline = self._cache.get_client(made_key).pipeline()
+        pipeline.get(made_key)
+        pipeline.pttl(made_key)
+        value, ttl = pipeline.execute()
+        if value is None:
+            return MISSING, None
+        return self._cache._serializer.loads(value), ttl / 1000 if ttl >= 0 else None
+
+    def get(self, key, default=None, version=None):
+        if not self.in_l1(key):
+            return super().get(key, default, version)
+        made_key = self.make_and_validate_key(key, version=version)
+        value = self.l1.get(made_key)
+        if value is not MISSING:
+            cache_l1_requests.inc('hit')
+            return value
+        cache_l1_requests.inc('miss')
+        value, ttl = self.get_with_ttl(made_key)
+        if value is MISSING:
+            return default
+        l1_timeout = self.l1_timeout if ttl is None else min(ttl, self.l1_timeout)
+        if l1_timeout > 0:
+            self.l1.set(made_key, value, l1_timeout)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = {}
+        for key in keys:
+            if self.in_l1(key):
+                value = self.get(key, MISSING, version)
+                if value is not MISSING:
+                    values[key] = value
+        values.update(super().get_many([key for key in keys if not self.in_l1(key)], version))
+        return values
+
+    def has_key(self, key, version=None):
+        if self.in_l1(key) and self.l1.get(self.make_and_validate_key(key, version=version)) is not MISSING:
+            return True
+        return super().has_key(key, version)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        super().set(key, value, timeout, version)
+        if self.in_l1(key):
+            made_key = self.make_and_validate_key(key, version=version)
+            l1_timeout = self.get_l1_timeout(timeout)
+            if l1_timeout > 0:
+                self.l1.set(made_key, value, l1_timeout)
+            else:
+                self.l1.delete([made_key])
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = super().set_many(data, timeout, version)
+        l1_timeout = self.get_l1_timeout(timeout)
+        for key, value in data.items():
+            if self.in_l1(key) and key not in failed:
+                made_key = self.make_and_validate_key(key, version=version)
+                if l1_timeout > 0:
+                    self.l1.set(made_key, value, l1_timeout)
+                else:
+                    self.l1.delete([made_key])
+        return failed
+
+    def forget(self, keys, version=None):
+        '''Удаляет ключи из L1 процесса'''
+        self.l1.delete([self.make_and_validate_key(key, version=version) for key in keys if self.in_l1(key)])
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.forget([key], version)
+        return super().add(key, value, timeout, version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        self.forget([key], version)
+        return super().touch(key, timeout, version)
+
+    def incr(self, key, delta=1, version=None):
+        self.forget([key], version)
+        return super().incr(key, delta, version)
+
+    def delete(self, key, version=None):
+        self.forget([key], version)
+        return super().delete(key, version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        self.forget(keys, version)
+        return super().delete_many(keys, version)
+
+    def clear(self):
+        self.l1.clear()
+        return super().clear()
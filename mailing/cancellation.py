@@ -0,0 +1,79 @@
+'''Отмена отправки рассылки. Флаг отмены хранится в кеше: отключение или завершение рассылки
+ставит флаг, а идущая отправка проверяет его перед каждой SMTP-транзакцией и останавливается.
+Постановка рассылки в очередь снимает флаг. Значение флага - время отмены: отправку останавливает
+только отмена, запрошенная после постановки задания в очередь (или после запуска отправки из
+командной строки), поэтому старый флаг не отменяет отправку рассылки, включённой заново'''
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+def get_cancel_key(mailing_pk):
+    return f'mailing_cancel:{mailing_pk}'
+
+
+def request_cancel(*mailing_pks):
+    '''Ставит флаг отмены отправки рассылок (значение - время запроса отмены)'''
+    if not mailing_pks:
+        return
+    now = time.time()
+    try:
+        cache.set_many({get_cancel_key(pk): now for pk in mailing_pks}, settings.MAILING_PROGRESS_TTL)
+    except Exception as e:
+        logger.warning('Не удалось поставить флаг отмены отправки рассылок %s (%s)', mailing_pks, e)
+
+
+def clear_cancel(*mailing_pks):
+    '''Снимает флаг отмены: рассылка снова поставлена в очередь'''
+    if not mailing_pks:
+        return
+    try:
+        cache.delete_many([get_cancel_key(pk) for pk in mailing_pks])
+    except Exception as e:
+        logger.warning('Не удалось снять флаг отмены отправки рассылок %s (%s)', mailing_pks, e)
+
+
+def is_cancel_requested(mailing_pk, since=None):
+    '''Запрошена ли отмена отправки рассылки. since - время (timestamp), раньше которого отмена
+    не учитывается'''
+    try:
+        requested_at = cache.get(get_cancel_key(mailing_pk))
+    except Exception as e:
+        logger.warning('Рассылка %s: не удалось прочитать флаг отмены отправки (%s)', mailing_pk, e)
+        return False
+    return requested_at is not None and (since is None or requested_at >= since)
+
+
+class CancellationCheck:
+    '''Проверка флага отмены для запуска отправки рассылки. Флаг читается из кеша при первой проверке
+    и дальше не чаще раза в MAILING_CANCEL_CHECK_INTERVAL секунд, поэтому проверка перед каждой транзакцией
+    почти ничего не стоит. Проверку вызывают одновременно потоки отправки: флаг читает только один из них.
+    Отмена, запрошенная раньше since (timestamp), не учитывается. Отменённый запуск остаётся отменённым'''
+
+    def __init__(self, mailing_pk, since=None, interval=None):
+        self.mailing_pk = mailing_pk
+        self.since = since
+        self.interval = settings.MAILING_CANCEL_CHECK_INTERVAL if interval is None else interval
+        self.checked_at = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        if self.cancelled:
+            return True
+        if self.checked_at is not None and time.monotonic() - self.checked_at < self.interval:
+            return False
+        if not self.lock.acquire(blocking=False):
+            # Флаг сейчас читает другой поток
+            return self.cancelled
+        try:
+            self.checked_at = time.monotonic()
+            if is_cancel_requested(self.mailing_pk, self.since):
+                self.cancelled = True
+        finally:
+            self.lock.release()
+        return self.cancelled
@@ -0,0 +1,143 @@
+'''Кеш страниц объектов (получатель, сообщение, рассылка) и условные GET-запросы.
+
+Для каждого объекта в кеше хранится состояние: номер версии, время изменения и ID владельца. Сигналы
+сохранения и удаления объекта меняют состояние. По состоянию без запроса к объекту в БД проверяется доступ
+и строятся заголовки ETag и Last-Modified, поэтому повторный просмотр неизменённого объекта получает
+ответ 304. Разметка карточки объекта хранится в кеше под ключом (объект, версия, роль зрителя), где
+роль - права, от которых зависят кнопки карточки'''
+import hashlib
+import time
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.context_processors import PermWrapper
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+from mailing.models import Subscriber, Message, MailingModel
+from users.access import get_user_access
+
+
+def get_state_key(name, pk):
+    return f'detail_state:{name}:{pk}'
+
+
+def make_state(obj):
+    # Номер версии - время в микросекундах: номера не повторяются, даже если состояние вытеснено из кеша
+    now = time.time_ns()
+    return {'version': now // 1000, 'modified': now // 10 ** 9, 'owner_id': obj.owner_id}
+
+
+def get_state(name, pk):
+    return cache.get(get_state_key(name, pk))
+
+
+def set_state(name, obj):
+    state = make_state(obj)
+    cache.set(get_state_key(name, obj.pk), state, settings.LIST_CACHE_TTL)
+    return state
+
+
+def delete_states(name, pks):
+    cache.delete_many([get_state_key(name, pk) for pk in pks])
+
+
+class CachedDetailMixin:
+    '''Примесь DetailView: проверка доступа по состоянию объекта в кеше, ответ 304 на условный запрос
+    и разметка карточки объекта из кеша. Страница вокруг карточки (меню, сообщения, токен CSRF)
+    отрисовывается для каждого запроса.
+    detail_cache_name - имя объекта в ключах кеша,
+    card_template_name - шаблон карточки объекта,
+    view_permission - право на просмотр чужих объектов,
+    card_permissions - права, от которых зависит карточка'''
+    detail_cache_name = None
+    card_template_name = None
+    view_permission = None
+    card_permissions = ()
+
+    def check_access(self, owner_id):
+        user = self.request.user
+        if user.pk != owner_id and not user.has_perm(self.view_permission):
+            raise PermissionDenied("У Вас недостаточно прав для просмотра.")
+
+    def get_etag(self, state):
+        '''ETag зависит от версии объекта, групп и прав зрителя (меню и кнопки) и токена CSRF
+        (форма выхода в меню): после их изменения страница отрисовывается заново'''
+        access = get_user_access(self.request.user)
+        parts = [
+            self.detail_cache_name, str(self.kwargs['pk']), str(state['version']), str(self.request.user.pk),
+            *sorted(access.groups), *sorted(access.user_permissions | access.group_permissions),
+            self.request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        ]
+        return quote_etag(hashlib.md5('\n'.join(parts).encode(), usedforsecurity=False).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        self.object = None
+        state = get_state(self.detail_cache_name, kwargs['pk'])
+        if state is None:
+            # get_object проверяет доступ и отдаёт 404, если объекта нет
+            self.object = self.get_object()
+            state = set_state(self.detail_cache_name, self.object)
+        else:
+            self.check_access(state['owner_id'])
+
+        # Страница с непоказанными сообщениями (messages) отрисовывается полностью
+        etag = None
+        if not len(messages.get_messages(request)):
+            etag = self.get_etag(state)
+            response = get_conditional_response(request, etag=etag, last_modified=state['modified'])
+            if response is not None:
+                return response
+
+        user = request.user
+        role = ''.join('1' if user.has_perm(permission) else '0' for permission in self.card_permissions)
+        card_key = f'detail_card:{self.detail_cache_name}:{kwargs["pk"]}:{state["version"]}:{role}'
+        card = cache.get(card_key)
+        if card is None:
+            if self.object is None:
+                self.object = self.get_object()
+            card = render_to_string(
+                self.card_template_name, {self.context_object_name: self.object, 'perms': PermWrapper(user)}
+            )
+            cache.set(card_key, card, settings.LIST_CACHE_TTL)
+
+        response = render(request, self.template_name, {'card': mark_safe(card)})
+        if etag is not None:
+            response.headers['ETag'] = etag
+            response.headers['Last-Modified'] = http_date(state['modified'])
+            # Браузер проверяет актуальность страницы при каждом просмотре
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+
+DETAIL_NAMES = {Subscriber: 'subscriber', Message: 'message', MailingModel: 'mailing'}
+
+
+def get_subscriber_mailing_pks(subscriber):
+    return set(MailingModel.subscriber.through.objects.filter(subscriber=subscriber).values_list(
+        'mailingmodel_id', flat=True
+    ))
+
+
+def invalidate_detail_cache(sender, instance, action=None, reverse=False, pk_set=None, **kwargs):
+    '''Сигналы post_save и post_delete получателей, сообщений и рассылок, m2m_changed получателей рассылки:
+    сбрасывает состояние объекта и рассылок, на карточках которых он показан'''
+    if action == 'pre_clear' and reverse:
+        # После очистки связей рассылки получателя уже не найти: они запоминаются до очистки
+        instance._detail_cleared_mailings = get_subscriber_mailing_pks(instance)
+        return
+    if action is not None and action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    name = DETAIL_NAMES[type(instance)]
+    delete_states(name, [instance.pk])
+    if isinstance(instance, Message):
+        delete_states('mailing', MailingModel.objects.filter(message=instance).values_list('pk', flat=True))
+    elif isinstance(instance, Subscriber):
+        # Рассылки получателя и рассылки, из которых он только что удалён
+        mailing_pks = get_subscriber_mailing_pks(instance)
+        mailing_pks.update(pk_set or ())
+        mailing_pks.update(getattr(instance, '_detail_cleared_mailings', ()))
+        delete_states('mailing', mailing_pks)
@@ -0,0 +1,115 @@
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from mailing.cancellation import clear_cancel
+from mailing.models import MailingModel, MailingJob
+from mailing.sending import send_mailing
+
+logger = logging.getLogger(__name__)
+
+
+def get_worker_name():
+    '''Имя обработчика очереди: хост и PID процесса'''
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue_mailing(mailing):
+    '''Ставит рассылку в очередь на отправку. Если по рассылке уже есть невыполненное задание,
+    новое не создаётся и возвращается существующее. Новое задание снимает флаг отмены рассылки.
+    Возвращает задание и признак того, что оно создано'''
+    with transaction.atomic():
+        # Блокируем строку рассылки, чтобы два одновременных запроса не создали два задания
+        MailingModel.objects.select_for_update().filter(pk=mailing.pk).first()
+        job = MailingJob.objects.filter(
+            mailing=mailing, status__in=[MailingJob.QUEUED, MailingJob.RUNNING]
+        ).first()
+        created = job is None
+        if created:
+            job = MailingJob.objects.create(mailing=mailing)
+            clear_cancel(mailing.pk)
+    return job, created
+
+
+def claim_job(worker=None):
+    '''Забирает из очереди самое старое задание и помечает его выполняемым. Строки, заблокированные
+    другими обработчиками, пропускаются (SKIP LOCKED), поэтому очередь можно разбирать несколькими
+    процессами одновременно. Задания, обработчик которых перестал подавать сигнал дольше
+    MAILING_JOB_LEASE секунд (процесс упал или был перезапущен), забираются повторно'''
+    now = timezone.now()
+    expired = now - timedelta(seconds=settings.MAILING_JOB_LEASE)
+    with transaction.atomic():
+        # Задания, упавшие слишком много раз, больше не перезапускаем
+        MailingJob.objects.filter(
+            status=MailingJob.RUNNING, heartbeat_at__lt=expired, attempts__gte=settings.MAILING_JOB_MAX_ATTEMPTS
+        ).update(status=MailingJob.FAILED, finished_at=now, error='Превышено число перезапусков задания')
+        job = (
+            MailingJob.objects.select_for_update(skip_locked=True)
+            .filter(Q(status=MailingJob.QUEUED) | Q(status=MailingJob.RUNNING, heartbeat_at__lt=expired))
+            .order_by('created_at')
+            .first()
+        )
+        if job is None:
+            return None
+        job.status = MailingJob.RUNNING
+        job.worker = worker or get_worker_name()
+        job.started_at = job.heartbeat_at = now
+        job.attempts += 1
+        job.save(update_fields=['status', 'worker', 'started_at', 'heartbeat_at', 'attempts'])
+    return job
+
+
+class JobHeartbeat:
+    '''Фоновый поток, который, пока выполняется задание, раз в MAILING_JOB_LEASE / 3 секунд подтверждает,
+    что обработчик жив. Сигнал не зависит от хода отправки: долгое ожидание ограничения скорости
+    или медленный сервер не приводят к тому, что задание забирает другой обработчик'''
+
+    def __init__(self, job, interval=None):
+        self.job = job
+        self.interval = interval or settings.MAILING_JOB_LEASE / 3
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f'mailing-job-heartbeat-{job.pk}', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    MailingJob.objects.filter(pk=self.job.pk, status=MailingJob.RUNNING).update(
+                        heartbeat_at=timezone.now()
+                    )
+                except Exception as e:
+                    logger.warning('Задание %s: не удалось обновить сигнал обработчика (%s)', self.job.pk, e)
+        finally:
+            # У потока своё соединение с БД
+            connection.close()
+
+
+def run_job(job):
+    '''Выполняет задание: отправляет рассылку и записывает результат в задание'''
+    mailing = job.mailing
+    try:
+        if mailing.status == MailingModel.FINISHED or not mailing.is_active:
+            job.error = 'Рассылка завершена или отключена, отправка не выполнялась'
+        else:
+            with JobHeartbeat(job):
+                send_mailing(mailing, queued_at=job.created_at)
+        job.status = MailingJob.DONE
+    except Exception as e:
+        job.status = MailingJob.FAILED
+        job.error = str(e)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at'])
+    return job
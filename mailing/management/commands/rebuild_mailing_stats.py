@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from mailing.stats import rebuild_all_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики главной страницы (MailingStats) по всем владельцам и по всей системе'
+
+    def handle(self, *args, **options):
+        rows = rebuild_all_stats()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано строк счётчиков: {rows}'))
+
+# В корне проекта (где manage.py) выполни: python manage.py rebuild_mailing_stats
@@ -0,0 +1,46 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from mailing.jobs import claim_job, get_worker_name, run_job
+from mailing.models import MailingJob
+from mailing.retries import process_due_retries
+
+
+class Command(BaseCommand):
+    help = 'Обработчик очереди заданий на отправку рассылок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=2, help='Пауза при пустой очереди, секунд')
+        parser.add_argument('--burst', action='store_true', help='Завершить работу, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        worker = get_worker_name()
+        self.stdout.write(self.style.SUCCESS(f'Обработчик {worker} запущен.'))
+        try:
+            while True:
+                # Между заданиями закрываем устаревшие соединения с БД, как это делает Django между запросами
+                close_old_connections()
+                job = claim_job(worker)
+                if job is None:
+                    # Повторные отправки выполняются, когда нет новых заданий, и не задерживают основную отправку
+                    retried = process_due_retries()
+                    if retried:
+                        self.stdout.write(f'Обработано повторных отправок: {retried}.')
+                        continue
+                    if options['burst']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                self.stdout.write(f'Задание #{job.pk}: рассылка #{job.mailing_id}...')
+                job = run_job(job)
+                if job.status == MailingJob.DONE:
+                    self.stdout.write(self.style.SUCCESS(f'Задание #{job.pk} выполнено. {job.error}'.strip()))
+                else:
+                    self.stdout.write(self.style.ERROR(f'Задание #{job.pk} завершилось ошибкой: {job.error}'))
+        except KeyboardInterrupt:
+            # Прерванное задание будет забрано повторно по истечении MAILING_JOB_LEASE
+            pass
+        self.stdout.write(f'Обработчик {worker} остановлен.')
+
+# Запуск: python manage.py run_mail_workers
+# Можно запустить несколько экземпляров команды: задания разбираются ими параллельно
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from mailing.scheduler import tick
+
+
+class Command(BaseCommand):
+    help = 'Планировщик: запускает рассылки по времени начала и завершает их по времени окончания'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-sleep', type=float, default=60,
+            help='Наибольшая пауза между проверками, секунд (чтобы заметить новые рассылки)'
+        )
+        parser.add_argument('--once', action='store_true', help='Выполнить одну проверку и завершить работу')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS('Планировщик рассылок запущен.'))
+        try:
+            while True:
+                close_old_connections()
+                now = timezone.now()
+                enqueued, finished, next_event = tick(now)
+                if enqueued or finished:
+                    self.stdout.write(f'Поставлено в очередь рассылок: {enqueued}, завершено рассылок: {finished}.')
+                if options['once']:
+                    break
+                # Спим до ближайшего начала или окончания рассылки, но не дольше --max-sleep
+                sleep = options['max_sleep']
+                if next_event is not None:
+                    sleep = min(sleep, max((next_event - timezone.now()).total_seconds(), 0.1))
+                time.sleep(sleep)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('Планировщик рассылок остановлен.')
+
+# Запуск: python manage.py run_scheduler
+# Поставленные в очередь рассылки отправляет обработчик очереди: python manage.py run_mail_workers
@@ -1,63 +1,80 @@
-from django.core.mail import send_mail
+import os
+import time
 from django.core.management.base import BaseCommand, CommandError
-from mailing.models import MailingModel, MailingAttempt
-from django.conf import settings
-from django.utils import timezone
+from mailing.models import MailingModel
+from mailing.parallel import send_mailings
+from mailing.scheduler import get_due_mailings
+from mailing.sending import SEND_MODES
 
 
 class Command(BaseCommand):
-    help = 'Отправить рассылку вручную по ID через командную строку'
+    help = 'Отправить одну или несколько рассылок вручную по ID через командную строку'
 
-    # Задает аргумент для передачи в командную строку, когда запустим команду
+    # Задает аргументы для передачи в командную строку, когда запустим команду
     def add_arguments(self, parser):
-        parser.add_argument('pk', type=int, help='ID рассылки')
+        parser.add_argument('pk', type=int, nargs='*', help='ID одной или нескольких рассылок')
+        parser.add_argument(
+            '--all-due', action='store_true',
+            help='Отправить все рассылки, время отправки которых наступило, кроме рассылок с заданием в очереди'
+        )
+        parser.add_argument(
+            '--mode', choices=SEND_MODES, help='Режим отправки (по умолчанию MAILING_SEND_MODE из настроек)'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(),
+            help='Число процессов, по которым распределяются рассылки (по умолчанию - число ядер)'
+        )
 
     def handle(self, *args, **kwargs):
-        pk = kwargs['pk']
-        try:
-            mailing = MailingModel.objects.get(pk=pk)
-        except MailingModel.DoesNotExist:
-            raise CommandError('Рассылка не найдена.')
-
-        if mailing.status == MailingModel.FINISHED:
-            self.stdout.write(self.style.ERROR('Рассылка завершена. Отправка невозможна.'))
-            return
-
-        subject = mailing.message.subject
-        body = mailing.message.body
-        subscriber = mailing.subscriber.all()
-        emails = [p.email for p in subscriber]
-
-        if not emails:
-            self.stdout.write(self.style.WARNING('У рассылки нет получателей.'))
-        for email in emails:
-            try:
-                send_mail(
-                    subject=subject,
-                    message=body,
-                    from_email=settings.EMAIL_HOST_USER,
-                    recipient_list=[email],
-                    fail_silently=False,
-                )
-                mailing.status = MailingModel.STARTED
-                mailing.save()
-
-                status_mailing_attempt = MailingAttempt.SUCCESSFULLY
-                server_mail_response = 'Письмо отправлено'
-
-            except Exception as e:
-                status_mailing_attempt = MailingAttempt.NOT_SUCCESSFULL
-                server_mail_response = str(e)
-
-            MailingAttempt.objects.create(
-                date_and_time=timezone.now(),
-                status=status_mailing_attempt,
-                server_mail_response=server_mail_response,
-                mailing=mailing
-            )
-        self.stdout.write(self.style.SUCCESS(f'Успешно отправлено писем: {len(emails)}.'))
+        pks = list(dict.fromkeys(kwargs['pk']))
+        if kwargs['all_due']:
+            pks += [pk for pk in get_due_mailings().values_list('pk', flat=True) if pk not in pks]
+        if not pks:
+            raise CommandError('Укажите ID рассылок или --all-due.')
+
+        statuses = dict(MailingModel.objects.filter(pk__in=pks).values_list('pk', 'status'))
+        missing = [str(pk) for pk in pks if pk not in statuses]
+        if missing:
+            raise CommandError(f'Рассылка не найдена: {", ".join(missing)}.')
+
+        finished = [pk for pk in pks if statuses[pk] == MailingModel.FINISHED]
+        for pk in finished:
+            self.stdout.write(self.style.ERROR(f'Рассылка #{pk} завершена. Отправка невозможна.'))
+        pks = [pk for pk in pks if pk not in finished]
+
+        # Независимые рассылки отправляются параллельно в пуле процессов
+        started = time.perf_counter()
+        total_sent = total_failed = total_suppressed = 0
+        for pk, sent, failed, suppressed, elapsed, error in send_mailings(
+            pks, kwargs['processes'], mode=kwargs['mode']
+        ):
+            if error:
+                self.stdout.write(self.style.ERROR(f'Рассылка #{pk}: ошибка отправки: {error}'))
+            elif not sent + failed:
+                self.stdout.write(self.style.WARNING(
+                    f'Рассылка #{pk}: нет получателей, которым рассылка ещё не доставлена.'
+                    + (f' Отсеяно по списку подавления: {suppressed}.' if suppressed else '')
+                ))
+            else:
+                rate = (sent + failed) / elapsed if elapsed else 0
+                self.stdout.write(self.style.SUCCESS(
+                    f'Рассылка #{pk}: отправлено писем: {sent}, не отправлено: {failed}, '
+                    f'отсеяно по списку подавления: {suppressed}, {elapsed:.2f} с, {rate:.1f} писем/с.'
+                ))
+            total_sent += sent
+            total_failed += failed
+            total_suppressed += suppressed
+        elapsed = time.perf_counter() - started
+
+        if len(pks) > 1:
+            rate = (total_sent + total_failed) / elapsed if elapsed else 0
+            self.stdout.write(self.style.SUCCESS(
+                f'Итого рассылок: {len(pks)}, отправлено писем: {total_sent}, не отправлено: {total_failed}, '
+                f'отсеяно по списку подавления: {total_suppressed}, {elapsed:.2f} с, {rate:.1f} писем/с.'
+            ))
 
 # отправляется рассылка командой python manage.py send_mailing 7 (7 - это ID рассылки)
-# Если принимать несколько ID, можно использовать nargs='+':
-# parser.add_argument('pk', type=int, nargs='+', help='ID одной или нескольких рассылок')
-# отправляются командой python manage.py send_mailing 3 5 7 (3,5,7 - это ID рассылок)
+# несколько рассылок отправляются командой python manage.py send_mailing 3 5 7 (3,5,7 - это ID рассылок),
+# рассылки распределяются по процессам: python manage.py send_mailing 3 5 7 --processes 3
+# все рассылки, время отправки которых наступило: python manage.py send_mailing --all-due
+# Режим отправки можно выбрать явно: python manage.py send_mailing 7 --mode async
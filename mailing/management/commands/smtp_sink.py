@@ -0,0 +1,63 @@
+import asyncio
+from django.core.management.base import BaseCommand, CommandError
+from mailing.smtp_sink import SMTPSink, parse_command_values
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальный SMTP-сервер-заглушку, который принимает и отбрасывает письма'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес для прослушивания')
+        parser.add_argument('--port', type=int, default=8025, help='Порт для прослушивания')
+        parser.add_argument('--interval', type=float, default=5, help='Период вывода статистики, секунд')
+        parser.add_argument(
+            '--max-recipients', type=int, default=None,
+            help='Наибольшее число RCPT TO в одной транзакции (сверх него сервер отвечает 452)'
+        )
+        parser.add_argument(
+            '--latency', action='append', metavar='КОМАНДА=СЕКУНДЫ',
+            help='Задержка ответа на команду MAIL, RCPT или DATA, например RCPT=0.002 (можно указать несколько раз)'
+        )
+        parser.add_argument(
+            '--failure-rate', action='append', metavar='КОМАНДА=ДОЛЯ',
+            help='Доля временных отказов (451) на команду MAIL, RCPT или DATA, например DATA=0.01'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            latency = parse_command_values(options['latency'])
+            failure_rates = parse_command_values(options['failure_rate'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        sink = SMTPSink(
+            host=options['host'], port=options['port'], max_recipients=options['max_recipients'],
+            latency=latency, failure_rates=failure_rates,
+        )
+
+        async def report():
+            received = 0
+            while True:
+                await asyncio.sleep(options['interval'])
+                rate = (sink.messages - received) / options['interval']
+                received = sink.messages
+                self.stdout.write(
+                    f'Принято писем: {received}, получателей: {sink.recipients}, '
+                    f'транзакций на 1000 получателей: {sink.transactions_per_1k:.1f}, '
+                    f'соединений: {sink.connections}, открыто сессий: {sink.sessions}, отказов: {sink.failures}, '
+                    f'{rate:.1f} писем/с'
+                )
+
+        async def main():
+            asyncio.create_task(report())
+            await sink.serve_forever()
+
+        self.stdout.write(self.style.SUCCESS(f'SMTP-заглушка слушает {sink.host}:{sink.port}'))
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            self.stdout.write(f'Всего принято писем: {sink.messages}, получателей: {sink.recipients}')
+            for domain, count in sink.domains.most_common(10):
+                self.stdout.write(f'  {domain}: {count}')
+
+# Запуск: python manage.py smtp_sink --port 8025
+# Для отправки рассылок в заглушку укажите в .env EMAIL_HOST=127.0.0.1 и EMAIL_PORT=8025
@@ -0,0 +1,266 @@
+'''Метрики в формате Prometheus: задержки SMTP-команд, исходы попыток рассылки, время обработки
+запросов и запросы к БД.
+
+Наблюдения копятся в памяти процесса и не чаще раза в METRICS_FLUSH_INTERVAL секунд прибавляются
+к общим значениям в Redis (HINCRBYFLOAT в одном конвейере), поэтому /metrics показывает сумму
+по всем процессам gunicorn и обработчикам очереди. Если кеш не на Redis, /metrics показывает
+только значения текущего процесса'''
+import atexit
+import bisect
+import logging
+import re
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from mailing.redis_client import get_redis_client
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Хеш Redis с общими значениями метрик: поле - строка образца Prometheus, значение - число
+METRICS_KEY = 'metrics'
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+LE_LABEL_RE = re.compile(r',?le="([^"]*)"')
+
+
+def sample_sort_key(field):
+    '''Порядок образцов: по меткам, интервалы гистограммы - по возрастанию границы le'''
+    match = LE_LABEL_RE.search(field)
+    if match is None:
+        return field, 0.0
+    return LE_LABEL_RE.sub('', field), float(match.group(1).replace('+Inf', 'inf'))
+
+
+def format_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.pending = {}
+        registry.register(self)
+
+
+class Counter(Metric):
+    '''Счётчик: значения накапливаются в памяти процесса до выгрузки в общее хранилище'''
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with registry.lock:
+            self.pending[labels] = self.pending.get(labels, 0) + amount
+        registry.maybe_flush()
+
+    def collect(self, pending):
+        '''Образцы Prometheus для прибавления к общим значениям'''
+        for labels, value in pending.items():
+            yield f'{self.name}_total{format_labels(self.labelnames, labels)}', value
+
+
+class Histogram(Metric):
+    '''Гистограмма: в памяти хранится число наблюдений в каждом интервале, накопительные значения
+    по границам le считаются при выгрузке'''
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with registry.lock:
+            state = self.pending.get(labels)
+            if state is None:
+                state = self.pending[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+        registry.maybe_flush()
+
+    def time(self, *labels):
+        '''Контекстный менеджер, который наблюдает время выполнения блока'''
+        return Timer(self, labels)
+
+    def collect(self, pending):
+        for labels, (counts, total) in pending.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                le = (('le', bound if bound == '+Inf' else format_value(bound)),)
+                yield f'{self.name}_bucket{format_labels(self.labelnames, labels, le)}', cumulative
+            yield f'{self.name}_sum{format_labels(self.labelnames, labels)}', total
+            yield f'{self.name}_count{format_labels(self.labelnames, labels)}', cumulative
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+        # Значения, выгруженные без Redis: остаются в памяти процесса
+        self.local = {}
+        self.flush_at = 0.0
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def maybe_flush(self):
+        if time.monotonic() >= self.flush_at:
+            self.flush()
+
+    def flush(self):
+        '''Прибавляет накопленные в процессе значения к общим'''
+        with self.lock:
+            self.flush_at = time.monotonic() + settings.METRICS_FLUSH_INTERVAL
+            pending = [(metric, metric.pending) for metric in self.metrics if metric.pending]
+            for metric, _ in pending:
+                metric.pending = {}
+        samples = [sample for metric, values in pending for sample in metric.collect(values)]
+        if not samples:
+            return
+        try:
+            client = get_redis_client()
+        except Exception:
+            client = None
+        if client is not None:
+            try:
+                pipeline = client.pipeline(transaction=False)
+                key = cache.make_key(METRICS_KEY)
+                for field, value in samples:
+                    pipeline.hincrbyfloat(key, field, value)
+                pipeline.execute()
+                return
+            except Exception as e:
+                logger.warning('Не удалось выгрузить метрики в Redis (%s), значения учтены в процессе', e)
+        with self.lock:
+            for field, value in samples:
+                self.local[field] = self.local.get(field, 0) + value
+
+    def read(self):
+        '''Общие значения метрик: из Redis (сумма по всем процессам) и ещё не выгруженные в Redis
+        значения текущего процесса'''
+        self.flush()
+        try:
+            client = get_redis_client()
+            shared = client.hgetall(cache.make_key(METRICS_KEY)) if client is not None else {}
+        except RedisError as e:
+            # Redis недоступен: /metrics показывает значения текущего процесса, а не ошибку
+            logger.warning('Не удалось прочитать метрики из Redis (%s), показаны значения процесса', e)
+            shared = {}
+        with self.lock:
+            values = dict(self.local)
+        for field, value in shared.items():
+            field = field.decode()
+            values[field] = values.get(field, 0) + float(value)
+        return values
+
+    def render(self):
+        '''Текст для /metrics в формате Prometheus'''
+        values = self.read()
+        by_name = {}
+        for field, value in values.items():
+            by_name.setdefault(field.partition('{')[0], []).append((field, value))
+        lines = []
+        for metric in self.metrics:
+            lines += [f'# HELP {metric.name} {metric.documentation}', f'# TYPE {metric.name} {metric.type}']
+            suffixes = ('_total',) if metric.type == 'counter' else ('_bucket', '_sum', '_count')
+            for suffix in suffixes:
+                samples = sorted(by_name.get(metric.name + suffix, ()), key=lambda sample: sample_sort_key(sample[0]))
+                lines += [f'{field} {format_value(value)}' for field, value in samples]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+# При остановке процесса невыгруженные значения не теряются
+atexit.register(registry.flush)
+
+smtp_command_seconds = Histogram(
+    'mailing_smtp_command_seconds', 'Время SMTP-команд отправки рассылок, секунд', ['command']
+)
+mailing_attempts = Counter('mailing_attempts', 'Записанные попытки рассылки по статусу', ['status'])
+http_request_seconds = Histogram(
+    'http_request_seconds', 'Время обработки HTTP-запросов по представлению, секунд', ['view', 'method']
+)
+http_responses = Counter('http_responses', 'HTTP-ответы по представлению и коду ответа', ['view', 'status'])
+http_request_db_queries = Counter(
+    'http_request_db_queries', 'Запросы к БД при обработке HTTP-запросов по представлению', ['view']
+)
+db_query_seconds = Histogram('db_query_seconds', 'Время запросов к БД, секунд')
+
+# Число запросов к БД в текущем HTTP-запросе потока
+request_state = threading.local()
+
+
+def observe_query(execute, sql, params, many, context):
+    '''Обёртка выполнения запросов к БД (connection.execute_wrapper): время каждого запроса
+    и число запросов в HTTP-запросе'''
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        db_query_seconds.observe(time.perf_counter() - started)
+        if getattr(request_state, 'queries', None) is not None:
+            request_state.queries += 1
+
+
+def install_query_observer(sender, connection, **kwargs):
+    '''Подключает observe_query к каждому новому соединению с БД (сигнал connection_created)'''
+    if observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(observe_query)
+
+
+class MetricsMiddleware:
+    '''Время обработки, код ответа и число запросов к БД по каждому представлению. Представление
+    определяется по имени маршрута, поэтому число меток не растёт с числом разных URL'''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_state.queries = 0
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            elapsed = time.perf_counter() - started
+            queries = request_state.queries
+            request_state.queries = None
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unmatched'
+        http_request_seconds.observe(elapsed, view, request.method)
+        http_responses.inc(view, response.status_code)
+        if queries:
+            http_request_db_queries.inc(view, amount=queries)
+        return response
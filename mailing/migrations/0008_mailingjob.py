@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0007_alter_mailingattempt_options_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailingJob",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("queued", "В очереди"),
+                            ("running", "Выполняется"),
+                            ("done", "Выполнено"),
+                            ("failed", "Ошибка"),
+                        ],
+                        default="queued",
+                        max_length=20,
+                        verbose_name="Статус",
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="Поставлено в очередь")),
+                ("started_at", models.DateTimeField(blank=True, null=True, verbose_name="Начало выполнения")),
+                ("finished_at", models.DateTimeField(blank=True, null=True, verbose_name="Окончание выполнения")),
+                (
+                    "heartbeat_at",
+                    models.DateTimeField(blank=True, null=True, verbose_name="Последний сигнал обработчика"),
+                ),
+                ("worker", models.CharField(blank=True, max_length=255, verbose_name="Обработчик")),
+                ("attempts", models.PositiveIntegerField(default=0, verbose_name="Число запусков")),
+                ("error", models.TextField(blank=True, verbose_name="Ошибка")),
+                (
+                    "mailing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="jobs",
+                        to="mailing.mailingmodel",
+                        verbose_name="Рассылка",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Задание на отправку",
+                "verbose_name_plural": "Задания на отправку",
+                "ordering": ["created_at"],
+                "indexes": [models.Index(fields=["status", "created_at"], name="mailing_mai_status_31f5bb_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0008_mailingjob"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="mailingmodel",
+            index=models.Index(fields=["status", "beginning_sending"], name="mailing_mai_status_2b5279_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="mailingmodel",
+            index=models.Index(fields=["status", "end_sending"], name="mailing_mai_status_baf5b2_idx"),
+        ),
+    ]
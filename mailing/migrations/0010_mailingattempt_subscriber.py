@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0009_mailingmodel_schedule_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mailingattempt",
+            name="subscriber",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="attempts",
+                to="mailing.subscriber",
+                verbose_name="Получатель рассылки",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="mailingattempt",
+            index=models.Index(fields=["mailing", "subscriber", "status"], name="mailing_mai_mailing_25d235_idx"),
+        ),
+    ]
@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0010_mailingattempt_subscriber"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailingDeadLetter",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("email", models.EmailField(max_length=254, verbose_name="Email")),
+                ("attempts", models.PositiveIntegerField(default=1, verbose_name="Число неудачных попыток")),
+                ("last_error", models.TextField(blank=True, verbose_name="Последняя ошибка")),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="Создано")),
+                (
+                    "mailing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="dead_letters",
+                        to="mailing.mailingmodel",
+                        verbose_name="Рассылка",
+                    ),
+                ),
+                (
+                    "subscriber",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="dead_letters",
+                        to="mailing.subscriber",
+                        verbose_name="Получатель рассылки",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Недоставленное письмо",
+                "verbose_name_plural": "Недоставленные письма",
+                "ordering": ["-created_at"],
+            },
+        ),
+        migrations.CreateModel(
+            name="MailingRetry",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("attempts", models.PositiveIntegerField(default=1, verbose_name="Число неудачных попыток")),
+                ("next_attempt_at", models.DateTimeField(verbose_name="Время следующей попытки")),
+                ("last_error", models.TextField(blank=True, verbose_name="Последняя ошибка")),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="Создана")),
+                (
+                    "mailing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="retries",
+                        to="mailing.mailingmodel",
+                        verbose_name="Рассылка",
+                    ),
+                ),
+                (
+                    "subscriber",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="retries",
+                        to="mailing.subscriber",
+                        verbose_name="Получатель рассылки",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Повторная отправка",
+                "verbose_name_plural": "Повторные отправки",
+                "ordering": ["next_attempt_at"],
+                "indexes": [models.Index(fields=["next_attempt_at"], name="mailing_mai_next_at_1b9542_idx")],
+                "constraints": [
+                    models.UniqueConstraint(fields=("mailing", "subscriber"), name="unique_mailing_retry")
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0011_mailingretry_mailingdeadletter"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="body",
+            field=models.TextField(
+                help_text="Введите текст сообщения. Можно использовать {{ full_name }} и {{ email }} получателя",
+                verbose_name="Тело письма",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="subject",
+            field=models.CharField(
+                help_text="Введите тему. Можно использовать {{ full_name }} и {{ email }} получателя",
+                max_length=255,
+                verbose_name="Тема письма",
+            ),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:22
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0012_message_placeholders_help_text"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SuppressedAddress",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "email",
+                    models.EmailField(
+                        help_text="Адрес хранится в нижнем регистре", max_length=254, verbose_name="Email"
+                    ),
+                ),
+                (
+                    "reason",
+                    models.CharField(
+                        choices=[
+                            ("hard_bounce", "Постоянный отказ"),
+                            ("unsubscribed", "Отписка"),
+                            ("manual", "Добавлен вручную"),
+                        ],
+                        default="manual",
+                        max_length=20,
+                        verbose_name="Причина",
+                    ),
+                ),
+                ("comment", models.TextField(blank=True, verbose_name="Комментарий")),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="Добавлен")),
+                (
+                    "owner",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="Оставьте пустым, чтобы адрес не получал ни одной рассылки",
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Владелец",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Подавленный адрес",
+                "verbose_name_plural": "Подавленные адреса",
+                "ordering": ["-created_at"],
+                "constraints": [
+                    models.UniqueConstraint(fields=("email", "owner"), name="unique_suppressed_address"),
+                    models.UniqueConstraint(
+                        condition=models.Q(("owner__isnull", True)),
+                        fields=("email",),
+                        name="unique_global_suppressed_address",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0013_suppressedaddress"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="mailingattempt",
+            name="status",
+            field=models.CharField(
+                choices=[("successfully", "Успешно"), ("not_successful", "Не успешно"), ("cancelled", "Отменено")],
+                max_length=20,
+                verbose_name="Статус отправки",
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:53
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("mailing", "0014_mailingattempt_cancelled_status"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailingStats",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("total_mailings", models.IntegerField(default=0, verbose_name="Всего рассылок")),
+                ("active_mailings", models.IntegerField(default=0, verbose_name="Активных рассылок")),
+                ("unique_subscribers", models.IntegerField(default=0, verbose_name="Уникальных получателей")),
+                ("updated_at", models.DateTimeField(auto_now=True, verbose_name="Обновлено")),
+                (
+                    "owner",
+                    models.OneToOneField(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="mailing_stats",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Владелец",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Статистика рассылок",
+                "verbose_name_plural": "Статистика рассылок",
+                "constraints": [
+                    models.UniqueConstraint(
+                        django.db.models.functions.comparison.Coalesce("owner", models.Value(0)),
+                        name="unique_mailing_stats_owner",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Coalesce
 from users.models import CustomUser
 
 
@@ -25,8 +26,15 @@ class Subscriber(models.Model):
 
 # Модель Сообщение
 class Message(models.Model):
-    subject = models.CharField(max_length=255, verbose_name="Тема письма", help_text="Введите тему")
-    body = models.TextField(verbose_name="Тело письма", help_text="Введите текст сообщения")
+    subject = models.CharField(
+        max_length=255,
+        verbose_name="Тема письма",
+        help_text="Введите тему. Можно использовать {{ full_name }} и {{ email }} получателя",
+    )
+    body = models.TextField(
+        verbose_name="Тело письма",
+        help_text="Введите текст сообщения. Можно использовать {{ full_name }} и {{ email }} получателя",
+    )
     owner = models.ForeignKey(
         CustomUser,
         verbose_name='Владелец',
@@ -86,6 +94,11 @@ class MailingModel(models.Model):
         verbose_name = "Рассылка"
         verbose_name_plural = "Рассылки"
         ordering = ["beginning_sending"]
+        indexes = [
+            # Поиск рассылок, которые пора запустить и которые пора завершить (планировщик run_scheduler)
+            models.Index(fields=["status", "beginning_sending"]),
+            models.Index(fields=["status", "end_sending"]),
+        ]
         permissions = [
             ("can_disable_mailing", "Can disable mailing"),
             ("can_send_message", "Can send_message"),
@@ -99,21 +112,201 @@ class MailingAttempt(models.Model):
     '''Модель попытка рассылки'''
     SUCCESSFULLY = "successfully"
     NOT_SUCCESSFULL = "not_successful"
+    CANCELLED = "cancelled"
 
     STATUSES_CHOICES = [
         (SUCCESSFULLY, "Успешно"),
         (NOT_SUCCESSFULL, "Не успешно"),
+        (CANCELLED, "Отменено"),
     ]
 
     date_and_time = models.DateTimeField(auto_now_add=True, verbose_name="Время отправки")
     status = models.CharField(max_length=20, choices=STATUSES_CHOICES, verbose_name="Статус отправки")
     server_mail_response = models.TextField(verbose_name="Ответ почтового сервера")
     mailing = models.ForeignKey(MailingModel, on_delete=models.CASCADE, related_name='mailings')
+    subscriber = models.ForeignKey(
+        Subscriber,
+        verbose_name="Получатель рассылки",
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name='attempts',
+    )
 
     class Meta:
         verbose_name = "Попытка рассылки"
         verbose_name_plural = "Попытки рассылок"
         ordering = ["date_and_time"]
+        indexes = [
+            # Поиск получателей, которым рассылка уже доставлена (возобновление отправки после сбоя)
+            models.Index(fields=["mailing", "subscriber", "status"]),
+        ]
 
     def __str__(self):
         return f"{self.date_and_time} - {self.status}"
+
+
+class MailingJob(models.Model):
+    '''Модель задание на отправку рассылки (очередь заданий для run_mail_workers)'''
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    STATUSES_CHOICES = [
+        (QUEUED, "В очереди"),
+        (RUNNING, "Выполняется"),
+        (DONE, "Выполнено"),
+        (FAILED, "Ошибка"),
+    ]
+
+    mailing = models.ForeignKey(MailingModel, on_delete=models.CASCADE, verbose_name="Рассылка", related_name="jobs")
+    status = models.CharField(max_length=20, choices=STATUSES_CHOICES, default=QUEUED, verbose_name="Статус")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Поставлено в очередь")
+    started_at = models.DateTimeField(blank=True, null=True, verbose_name="Начало выполнения")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="Окончание выполнения")
+    heartbeat_at = models.DateTimeField(blank=True, null=True, verbose_name="Последний сигнал обработчика")
+    worker = models.CharField(max_length=255, blank=True, verbose_name="Обработчик")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Число запусков")
+    error = models.TextField(blank=True, verbose_name="Ошибка")
+
+    class Meta:
+        verbose_name = "Задание на отправку"
+        verbose_name_plural = "Задания на отправку"
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"Задание #{self.pk} ({self.mailing_id}) - {self.status}"
+
+
+class MailingRetry(models.Model):
+    '''Модель очередь повторных отправок: получатель, письмо которому не ушло из-за временной ошибки'''
+    mailing = models.ForeignKey(
+        MailingModel, on_delete=models.CASCADE, verbose_name="Рассылка", related_name="retries"
+    )
+    subscriber = models.ForeignKey(
+        Subscriber, on_delete=models.CASCADE, verbose_name="Получатель рассылки", related_name="retries"
+    )
+    attempts = models.PositiveIntegerField(default=1, verbose_name="Число неудачных попыток")
+    next_attempt_at = models.DateTimeField(verbose_name="Время следующей попытки")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создана")
+
+    class Meta:
+        verbose_name = "Повторная отправка"
+        verbose_name_plural = "Повторные отправки"
+        ordering = ["next_attempt_at"]
+        indexes = [
+            models.Index(fields=["next_attempt_at"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["mailing", "subscriber"], name="unique_mailing_retry"),
+        ]
+
+    def __str__(self):
+        return f"{self.subscriber_id} ({self.mailing_id}) - {self.next_attempt_at}"
+
+
+class MailingDeadLetter(models.Model):
+    '''Модель недоставляемые письма: постоянная ошибка или исчерпан лимит повторных отправок'''
+    mailing = models.ForeignKey(
+        MailingModel, on_delete=models.CASCADE, verbose_name="Рассылка", related_name="dead_letters"
+    )
+    subscriber = models.ForeignKey(
+        Subscriber,
+        on_delete=models.SET_NULL,
+        verbose_name="Получатель рассылки",
+        blank=True,
+        null=True,
+        related_name="dead_letters",
+    )
+    email = models.EmailField(verbose_name="Email")
+    attempts = models.PositiveIntegerField(default=1, verbose_name="Число неудачных попыток")
+    last_error = models.TextField(blank=True, verbose_name="Последняя ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
+
+    class Meta:
+        verbose_name = "Недоставленное письмо"
+        verbose_name_plural = "Недоставленные письма"
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.email} ({self.mailing_id})"
+
+
+class SuppressedAddress(models.Model):
+    '''Модель список подавления: адреса, на которые рассылки не отправляются (постоянный отказ сервера
+    получателя, отписка). Запись без владельца действует для всех рассылок, с владельцем - только
+    для его рассылок'''
+    HARD_BOUNCE = "hard_bounce"
+    UNSUBSCRIBED = "unsubscribed"
+    MANUAL = "manual"
+
+    REASONS_CHOICES = [
+        (HARD_BOUNCE, "Постоянный отказ"),
+        (UNSUBSCRIBED, "Отписка"),
+        (MANUAL, "Добавлен вручную"),
+    ]
+
+    email = models.EmailField(verbose_name="Email", help_text="Адрес хранится в нижнем регистре")
+    owner = models.ForeignKey(
+        CustomUser,
+        verbose_name='Владелец',
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        help_text="Оставьте пустым, чтобы адрес не получал ни одной рассылки",
+    )
+    reason = models.CharField(max_length=20, choices=REASONS_CHOICES, default=MANUAL, verbose_name="Причина")
+    comment = models.TextField(blank=True, verbose_name="Комментарий")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Добавлен")
+
+    class Meta:
+        verbose_name = "Подавленный адрес"
+        verbose_name_plural = "Подавленные адреса"
+        ordering = ["-created_at"]
+        constraints = [
+            models.UniqueConstraint(fields=["email", "owner"], name="unique_suppressed_address"),
+            models.UniqueConstraint(
+                fields=["email"], condition=models.Q(owner__isnull=True), name="unique_global_suppressed_address"
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.email = self.email.lower()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.email} - {self.get_reason_display()}"
+
+
+class MailingStats(models.Model):
+    '''Модель счётчики главной страницы по владельцу рассылок. Строка без владельца - по всей системе.
+    Счётчики обновляются сигналами при изменении рассылок и получателей (mailing.stats), заново
+    пересчитываются командой rebuild_mailing_stats'''
+    owner = models.OneToOneField(
+        CustomUser,
+        verbose_name='Владелец',
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name='mailing_stats',
+    )
+    total_mailings = models.IntegerField(default=0, verbose_name="Всего рассылок")
+    active_mailings = models.IntegerField(default=0, verbose_name="Активных рассылок")
+    unique_subscribers = models.IntegerField(default=0, verbose_name="Уникальных получателей")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Обновлено")
+
+    class Meta:
+        verbose_name = "Статистика рассылок"
+        verbose_name_plural = "Статистика рассылок"
+        constraints = [
+            # Строка по всей системе (без владельца) одна
+            models.UniqueConstraint(Coalesce("owner", models.Value(0)), name="unique_mailing_stats_owner"),
+        ]
+
+    def __str__(self):
+        return f"{self.owner or 'Все рассылки'}: {self.total_mailings} / {self.active_mailings}"
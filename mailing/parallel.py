@@ -0,0 +1,46 @@
+'''Параллельная отправка нескольких рассылок в пуле процессов.
+
+Модели импортируются внутри функций: при запуске процессов через spawn/forkserver дочерний процесс
+импортирует этот модуль до вызова django.setup() в init_worker'''
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import django
+from django.db import connections
+
+
+def init_worker():
+    '''Инициализация процесса пула: настраивает Django и отбрасывает соединения с БД родителя,
+    чтобы каждый процесс открыл собственное'''
+    django.setup()
+    connections.close_all()
+
+
+def send_mailing_by_pk(pk, mode=None):
+    '''Отправляет рассылку в текущем процессе и возвращает сводку: (ID рассылки, отправлено,
+    не отправлено, отсеяно по списку подавления, время отправки в секундах, текст ошибки или пустая строка)'''
+    from mailing.models import MailingModel
+    from mailing.sending import send_mailing
+
+    started = time.perf_counter()
+    try:
+        mailing = MailingModel.objects.select_related('message').get(pk=pk)
+        sent, failed, suppressed = send_mailing(mailing, mode=mode)
+    except Exception as e:
+        return pk, 0, 0, 0, time.perf_counter() - started, str(e)
+    return pk, sent, failed, suppressed, time.perf_counter() - started, ''
+
+
+def send_mailings(pks, processes, mode=None):
+    '''Распределяет рассылки по пулу из processes процессов, у каждого свои соединения с БД и SMTP.
+    По мере завершения рассылок отдаёт их сводки'''
+    if processes <= 1 or len(pks) <= 1:
+        for pk in pks:
+            yield send_mailing_by_pk(pk, mode)
+        return
+
+    # Соединения с БД нельзя разделять между процессами: закрываем их до создания пула
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=min(processes, len(pks)), initializer=init_worker) as executor:
+        futures = [executor.submit(send_mailing_by_pk, pk, mode) for pk in pks]
+        for future in as_completed(futures):
+            yield future.result()
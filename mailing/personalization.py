@@ -0,0 +1,66 @@
+import re
+from functools import lru_cache
+
+
+# Поля получателя в том порядке, в котором отправщики передают их в кортеже получателя
+RECIPIENT_FIELDS = ('id', 'email', 'full_name')
+
+# Поля подписчика, доступные в шаблоне письма как {{ поле }}
+TEMPLATE_FIELDS = ('email', 'full_name')
+
+PLACEHOLDER_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+class CompiledTemplate:
+    '''Шаблон темы или тела письма, разобранный один раз: текст разбит на неизменные части и номера
+    полей получателя. Для подстановки в текст шаблон хранится строкой формата str.format, для сборки
+    письма из байтов - частями, заранее закодированными в UTF-8'''
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = []
+        format_parts = []
+        self.parts = []
+        position = 0
+        for match in PLACEHOLDER_RE.finditer(text):
+            name = match.group(1)
+            if name not in TEMPLATE_FIELDS:
+                # Неизвестные подстановки оставляются в тексте как есть
+                continue
+            index = RECIPIENT_FIELDS.index(name)
+            literal = text[position:match.start()]
+            format_parts += [literal.replace('{', '{{').replace('}', '}}'), '{%d}' % index]
+            self.parts += [literal.encode(), index]
+            self.fields.append(index)
+            position = match.end()
+        literal = text[position:]
+        format_parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        self.parts.append(literal.encode())
+        self.format = ''.join(format_parts)
+        # Самая длинная строка шаблона в байтах: вместе с длиной подставленных полей даёт оценку сверху
+        # длины строк готового текста
+        self.max_line_length = max(len(line.encode()) for line in text.split('\n'))
+
+    @property
+    def is_static(self):
+        '''Шаблон без подстановок: текст одинаков для всех получателей'''
+        return not self.fields
+
+    def render(self, recipient):
+        '''Текст для получателя - кортежа с полями RECIPIENT_FIELDS'''
+        if self.is_static:
+            return self.text
+        return self.format.format(*recipient)
+
+    def render_bytes(self, recipient):
+        '''Текст для получателя в UTF-8 и оценка сверху длины его самой длинной строки в байтах'''
+        values = {index: str(recipient[index]).encode() for index in self.fields}
+        parts = [part if isinstance(part, bytes) else values[part] for part in self.parts]
+        return b''.join(parts), self.max_line_length + sum(len(values[index]) for index in self.fields)
+
+
+@lru_cache(maxsize=256)
+def compile_template(text):
+    '''Компилирует шаблон. Скомпилированные шаблоны кэшируются в процессе, поэтому повторные
+    запуски рассылки и повторные отправки не компилируют одно и то же письмо заново'''
+    return CompiledTemplate(text)
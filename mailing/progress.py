@@ -0,0 +1,144 @@
+import logging
+import time
+from django.conf import settings
+from django.core.cache import cache
+from mailing.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Состояния отправки рассылки
+PROGRESS_QUEUED = 'queued'
+PROGRESS_RUNNING = 'running'
+PROGRESS_FINISHED = 'finished'
+PROGRESS_FAILED = 'failed'
+PROGRESS_CANCELLED = 'cancelled'
+
+# Счётчики прогресса: всего получателей в запуске, отправлено, не отправлено, отсеяно по списку подавления,
+# отменено (отправка остановлена флагом отмены)
+PROGRESS_COUNTERS = ('total', 'sent', 'failed', 'suppressed', 'cancelled')
+
+
+def get_progress_key(mailing_pk):
+    return f'mailing_progress:{mailing_pk}'
+
+
+def write_progress(mailing_pk, values=None, increments=None):
+    '''Записывает поля прогресса рассылки и атомарно увеличивает счётчики. В Redis прогресс хранится
+    одним хешем (HSET и HINCRBY в одном конвейере), иначе - отдельными ключами кеша Django.
+    Ошибки хранилища не прерывают отправку'''
+    values = values or {}
+    increments = {field: value for field, value in (increments or {}).items() if value}
+    key = get_progress_key(mailing_pk)
+    try:
+        client = get_redis_client()
+        if client is not None:
+            redis_key = cache.make_key(key)
+            pipeline = client.pipeline(transaction=False)
+            if values:
+                pipeline.hset(redis_key, mapping=values)
+            for field, value in increments.items():
+                pipeline.hincrby(redis_key, field, value)
+            pipeline.expire(redis_key, settings.MAILING_PROGRESS_TTL)
+            pipeline.execute()
+            return
+        cache.set_many({f'{key}:{field}': value for field, value in values.items()}, settings.MAILING_PROGRESS_TTL)
+        for field, value in increments.items():
+            try:
+                cache.incr(f'{key}:{field}', value)
+            except ValueError:
+                cache.set(f'{key}:{field}', value, settings.MAILING_PROGRESS_TTL)
+    except Exception as e:
+        logger.warning('Рассылка %s: не удалось записать прогресс отправки (%s)', mailing_pk, e)
+
+
+def read_progress(mailing_pk):
+    '''Сырые поля прогресса рассылки: словарь строк или пустой словарь, если отправка не запускалась'''
+    key = get_progress_key(mailing_pk)
+    try:
+        client = get_redis_client()
+        if client is not None:
+            return {
+                field.decode(): value.decode() for field, value in client.hgetall(cache.make_key(key)).items()
+            }
+        fields = ('state', 'started_at', 'updated_at', 'finished_at', *PROGRESS_COUNTERS)
+        return {
+            field.rpartition(':')[2]: str(value)
+            for field, value in cache.get_many([f'{key}:{field}' for field in fields]).items()
+        }
+    except Exception as e:
+        logger.warning('Рассылка %s: не удалось прочитать прогресс отправки (%s)', mailing_pk, e)
+        return {}
+
+
+def mark_queued(mailing_pk):
+    '''Рассылка поставлена в очередь: счётчики предыдущего запуска обнуляются'''
+    now = time.time()
+    write_progress(mailing_pk, values={
+        'state': PROGRESS_QUEUED, 'started_at': '', 'finished_at': '', 'updated_at': now,
+        **{field: 0 for field in PROGRESS_COUNTERS},
+    })
+
+
+class ProgressTracker:
+    '''Передаёт число отправленных, не отправленных и отсеянных писем запуска рассылки в счётчики
+    прогресса не чаще раза в MAILING_PROGRESS_INTERVAL секунд, а не после каждого письма'''
+
+    def __init__(self, mailing_pk, total, interval=None):
+        self.mailing_pk = mailing_pk
+        self.interval = settings.MAILING_PROGRESS_INTERVAL if interval is None else interval
+        self.flushed = (0, 0, 0)
+        self.flushed_at = time.monotonic()
+        now = time.time()
+        write_progress(mailing_pk, values={
+            'state': PROGRESS_RUNNING, 'started_at': now, 'updated_at': now, 'finished_at': '',
+            'total': total, 'sent': 0, 'failed': 0, 'suppressed': 0, 'cancelled': 0,
+        })
+
+    def update(self, sent, failed, suppressed, force=False):
+        '''sent, failed, suppressed - число писем с начала запуска'''
+        if not force and time.monotonic() - self.flushed_at < self.interval:
+            return
+        counts = (sent, failed, suppressed)
+        if counts != self.flushed:
+            write_progress(
+                self.mailing_pk,
+                values={'updated_at': time.time()},
+                increments=dict(zip(('sent', 'failed', 'suppressed'), (
+                    count - flushed for count, flushed in zip(counts, self.flushed)
+                ))),
+            )
+            self.flushed = counts
+        self.flushed_at = time.monotonic()
+
+    def finish(self, sent, failed, suppressed, error=None, cancelled=None):
+        '''cancelled - число писем, не отправленных из-за отмены, или None, если отправка не отменялась'''
+        self.update(sent, failed, suppressed, force=True)
+        if error:
+            values = {'state': PROGRESS_FAILED}
+        elif cancelled is not None:
+            values = {'state': PROGRESS_CANCELLED, 'cancelled': cancelled}
+        else:
+            values = {'state': PROGRESS_FINISHED}
+        write_progress(self.mailing_pk, values={**values, 'finished_at': time.time()})
+
+
+def get_progress(mailing_pk):
+    '''Прогресс отправки рассылки: состояние, счётчики, доля обработанных получателей, скорость
+    (писем в секунду) и оценка оставшегося времени в секундах (None, если её нельзя рассчитать)'''
+    raw = read_progress(mailing_pk)
+    progress = {field: int(raw.get(field) or 0) for field in PROGRESS_COUNTERS}
+    progress['state'] = raw.get('state', '')
+    processed = progress['sent'] + progress['failed'] + progress['suppressed']
+    progress['processed'] = processed
+    progress['percent'] = round(100 * processed / progress['total'], 1) if progress['total'] else 0.0
+
+    started_at = float(raw.get('started_at') or 0)
+    finished_at = float(raw.get('finished_at') or 0)
+    elapsed = (finished_at or time.time()) - started_at if started_at else 0
+    progress['rate'] = round((progress['sent'] + progress['failed']) / elapsed, 1) if elapsed > 0 else 0.0
+    remaining = max(progress['total'] - processed, 0)
+    if progress['state'] == PROGRESS_RUNNING and progress['rate']:
+        progress['eta'] = round(remaining / progress['rate'])
+    else:
+        progress['eta'] = None
+    return progress
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from mailing.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# Корзина токенов в Redis. Время берётся у сервера Redis, поэтому часы отправляющих узлов не влияют на лимит.
+# Токен резервируется сразу, даже в долг: вызывающий получает время ожидания своей очереди и не
+# повторяет запрос, а ёмкость не простаивает между проверками
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - count
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+'''
+
+
+class TokenBucket:
+    '''Корзина токенов в памяти процесса: rate писем в секунду, всплеск до burst писем'''
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, count=1):
+        '''Резервирует count токенов и возвращает, сколько секунд нужно подождать перед отправкой'''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate) - count
+            self.ts = now
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RedisTokenBucket(TokenBucket):
+    '''Корзина токенов в Redis: общий лимит для всех потоков, процессов и узлов отправки'''
+
+    def __init__(self, name, rate, burst, client):
+        super().__init__(name, rate, burst)
+        self.client = client
+        self.key = cache.make_key(f'ratelimit:{name}')
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def reserve(self, count=1):
+        try:
+            return float(self.script(keys=[self.key], args=[self.rate, self.burst, count]))
+        except Exception as e:
+            # Redis недоступен: продолжаем с лимитом в памяти процесса, а не останавливаем отправку
+            logger.warning('Лимит %s: Redis недоступен (%s), используется лимит процесса', self.name, e)
+            return super().reserve(count)
+
+
+class RateLimiter:
+    '''Ограничивает скорость отправки: корзина токенов на каждый SMTP-сервер (MAILING_RELAY_RATE_LIMIT)
+    и, при настройке, на каждый домен получателей (MAILING_DOMAIN_RATE_LIMITS). Корзины хранятся
+    в Redis, если кеш по умолчанию на Redis, иначе в памяти процесса'''
+
+    def __init__(self):
+        self.client = get_redis_client()
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, name, rate, burst):
+        with self.lock:
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                if self.client is not None:
+                    bucket = RedisTokenBucket(name, rate, burst, self.client)
+                else:
+                    bucket = TokenBucket(name, rate, burst)
+                self.buckets[name] = bucket
+        return bucket
+
+    def reserve(self, relay, email, count=1):
+        '''Резервирует отправку count писем на адреса домена email через SMTP-сервер relay и возвращает,
+        сколько секунд нужно подождать. Без настроенных лимитов не обращается к Redis'''
+        wait = 0.0
+        if settings.MAILING_RELAY_RATE_LIMIT:
+            bucket = self.get_bucket(
+                f'relay:{relay}', settings.MAILING_RELAY_RATE_LIMIT, settings.MAILING_RELAY_BURST
+            )
+            wait = bucket.reserve(count)
+        domain = email.rpartition('@')[2].lower()
+        limit = settings.MAILING_DOMAIN_RATE_LIMITS.get(domain)
+        if limit:
+            wait = max(wait, self.get_bucket(f'domain:{domain}', *limit).reserve(count))
+        return wait
+
+    def acquire(self, relay, email, count=1):
+        '''Блокирует поток, пока отправка count писем не уложится в лимиты'''
+        wait = self.reserve(relay, email, count)
+        if wait:
+            time.sleep(wait)
+
+
+rate_limiter = None
+
+
+def get_rate_limiter():
+    '''Общий для процесса ограничитель скорости'''
+    global rate_limiter
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+    return rate_limiter
@@ -0,0 +1,12 @@
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+
+
+def get_redis_client():
+    '''Возвращает клиент redis-py из кеша по умолчанию (CACHES['default']) для атомарных операций,
+    которых нет в API кеша Django. Если кеш не на Redis (CACHE_ENABLED = False), возвращает None'''
+    # django.core.cache.cache - прокси, тип бэкенда проверяется у самого объекта кеша
+    cache = caches['default']
+    if isinstance(cache, RedisCache):
+        return cache._cache.get_client(write=True)
+    return None
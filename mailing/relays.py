@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Задержка, которую получает ещё не измеренный сервер: новые серверы сразу получают часть писем
+INITIAL_LATENCY = 0.001
+
+
+class Relay:
+    '''SMTP-сервер пула и его состояние: сглаженные задержка транзакции и доля ошибок, число транзакций
+    в работе и время, до которого сервер исключён из выбора'''
+
+    def __init__(self, host, port, weight=1.0):
+        self.host = host
+        self.port = int(port)
+        self.weight = weight
+        self.name = f'{host}:{self.port}'
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.in_flight = 0
+        self.ejected_until = None
+        self.probing = False
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def is_ejected(self):
+        return self.ejected_until is not None
+
+    @property
+    def score(self):
+        '''Оценка сервера для выбора: задержка с учётом транзакций в работе, делённая на вес и долю успешных
+        транзакций. Меньше - лучше'''
+        load = (self.latency or INITIAL_LATENCY) * (self.in_flight + 1) / self.weight
+        return load / max(1 - self.error_rate, 0.01)
+
+    def reset(self, latency=None):
+        self.latency = latency
+        self.error_rate = 0.0
+        self.samples = 0
+        self.ejected_until = None
+
+
+def parse_relays(values, default_port=25):
+    '''Разбирает серверы из строк вида host, host:port или host:port:вес'''
+    relays = []
+    for value in values:
+        host, _, rest = value.partition(':')
+        port, _, weight = rest.partition(':')
+        relays.append(Relay(host, port or default_port, float(weight or 1)))
+    return relays
+
+
+class RelayPool:
+    '''Пул SMTP-серверов для отправки рассылок. Каждая транзакция отправляется через сервер с наименьшей
+    взвешенной задержкой. Сервер, у которого доля ошибок превысила max_error_rate или задержка превысила
+    max_latency, исключается на probe_interval секунд, после чего получает одну пробную транзакцию:
+    при успехе он возвращается в пул, при ошибке исключается снова. Состояние серверов общее для всех
+    отправщиков процесса'''
+
+    def __init__(self, relays, max_error_rate=0.5, max_latency=0, probe_interval=30, min_samples=5,
+                 smoothing=0.2):
+        self.relays = relays
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.probe_interval = probe_interval
+        self.min_samples = min_samples
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.relays)
+
+    def choose(self, exclude=()):
+        '''Выбирает сервер для следующей транзакции, кроме серверов из exclude, и учитывает транзакцию
+        как начатую. После отправки нужно вызвать release'''
+        with self.lock:
+            now = time.monotonic()
+            candidates = [relay for relay in self.relays if relay not in exclude] or self.relays
+            # Исключённый сервер, срок исключения которого истёк, получает одну пробную транзакцию
+            for relay in candidates:
+                if relay.is_ejected and not relay.probing and relay.ejected_until <= now:
+                    relay.probing = True
+                    relay.in_flight += 1
+                    return relay
+            available = [relay for relay in candidates if not relay.is_ejected]
+            if available:
+                relay = min(available, key=lambda relay: relay.score)
+            else:
+                # Исключены все серверы: отправка не останавливается и идёт через тот, что вернётся раньше всех
+                relay = min(candidates, key=lambda relay: relay.ejected_until)
+            relay.in_flight += 1
+            return relay
+
+    def release(self, relay, elapsed, failed=False):
+        '''Учитывает результат транзакции через relay: время в секундах и была ли ошибка сервера'''
+        with self.lock:
+            relay.in_flight -= 1
+            if relay.probing:
+                relay.probing = False
+                if failed:
+                    relay.ejected_until = time.monotonic() + self.probe_interval
+                else:
+                    relay.reset(latency=elapsed)
+                    logger.warning('SMTP-сервер %s возвращён в пул после пробной отправки', relay)
+                return
+
+            relay.samples += 1
+            relay.error_rate += self.smoothing * (float(failed) - relay.error_rate)
+            if not failed:
+                if relay.latency is None:
+                    relay.latency = elapsed
+                else:
+                    relay.latency += self.smoothing * (elapsed - relay.latency)
+            if relay.is_ejected or relay.samples < self.min_samples:
+                return
+            too_slow = self.max_latency and relay.latency is not None and relay.latency > self.max_latency
+            if relay.error_rate > self.max_error_rate or too_slow:
+                relay.ejected_until = time.monotonic() + self.probe_interval
+                logger.warning(
+                    'SMTP-сервер %s исключён из пула на %s с: доля ошибок %.2f, задержка %.3f с',
+                    relay, self.probe_interval, relay.error_rate, relay.latency or 0,
+                )
+
+
+relay_pool = None
+relay_pool_config = None
+
+
+def get_relay_config():
+    return (
+        tuple(settings.MAILING_RELAYS),
+        settings.EMAIL_HOST,
+        settings.EMAIL_PORT,
+        settings.MAILING_RELAY_MAX_ERROR_RATE,
+        settings.MAILING_RELAY_MAX_LATENCY,
+        settings.MAILING_RELAY_PROBE_INTERVAL,
+    )
+
+
+def get_relay_pool():
+    '''Общий для процесса пул SMTP-серверов из MAILING_RELAYS или, если список не задан, из одного
+    сервера EMAIL_HOST. Пул создаётся заново, только если настройки серверов изменились'''
+    global relay_pool, relay_pool_config
+    config = get_relay_config()
+    if relay_pool is None or relay_pool_config != config:
+        relays = parse_relays(settings.MAILING_RELAYS, default_port=settings.EMAIL_PORT or 25)
+        if not relays:
+            relays = [Relay(settings.EMAIL_HOST, settings.EMAIL_PORT or 25)]
+        relay_pool = RelayPool(
+            relays,
+            max_error_rate=settings.MAILING_RELAY_MAX_ERROR_RATE,
+            max_latency=settings.MAILING_RELAY_MAX_LATENCY,
+            probe_interval=settings.MAILING_RELAY_PROBE_INTERVAL,
+        )
+        relay_pool_config = config
+    return relay_pool
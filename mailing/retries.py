@@ -0,0 +1,110 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from mailing.models import MailingModel, MailingAttempt, MailingRetry, MailingDeadLetter
+from mailing.sending import (
+    AttemptRecorder, PreparedMessage, get_retry_delay, get_sender, is_transient_error, mark_started
+)
+from mailing.suppression import get_suppressed_emails, is_suppressed
+
+
+def claim_due_retries(batch_size=None):
+    '''Забирает пачку повторных отправок, время которых наступило. Забранные записи откладываются
+    на MAILING_JOB_LEASE секунд, поэтому другие обработчики их не возьмут, а при падении обработчика
+    они вернутся в очередь'''
+    now = timezone.now()
+    with transaction.atomic():
+        retries = list(
+            MailingRetry.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(next_attempt_at__lte=now)
+            .select_related('mailing__message', 'subscriber')
+            .order_by('next_attempt_at')[:batch_size or settings.MAILING_RETRY_BATCH_SIZE]
+        )
+        MailingRetry.objects.filter(pk__in=[retry.pk for retry in retries]).update(
+            next_attempt_at=now + timedelta(seconds=settings.MAILING_JOB_LEASE)
+        )
+    return retries
+
+
+def to_dead_letter(retry, last_error):
+    return MailingDeadLetter(
+        mailing=retry.mailing,
+        subscriber=retry.subscriber,
+        email=retry.subscriber.email,
+        attempts=retry.attempts,
+        last_error=last_error,
+    )
+
+
+def retry_mailing(mailing, retries):
+    '''Повторно отправляет рассылку получателям из retries. Доставленные удаляются из очереди,
+    при временной ошибке отправка откладывается с экспоненциальной задержкой, а после
+    MAILING_RETRY_MAX_ATTEMPTS неудач или при постоянной ошибке получатель попадает в недоставленные'''
+    if mailing.status == MailingModel.FINISHED or not mailing.is_active:
+        MailingDeadLetter.objects.bulk_create(
+            [to_dead_letter(retry, 'Рассылка завершена или отключена') for retry in retries]
+        )
+        MailingRetry.objects.filter(pk__in=[retry.pk for retry in retries]).delete()
+        return
+
+    # Получателям, которым письмо тем временем доставлено другим запуском, повтор не нужен
+    delivered = set(MailingAttempt.objects.filter(
+        mailing=mailing,
+        subscriber_id__in=[retry.subscriber_id for retry in retries],
+        status=MailingAttempt.SUCCESSFULLY,
+    ).values_list('subscriber_id', flat=True))
+    done = [retry for retry in retries if retry.subscriber_id in delivered]
+    pending = {retry.subscriber_id: retry for retry in retries if retry.subscriber_id not in delivered}
+    rescheduled, dead_letters = [], []
+    sent = False
+
+    # Адреса, попавшие в список подавления после первой попытки, повторно не отправляются
+    suppressed = get_suppressed_emails(mailing.owner_id)
+    for subscriber_id, retry in list(pending.items()):
+        if is_suppressed(retry.subscriber.email, suppressed):
+            dead_letters.append(to_dead_letter(retry, 'Адрес в списке подавления'))
+            done.append(retry)
+            del pending[subscriber_id]
+
+    recipients = [
+        (retry.subscriber_id, retry.subscriber.email, retry.subscriber.full_name) for retry in pending.values()
+    ]
+    if recipients:
+        with get_sender() as sender, AttemptRecorder(mailing, queue_failures=False) as recorder:
+            for recipient, status_mailing_attempt, server_mail_response, error in sender.send(
+                PreparedMessage(mailing.message), recipients
+            ):
+                # Ошибка передаётся, как и в send_mailing: отвергнутый навсегда адрес попадает в список подавления
+                recorder.add(recipient, status_mailing_attempt, server_mail_response, error)
+                retry = pending[recipient[0]]
+                if error is None:
+                    sent = True
+                    done.append(retry)
+                    continue
+                retry.attempts += 1
+                retry.last_error = server_mail_response
+                if is_transient_error(error) and retry.attempts < settings.MAILING_RETRY_MAX_ATTEMPTS:
+                    retry.next_attempt_at = timezone.now() + get_retry_delay(retry.attempts)
+                    rescheduled.append(retry)
+                else:
+                    dead_letters.append(to_dead_letter(retry, server_mail_response))
+                    done.append(retry)
+
+    if sent and mailing.status != MailingModel.STARTED:
+        mark_started(mailing)
+    MailingRetry.objects.bulk_update(rescheduled, ['attempts', 'next_attempt_at', 'last_error'])
+    MailingDeadLetter.objects.bulk_create(dead_letters)
+    MailingRetry.objects.filter(pk__in=[retry.pk for retry in done]).delete()
+
+
+def process_due_retries(batch_size=None):
+    '''Обрабатывает одну пачку повторных отправок. Возвращает число обработанных записей'''
+    retries = claim_due_retries(batch_size)
+    by_mailing = defaultdict(list)
+    for retry in retries:
+        by_mailing[retry.mailing_id].append(retry)
+    for mailing_retries in by_mailing.values():
+        retry_mailing(mailing_retries[0].mailing, mailing_retries)
+    return len(retries)
@@ -0,0 +1,83 @@
+from django.db import transaction
+from django.db.models import Exists, Min, OuterRef, Q
+from django.utils import timezone
+from mailing.cancellation import clear_cancel, request_cancel
+from mailing.models import MailingModel, MailingJob
+from mailing.services import invalidate_mailing_caches
+from mailing.stats import update_status_stats
+
+
+def get_due_mailings(now=None):
+    '''Рассылки, которые сейчас можно отправлять: активные, не завершённые, в пределах времени рассылки
+    и без невыполненного задания в очереди. Рассылку с заданием в очереди или в работе отправляет
+    обработчик очереди, и отправка её вручную разослала бы письма повторно'''
+    now = now or timezone.now()
+    unfinished_jobs = MailingJob.objects.filter(
+        mailing=OuterRef('pk'), status__in=[MailingJob.QUEUED, MailingJob.RUNNING]
+    )
+    return MailingModel.objects.exclude(status=MailingModel.FINISHED).filter(
+        ~Exists(unfinished_jobs), is_active=True, beginning_sending__lte=now, end_sending__gt=now
+    )
+
+
+def finish_mailings(now=None, mailing_pks=None):
+    '''Завершает одним UPDATE все рассылки (или рассылки из mailing_pks), у которых истекло время окончания
+    или которые отключены, и ставит им флаг отмены, чтобы идущая отправка остановилась. Строки блокируются
+    до конца транзакции, поэтому при одновременном завершении несколькими планировщиками или вручную
+    каждая рассылка учитывается в счётчиках и сбрасывается в кеше один раз. Возвращает число завершённых рассылок'''
+    now = now or timezone.now()
+    with transaction.atomic():
+        finishing = MailingModel.objects.select_for_update().exclude(status=MailingModel.FINISHED).filter(
+            Q(end_sending__lte=now) | Q(is_active=False)
+        )
+        if mailing_pks is not None:
+            finishing = finishing.filter(pk__in=mailing_pks)
+        finished_mailings = list(finishing.values_list('pk', 'owner_id', 'status'))
+        if not finished_mailings:
+            return 0
+        finished_ids = [pk for pk, _, _ in finished_mailings]
+        finished = MailingModel.objects.filter(pk__in=finished_ids).update(status=MailingModel.FINISHED)
+        update_status_stats((owner_id, status, MailingModel.FINISHED) for _, owner_id, status in finished_mailings)
+    request_cancel(*finished_ids)
+    invalidate_mailing_caches((pk, owner_id) for pk, owner_id, _ in finished_mailings)
+    return finished
+
+
+def enqueue_due_mailings(now=None):
+    '''Ставит в очередь рассылки, время начала которых наступило. Планировщик запускает каждую
+    рассылку один раз: рассылки, по которым уже есть задания, пропускаются.
+    Возвращает число поставленных в очередь рассылок'''
+    now = now or timezone.now()
+    with transaction.atomic():
+        # Строки блокируются, поэтому несколько планировщиков не поставят рассылку в очередь дважды
+        due_ids = list(
+            MailingModel.objects.select_for_update(skip_locked=True)
+            .filter(status=MailingModel.CREATED, is_active=True, beginning_sending__lte=now, end_sending__gt=now)
+            .filter(~Exists(MailingJob.objects.filter(mailing=OuterRef('pk'))))
+            .values_list('pk', flat=True)
+        )
+        MailingJob.objects.bulk_create([MailingJob(mailing_id=pk) for pk in due_ids])
+    clear_cancel(*due_ids)
+    return len(due_ids)
+
+
+def get_next_event(now=None):
+    '''Возвращает ближайшее будущее время, когда какую-либо рассылку нужно запустить или завершить,
+    или None, если таких рассылок нет'''
+    now = now or timezone.now()
+    next_start = MailingModel.objects.filter(
+        status=MailingModel.CREATED, is_active=True, beginning_sending__gt=now
+    ).aggregate(value=Min('beginning_sending'))['value']
+    next_end = MailingModel.objects.exclude(status=MailingModel.FINISHED).filter(
+        end_sending__gt=now
+    ).aggregate(value=Min('end_sending'))['value']
+    events = [event for event in (next_start, next_end) if event is not None]
+    return min(events) if events else None
+
+
+def tick(now=None):
+    '''Один шаг планировщика. Возвращает (поставлено в очередь, завершено, время следующего события)'''
+    now = now or timezone.now()
+    finished = finish_mailings(now)
+    enqueued = enqueue_due_mailings(now)
+    return enqueued, finished, get_next_event(now)
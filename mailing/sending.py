@@ -0,0 +1,939 @@
+import asyncio
+import base64
+import queue
+import random
+import re
+import smtplib
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import timedelta
+from itertools import chain, islice
+from email.charset import Charset
+from email.policy import compat32
+from email.utils import formatdate, make_msgid
+from django.conf import settings
+from django.core.mail import BadHeaderError, EmailMessage, get_connection
+from django.core.mail.backends.smtp import EmailBackend as SMTPEmailBackend
+from django.core.mail.message import (
+    RFC5322_EMAIL_LINE_LENGTH_LIMIT, forbid_multi_line_headers, sanitize_address
+)
+from django.core.mail.utils import DNS_NAME
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from mailing.async_smtp import AsyncSMTPClient
+from mailing.cancellation import CancellationCheck
+from mailing.models import MailingModel, MailingAttempt, MailingRetry, MailingDeadLetter, SuppressedAddress
+from mailing.personalization import RECIPIENT_FIELDS, compile_template
+from mailing.metrics import mailing_attempts
+from mailing.progress import ProgressTracker
+from mailing.ratelimit import get_rate_limiter
+from mailing.relays import get_relay_pool
+from mailing.services import invalidate_mailing_caches
+from mailing.stats import add_mailing_stats
+from mailing.suppression import get_suppressed_emails, is_suppressed
+
+
+# Режимы отправки рассылки
+SEND_MODE_SEQUENTIAL = 'sequential'
+SEND_MODE_THREADS = 'threads'
+SEND_MODE_ASYNC = 'async'
+SEND_MODES = (SEND_MODE_SEQUENTIAL, SEND_MODE_THREADS, SEND_MODE_ASYNC)
+
+
+# Ошибки, при которых сервер оборвал соединение и имеет смысл переподключиться
+DISCONNECT_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+# Переводы строк, которые при сериализации письма заменяются на CRLF
+LINE_BREAK_RE = re.compile(r'\r\n|\r|\n')
+
+# Кодирование и перенос заголовков те же, что при сериализации EmailMessage
+UTF8_CHARSET = Charset('utf-8')
+HEADER_POLICY = compat32.clone(linesep='\r\n')
+SUBJECT_MAX_LENGTH = 78 - len('Subject: ')
+
+# Пробельные символы, которые перенос заголовка заменил бы одним пробелом
+WHITESPACE_RUN_RE = re.compile(r'\s\s|\t')
+
+# Наибольшая длина текста в байтах в одном закодированном слове base64 =?utf-8?b?...?=,
+# при которой строка заголовка Subject не длиннее 78 символов
+ENCODED_WORD_MAX_BYTES = 42
+
+# Ответ сервера на RCPT TO сверх допустимого числа получателей в транзакции
+TOO_MANY_RECIPIENTS = 452
+
+# Заголовок To письма, отправленного нескольким получателям одной транзакцией: адреса получателей
+# друг другу не раскрываются
+UNDISCLOSED_RECIPIENTS = b'undisclosed-recipients:;'
+
+# Адрес из одних ASCII-символов без имени, кавычек и пробелов
+SIMPLE_ADDRESS_RE = re.compile(r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~.-]+@[A-Za-z0-9.-]+\Z")
+
+
+def encode_words(text):
+    '''Разбивает текст на закодированные слова base64 (RFC 2047), не разрывая символы UTF-8'''
+    words = []
+    chunk = []
+    size = 0
+    for char in text:
+        char_size = len(char.encode())
+        if size + char_size > ENCODED_WORD_MAX_BYTES:
+            words.append(''.join(chunk))
+            chunk, size = [], 0
+        chunk.append(char)
+        size += char_size
+    words.append(''.join(chunk))
+    return [b'=?utf-8?b?' + base64.b64encode(word.encode()) + b'?=' for word in words]
+
+
+def iter_batches(iterable, size):
+    '''Разбивает итерируемый объект на списки по size элементов, не читая его целиком'''
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def get_domain(email):
+    return email.rpartition('@')[2].lower()
+
+
+def iter_domain_batches(recipients, batch_size, window=None, cancelled=None):
+    '''Разбивает получателей на пачки по batch_size, в каждой пачке получатели одного домена. Поток
+    получателей группируется окнами по window (по умолчанию MAILING_RECIPIENT_CHUNK_SIZE), поэтому
+    целиком в память не читается. cancelled - необязательная функция, которая проверяется перед каждой
+    пачкой: если она вернула True, пачки больше не выдаются'''
+    for chunk in iter_batches(recipients, window or settings.MAILING_RECIPIENT_CHUNK_SIZE):
+        by_domain = defaultdict(list)
+        for recipient in chunk:
+            by_domain[get_domain(recipient[1])].append(recipient)
+        for domain_recipients in by_domain.values():
+            for batch in iter_batches(domain_recipients, batch_size):
+                if cancelled is not None and cancelled():
+                    return
+                yield batch
+
+
+def split_transactions(message, batch):
+    '''Разбивает пачку получателей одного домена на SMTP-транзакции. Одинаковое для всех письмо
+    (без подстановок) отправляется получателям доменов из MAILING_MULTI_RCPT_DOMAINS одной транзакцией
+    с несколькими RCPT TO, до MAILING_MAX_RCPT_PER_TRANSACTION получателей. Остальным письмо уходит
+    отдельной транзакцией'''
+    domains = settings.MAILING_MULTI_RCPT_DOMAINS
+    if message.is_shared and ('*' in domains or get_domain(batch[0][1]) in domains):
+        return list(iter_batches(batch, max(1, settings.MAILING_MAX_RCPT_PER_TRANSACTION)))
+    return [[recipient] for recipient in batch]
+
+
+def split_deferred(message, transaction, refused):
+    '''Разбирает отказы сервера по транзакции. Если сервер принял часть получателей, а остальным ответил
+    452 (слишком много получателей), им письмо нужно отправить следующей транзакцией (RFC 5321, 3.3).
+    Возвращает (получатели для следующей транзакции, окончательные отказы)'''
+    deferred = [
+        recipient for recipient in transaction
+        if refused.get(message.recipient(recipient[1]), (None,))[0] == TOO_MANY_RECIPIENTS
+    ]
+    if not deferred or len(deferred) == len(transaction):
+        return [], refused
+    deferred_addresses = {message.recipient(recipient[1]) for recipient in deferred}
+    return deferred, {address: reply for address, reply in refused.items() if address not in deferred_addresses}
+
+
+def get_transaction_results(message, transaction, refused):
+    '''Результаты транзакции по каждому получателю: refused - отвергнутые сервером адреса
+    {адрес: (код, ответ)}, остальным получателям письмо доставлено'''
+    results = []
+    for recipient in transaction:
+        address = message.recipient(recipient[1])
+        if address in refused:
+            error = smtplib.SMTPRecipientsRefused({address: refused[address]})
+            results.append((recipient, MailingAttempt.NOT_SUCCESSFULL, str(error), error))
+        else:
+            results.append((recipient, MailingAttempt.SUCCESSFULLY, 'Письмо отправлено', None))
+    return results
+
+
+def get_failed_results(transaction, error):
+    '''Результаты транзакции, которую не удалось отправить: письмо не доставлено ни одному получателю'''
+    return [(recipient, MailingAttempt.NOT_SUCCESSFULL, str(error), error) for recipient in transaction]
+
+
+def settle_transaction(message, transaction, refused):
+    '''Разбирает ответ сервера на транзакцию. Возвращает (получатели для следующей транзакции, результаты
+    по остальным получателям транзакции)'''
+    deferred, refused = split_deferred(message, transaction, refused)
+    if deferred:
+        deferred_ids = {recipient[0] for recipient in deferred}
+        transaction = [recipient for recipient in transaction if recipient[0] not in deferred_ids]
+    return deferred, get_transaction_results(message, transaction, refused)
+
+
+class PreparedMessage:
+    '''Письмо рассылки, подготовленное один раз на всю рассылку. Тема и тело компилируются в шаблоны
+    с подстановками полей подписчика, а общие заголовки и не зависящие от получателя тема и тело
+    кодируются и сериализуются при создании. Для каждого получателя подставляются его поля и к готовым байтам
+    добавляются заголовки To, Date и Message-ID'''
+
+    def __init__(self, message, from_email=None):
+        self.subject = compile_template(message.subject)
+        self.body = compile_template(message.body)
+        # Для сборки письма из байтов переводы строк в шаблоне тела заменяются на CRLF заранее
+        self.body_crlf = compile_template(LINE_BREAK_RE.sub('\r\n', message.body))
+        self.from_email = from_email or settings.EMAIL_HOST_USER
+        email_message = EmailMessage(subject=message.subject, body=message.body, from_email=self.from_email)
+        self.encoding = email_message.encoding or settings.DEFAULT_CHARSET
+        self.envelope_from = sanitize_address(self.from_email, self.encoding)
+        # Персонализированные тему и тело можно собрать из байтов только в кодировке UTF-8, в других
+        # кодировках письмо каждого получателя формирует EmailMessage
+        self.is_utf8 = self.encoding.lower().replace('_', '-') in ('utf-8', 'utf8')
+        mime = email_message.message()
+        for header in ('To', 'Date', 'Message-ID'):
+            del mime[header]
+        if not self.body.is_static:
+            del mime['Content-Transfer-Encoding']
+        if not self.subject.is_static:
+            del mime['Subject']
+        self.headers, _, self.content = mime.as_bytes(linesep='\r\n').partition(b'\r\n\r\n')
+        self.date = None
+        self.date_second = None
+
+    @property
+    def is_shared(self):
+        '''Письмо одинаково для всех получателей и может быть отправлено нескольким получателям сразу'''
+        return self.subject.is_static and self.body.is_static
+
+    def get_date(self):
+        # Заголовок Date меняется раз в секунду, форматировать его для каждого письма незачем
+        second = int(time.time())
+        if second != self.date_second:
+            self.date = formatdate(second, localtime=settings.EMAIL_USE_LOCALTIME)
+            self.date_second = second
+        return self.date
+
+    def get_subject(self, recipient):
+        return self.subject.render(recipient)
+
+    def get_body(self, recipient):
+        return self.body.render(recipient)
+
+    def recipient(self, email):
+        '''Адрес получателя для конверта и заголовка To'''
+        if SIMPLE_ADDRESS_RE.match(email):
+            # Обычный ASCII-адрес sanitize_address вернул бы без изменений, а разбор адреса дорогой
+            return email
+        return sanitize_address(email, self.encoding)
+
+    def encode_subject(self, recipient):
+        '''Заголовок Subject для получателя, закодированный так же, как его кодирует EmailMessage'''
+        subject = self.get_subject(recipient)
+        if '\n' in subject or '\r' in subject:
+            raise BadHeaderError(f'Тема письма не может содержать перевод строки: {subject!r}')
+        if subject.isascii():
+            is_simple = subject.strip() == subject and not WHITESPACE_RUN_RE.search(subject)
+            if len(subject) <= SUBJECT_MAX_LENGTH and is_simple:
+                # Короткая тема умещается в одну строку заголовка и не требует переноса
+                return b'\r\nSubject: ' + subject.encode()
+            _, encoded = forbid_multi_line_headers('Subject', subject, self.encoding)
+            return b'\r\n' + HEADER_POLICY.fold_binary('Subject', encoded).rstrip(b'\r\n')
+        if len(subject.encode()) <= SUBJECT_MAX_LENGTH - len('=?utf-8?q??='):
+            # Тема может уместиться в одно закодированное слово: кодировку (base64 или quoted-printable)
+            # выбирает email.charset, как и для EmailMessage
+            encoded = UTF8_CHARSET.header_encode(subject)
+            if len(encoded) <= SUBJECT_MAX_LENGTH:
+                return b'\r\nSubject: ' + encoded.encode()
+        return b'\r\nSubject: ' + b'\r\n '.join(encode_words(subject))
+
+    def encode_body(self, recipient):
+        '''Заголовок Content-Transfer-Encoding и тело письма для получателя, как их кодирует
+        EmailMessage, или None, если тело нужно кодировать в quoted-printable'''
+        if any('\r' in value or '\n' in value for value in recipient[1:]):
+            content = LINE_BREAK_RE.sub('\r\n', self.get_body(recipient)).encode()
+            max_line_length = max(map(len, content.split(b'\r\n')))
+        else:
+            content, max_line_length = self.body_crlf.render_bytes(recipient)
+        if content.isascii():
+            return b'\r\nContent-Transfer-Encoding: 7bit\r\n\r\n' + content
+        if max_line_length > RFC5322_EMAIL_LINE_LENGTH_LIMIT:
+            # Оценка длины строк грубая, поэтому строки проверяются точно
+            if max(map(len, content.split(b'\r\n'))) > RFC5322_EMAIL_LINE_LENGTH_LIMIT:
+                return None
+        return b'\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' + content
+
+    def build_message(self, recipient, connection=None):
+        '''EmailMessage для получателя: для бэкендов почты без SMTP и для редких писем,
+        которые нельзя собрать из готовых байтов'''
+        return EmailMessage(
+            subject=self.get_subject(recipient),
+            body=self.get_body(recipient),
+            from_email=self.from_email,
+            to=[recipient[1]],
+            connection=connection,
+        )
+
+    def render(self, recipient, to=None):
+        '''Байты письма для получателя (ID подписчика, email, Ф.И.О.) в виде, готовом для команды DATA.
+        to - значение заголовка To, по умолчанию адрес получателя'''
+        if not self.is_utf8 and not (self.subject.is_static and self.body.is_static):
+            return self.build_message(recipient).message().as_bytes(linesep='\r\n')
+        if self.body.is_static:
+            body = b'\r\n\r\n' + self.content
+        else:
+            body = self.encode_body(recipient)
+            if body is None:
+                return self.build_message(recipient).message().as_bytes(linesep='\r\n')
+        parts = [self.headers]
+        if not self.subject.is_static:
+            parts.append(self.encode_subject(recipient))
+        parts += [
+            b'\r\nTo: ', to or self.recipient(recipient[1]).encode(),
+            b'\r\nDate: ', self.get_date().encode(),
+            b'\r\nMessage-ID: ', make_msgid(domain=DNS_NAME).encode(),
+            body,
+        ]
+        return b''.join(parts)
+
+
+class MailingSender:
+    '''Последовательно отправляет письма рассылки. С каждым SMTP-сервером пула держится одно соединение:
+    оно открывается при первой транзакции через сервер (TLS и авторизация выполняются однократно)
+    и переоткрывается, только если сервер его оборвал'''
+
+    def __init__(self, batch_size=None, connection=None):
+        self.batch_size = batch_size or settings.MAILING_SEND_BATCH_SIZE
+        self.connection = connection or get_connection(fail_silently=False)
+        # С SMTP-сервером письмо отправляется готовыми байтами, минуя EmailMessage. Остальные
+        # бэкенды (консоль, память, файлы) принимают только EmailMessage
+        self.is_smtp = isinstance(self.connection, SMTPEmailBackend)
+        self.is_open = False
+        self.relay = settings.EMAIL_HOST
+        self.relays = get_relay_pool()
+        # SMTP-соединения по именам серверов пула
+        self.relay_connections = {}
+        self.limiter = get_rate_limiter()
+
+    def __enter__(self):
+        if self.is_smtp:
+            return self
+        try:
+            self.open()
+        except Exception:
+            # Бэкенд недоступен: ошибка будет записана в попытку по каждому получателю
+            pass
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self.connection.open()
+        self.is_open = True
+
+    def close(self):
+        for connection in [self.connection, *self.relay_connections.values()]:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        self.is_open = False
+
+    def get_relay_connection(self, relay):
+        '''Открытое SMTP-соединение (smtplib.SMTP) с сервером relay'''
+        connection = self.relay_connections.get(relay.name)
+        if connection is None:
+            connection = get_connection(fail_silently=False, host=relay.host, port=relay.port)
+            self.relay_connections[relay.name] = connection
+        # Уже открытое соединение не переоткрывается
+        connection.open()
+        return connection.connection
+
+    def close_relay_connection(self, relay):
+        try:
+            self.relay_connections[relay.name].close()
+        except Exception:
+            pass
+
+    def sendmail(self, relay, envelope_from, addresses, data):
+        '''Отправляет письмо через сервер relay. При обрыве соединения переподключается и повторяет отправку
+        один раз'''
+        try:
+            return self.get_relay_connection(relay).sendmail(envelope_from, addresses, data)
+        except DISCONNECT_ERRORS:
+            self.close_relay_connection(relay)
+            return self.get_relay_connection(relay).sendmail(envelope_from, addresses, data)
+
+    def reconnect(self):
+        '''Закрывает оборванное соединение и открывает новое'''
+        self.close()
+        self.open()
+
+    def send_message(self, message):
+        '''Отправляет одно письмо через открытое соединение. При обрыве соединения переподключается
+        и повторяет отправку один раз'''
+        if not self.is_open:
+            self.open()
+        try:
+            self.connection.send_messages([message])
+        except DISCONNECT_ERRORS:
+            self.reconnect()
+            self.connection.send_messages([message])
+
+    def send_transaction(self, prepared, transaction):
+        '''Отправляет подготовленное письмо получателям transaction одной SMTP-транзакцией напрямую
+        через SMTP-соединение с сервером пула. Возвращает отвергнутые сервером адреса {адрес: (код, ответ)}.
+        Если сервер недоступен или ответил временной ошибкой, транзакция повторяется через другой сервер пула'''
+        addresses = [prepared.recipient(recipient[1]) for recipient in transaction]
+        data = prepared.render(transaction[0], to=UNDISCLOSED_RECIPIENTS if len(transaction) > 1 else None)
+        tried = []
+        while True:
+            relay = self.relays.choose(exclude=tried)
+            # Темп отправки ограничивается общими для всех отправщиков лимитами SMTP-сервера и домена.
+            # Получатели транзакции из одного домена: токены на всю транзакцию резервируются одним запросом
+            self.limiter.acquire(relay.name, transaction[0][1], len(transaction))
+            started = time.monotonic()
+            try:
+                refused = self.sendmail(relay, prepared.envelope_from, addresses, data)
+            except smtplib.SMTPRecipientsRefused as e:
+                # Все получатели отвергнуты: результат тот же, что и при частичном отказе
+                self.relays.release(relay, time.monotonic() - started)
+                return e.recipients
+            except Exception as e:
+                failed = is_relay_error(e)
+                self.relays.release(relay, time.monotonic() - started, failed=failed)
+                if not failed:
+                    raise
+                self.close_relay_connection(relay)
+                tried.append(relay)
+                if len(tried) >= len(self.relays):
+                    raise
+                continue
+            self.relays.release(relay, time.monotonic() - started)
+            return refused
+
+    def send_prepared(self, prepared, transaction):
+        '''Отправляет подготовленное письмо получателям transaction и возвращает результат по каждому.
+        Получателям, которых сервер не принял из-за ограничения числа RCPT TO в транзакции, письмо отправляется
+        следующей транзакцией. Если следующая транзакция не удалась, неудачными записываются только её
+        получатели: остальным письмо уже доставлено'''
+        results = []
+        while transaction:
+            try:
+                refused = self.send_transaction(prepared, transaction)
+            except Exception as e:
+                return results + get_failed_results(transaction, e)
+            transaction, done = settle_transaction(prepared, transaction, refused)
+            results += done
+        return results
+
+    def send_batch(self, message, recipients, cancelled=None):
+        '''Отправляет подготовленное письмо (PreparedMessage) пачке получателей одного домена (ID подписчика,
+        email, Ф.И.О.) и возвращает результат по каждому: (получатель, статус, ответ сервера, исключение или None).
+        cancelled проверяется перед каждой транзакцией: после отмены остальным получателям пачки письмо
+        не отправляется и результата по ним нет'''
+        results = []
+        if not self.is_smtp:
+            for recipient, email_message in zip(recipients, build_messages(message, recipients, self.connection)):
+                if cancelled is not None and cancelled():
+                    break
+                self.limiter.acquire(self.relay, recipient[1])
+                try:
+                    self.send_message(email_message)
+                    results.append((recipient, MailingAttempt.SUCCESSFULLY, 'Письмо отправлено', None))
+                except Exception as e:
+                    results.append((recipient, MailingAttempt.NOT_SUCCESSFULL, str(e), e))
+            return results
+
+        for transaction in split_transactions(message, recipients):
+            if cancelled is not None and cancelled():
+                break
+            results += self.send_prepared(message, transaction)
+        return results
+
+    def send(self, message, recipients, cancelled=None):
+        '''Отправляет письмо всем получателям пачками по batch_size, сгруппированными по домену, и по мере
+        отправки отдаёт результаты. recipients - любой итерируемый объект, получатели читаются по мере отправки.
+        Если cancelled вернула True, следующие транзакции не отправляются'''
+        for batch in iter_domain_batches(recipients, self.batch_size, cancelled=cancelled):
+            yield from self.send_batch(message, batch, cancelled)
+
+
+class ConcurrentMailingSender:
+    '''Отправляет письма рассылки из пула потоков. Каждый поток владеет собственным SMTP-соединением
+    (MailingSender), получатели раздаются потокам пачками по batch_size из получателей одного домена,
+    а результаты собираются обратно в вызывающий поток по мере готовности пачек'''
+
+    def __init__(self, workers=None, batch_size=None):
+        self.workers = workers or settings.MAILING_SEND_WORKERS
+        self.batch_size = batch_size or settings.MAILING_SEND_BATCH_SIZE
+        self.local = threading.local()
+        self.senders = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for sender in self.senders:
+            sender.close()
+        self.senders = []
+
+    def get_sender(self):
+        '''Возвращает соединение текущего потока, при первом обращении открывает его'''
+        sender = getattr(self.local, 'sender', None)
+        if sender is None:
+            sender = MailingSender(batch_size=self.batch_size).__enter__()
+            self.local.sender = sender
+            with self.lock:
+                self.senders.append(sender)
+        return sender
+
+    def send_batch(self, message, recipients, cancelled=None):
+        return self.get_sender().send_batch(message, recipients, cancelled)
+
+    def send(self, message, recipients, cancelled=None):
+        '''Раздаёт получателей потокам и по мере отправки отдаёт результаты. Получатели читаются
+        в вызывающем потоке, и в работе одновременно не больше двух пачек на поток, поэтому
+        память не растёт с числом получателей. Потоки проверяют cancelled перед каждой транзакцией:
+        после отмены каждый заканчивает только начатую транзакцию'''
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mailing-sender') as executor:
+            futures = set()
+            for batch in iter_domain_batches(recipients, self.batch_size, cancelled=cancelled):
+                if len(futures) >= self.workers * 2:
+                    done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+                futures.add(executor.submit(self.send_batch, message, batch, cancelled))
+            for future in as_completed(futures):
+                yield from future.result()
+
+
+class AsyncMailingSender:
+    '''Отправляет письма рассылки через asyncio: в одном потоке держит до connections обработчиков
+    с SMTP-сессиями, без отдельного потока на каждое соединение. Цикл событий работает в фоновом потоке.
+    Получатели читаются в вызывающем потоке и передаются сессиям через ограниченную очередь, а результаты
+    по мере отправки возвращаются в вызывающий поток через другую очередь'''
+
+    def __init__(self, connections=None, batch_size=None):
+        self.connections = connections or settings.MAILING_ASYNC_CONNECTIONS
+        self.batch_size = batch_size or settings.MAILING_SEND_BATCH_SIZE
+        self.limiter = get_rate_limiter()
+        self.relays = get_relay_pool()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def make_client(self, relay):
+        return AsyncSMTPClient(
+            host=relay.host,
+            port=relay.port,
+            username=settings.EMAIL_HOST_USER,
+            password=settings.EMAIL_HOST_PASSWORD,
+            use_tls=settings.EMAIL_USE_TLS,
+            use_ssl=settings.EMAIL_USE_SSL,
+            timeout=settings.EMAIL_TIMEOUT,
+        )
+
+    async def sendmail(self, client, envelope_from, addresses, data):
+        '''Отправляет письмо через сессию client. При обрыве соединения переподключается и повторяет
+        отправку один раз'''
+        if not client.is_connected:
+            await client.connect()
+        try:
+            return await client.sendmail(envelope_from, addresses, data)
+        except DISCONNECT_ERRORS:
+            await client.close()
+            await client.connect()
+            return await client.sendmail(envelope_from, addresses, data)
+
+    async def deliver_transaction(self, clients, prepared, transaction):
+        '''Отправляет письмо получателям transaction одной SMTP-транзакцией через сервер пула и возвращает
+        отвергнутые сервером адреса {адрес: (код, ответ)}. Если сервер недоступен или ответил временной
+        ошибкой, транзакция повторяется через другой сервер пула. clients - сессии по именам серверов'''
+        addresses = [prepared.recipient(recipient[1]) for recipient in transaction]
+        data = prepared.render(transaction[0], to=UNDISCLOSED_RECIPIENTS if len(transaction) > 1 else None)
+        tried = []
+        while True:
+            relay = self.relays.choose(exclude=tried)
+            client = clients.get(relay.name)
+            if client is None:
+                client = clients[relay.name] = self.make_client(relay)
+            # Резервирование в Redis - блокирующий запрос: он выполняется в потоке, а не в цикле событий,
+            # чтобы не останавливать остальные SMTP-сессии. Токены на всю транзакцию - одним запросом
+            if self.limiter.client is None:
+                delay = self.limiter.reserve(relay.name, transaction[0][1], len(transaction))
+            else:
+                delay = await asyncio.to_thread(self.limiter.reserve, relay.name, transaction[0][1], len(transaction))
+            if delay:
+                await asyncio.sleep(delay)
+            started = time.monotonic()
+            try:
+                refused = await self.sendmail(client, prepared.envelope_from, addresses, data)
+            except smtplib.SMTPRecipientsRefused as e:
+                self.relays.release(relay, time.monotonic() - started)
+                return e.recipients
+            except Exception as e:
+                failed = is_relay_error(e)
+                self.relays.release(relay, time.monotonic() - started, failed=failed)
+                if not failed:
+                    raise
+                await client.close()
+                tried.append(relay)
+                if len(tried) >= len(self.relays):
+                    raise
+                continue
+            self.relays.release(relay, time.monotonic() - started)
+            return refused
+
+    async def deliver(self, clients, prepared, transaction):
+        '''Отправляет письмо получателям transaction, при ограничении числа RCPT TO - несколькими
+        транзакциями, и возвращает результат по каждому получателю. Если следующая транзакция не удалась,
+        неудачными записываются только её получатели'''
+        results = []
+        while transaction:
+            try:
+                refused = await self.deliver_transaction(clients, prepared, transaction)
+            except Exception as e:
+                return results + get_failed_results(transaction, e)
+            transaction, done = settle_transaction(prepared, transaction, refused)
+            results += done
+        return results
+
+    async def session(self, message, pending, put, cancelled=None):
+        '''Один обработчик: забирает транзакции из общей очереди до метки конца (None) и держит
+        по одной SMTP-сессии с каждым сервером пула, через который отправлял. После отмены (cancelled
+        вернула True) транзакции из очереди забираются без отправки'''
+        clients = {}
+        try:
+            while (transaction := await pending.get()) is not None:
+                if cancelled is not None and cancelled():
+                    continue
+                for result in await self.deliver(clients, message, transaction):
+                    put(result)
+        finally:
+            for client in clients.values():
+                await client.quit()
+
+    async def feed(self, message, batch, pending, sessions, put, cancelled=None):
+        '''Передаёт сессиям пачку получателей одного домена, разбитую на транзакции. Сессии открываются
+        по мере поступления транзакций, но не больше connections. Пока очередь заполнена, передача ждёт'''
+        for transaction in split_transactions(message, batch):
+            if len(sessions) < self.connections:
+                sessions.append(asyncio.create_task(self.session(message, pending, put, cancelled)))
+            await pending.put(transaction)
+
+    async def finish(self, pending, sessions):
+        '''Сообщает сессиям, что получателей больше нет, и ждёт окончания отправки'''
+        for _ in sessions:
+            await pending.put(None)
+        await asyncio.gather(*sessions)
+
+    async def cancel(self, sessions):
+        for task in sessions:
+            task.cancel()
+        await asyncio.gather(*sessions, return_exceptions=True)
+
+    def send(self, message, recipients, cancelled=None):
+        '''Запускает цикл событий в фоновом потоке, передаёт ему получателей пачками по batch_size,
+        сгруппированными по домену, и по мере отправки отдаёт результаты. Сессии проверяют cancelled
+        перед каждой транзакцией: после отмены каждая заканчивает только начатую транзакцию'''
+        results = queue.SimpleQueue()
+        pending = asyncio.Queue(maxsize=self.connections * 2)
+        sessions = []
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name='mailing-async-sender')
+        thread.start()
+
+        def call(coroutine):
+            return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+        def drain():
+            while True:
+                try:
+                    yield results.get_nowait()
+                except queue.Empty:
+                    return
+
+        finished = False
+        try:
+            for batch in iter_domain_batches(recipients, self.batch_size, cancelled=cancelled):
+                call(self.feed(message, batch, pending, sessions, results.put, cancelled))
+                yield from drain()
+            call(self.finish(pending, sessions))
+            finished = True
+            yield from drain()
+        finally:
+            if not finished:
+                call(self.cancel(sessions))
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+def get_sender(mode=None, workers=None, batch_size=None):
+    '''Возвращает отправщик для режима mode (по умолчанию MAILING_SEND_MODE): последовательный,
+    пул потоков или asyncio'''
+    mode = mode or settings.MAILING_SEND_MODE
+    workers = workers or settings.MAILING_SEND_WORKERS
+    if mode == SEND_MODE_ASYNC:
+        return AsyncMailingSender(batch_size=batch_size)
+    if mode == SEND_MODE_THREADS and workers > 1:
+        return ConcurrentMailingSender(workers=workers, batch_size=batch_size)
+    return MailingSender(batch_size=batch_size)
+
+
+def build_messages(message, recipients, connection=None):
+    '''Формирует письма рассылки, по одному на каждого получателя. Нужны только для бэкендов почты
+    без SMTP: по SMTP отправляется PreparedMessage'''
+    return [message.build_message(recipient, connection=connection) for recipient in recipients]
+
+
+def is_transient_error(error):
+    '''Временная ли ошибка отправки: коды 4xx, обрыв соединения и таймауты - временные,
+    коды 5xx и прочие ошибки - постоянные'''
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    return isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError))
+
+
+def is_relay_error(error):
+    '''Ошибка ли это SMTP-сервера, а не письма или получателя: сервер недоступен, оборвал соединение,
+    не принял авторизацию или ответил временной ошибкой (4xx). Постоянный отказ (5xx) относится к письму
+    или получателю: повтор через другой сервер его не исправит и не должен портить оценку серверов.
+    Исключения smtplib - подклассы OSError, поэтому сетевые ошибки проверяются после них'''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPAuthenticationError)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    return isinstance(error, OSError)
+
+
+def is_hard_bounce(error):
+    '''Отверг ли сервер получателя адрес навсегда (код 5xx на RCPT TO): такой адрес не принимает почту
+    и не должен получать следующие рассылки'''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+    return False
+
+
+def get_retry_delay(attempts):
+    '''Задержка перед повторной отправкой после attempts неудачных попыток: экспоненциальный рост
+    от MAILING_RETRY_BASE_DELAY до MAILING_RETRY_MAX_DELAY со случайным разбросом +-50%, чтобы
+    повторы не приходили на сервер одной волной'''
+    delay = min(settings.MAILING_RETRY_MAX_DELAY, settings.MAILING_RETRY_BASE_DELAY * 2 ** (attempts - 1))
+    return timedelta(seconds=delay * random.uniform(0.5, 1.5))
+
+
+class AttemptRecorder:
+    '''Накапливает попытки рассылки в памяти и записывает их в БД пачками по chunk_size через
+    bulk_create, вместо отдельного INSERT на каждого получателя. Каждая записанная пачка служит
+    контрольной точкой: при повторном запуске рассылки получатели с успешной попыткой пропускаются.
+    Получатели с временной ошибкой ставятся в очередь повторных отправок, с постоянной -
+    записываются в недоставленные письма (если queue_failures не отключён). Адреса, которые сервер
+    получателя отверг навсегда, попадают в список подавления владельца рассылки'''
+
+    def __init__(self, mailing, chunk_size=None, queue_failures=True):
+        self.mailing = mailing
+        self.chunk_size = chunk_size or settings.MAILING_ATTEMPT_CHUNK_SIZE
+        self.queue_failures = queue_failures
+        self.attempts = []
+        self.retries = []
+        self.dead_letters = []
+        self.suppressed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Уже отправленные письма записываются даже при ошибке посреди рассылки
+        self.flush()
+
+    def add(self, recipient, status_mailing_attempt, server_mail_response, error=None):
+        subscriber_id, email = recipient[:2]
+        now = timezone.now()
+        self.attempts.append(MailingAttempt(
+            date_and_time=now,
+            status=status_mailing_attempt,
+            server_mail_response=server_mail_response,
+            mailing=self.mailing,
+            subscriber_id=subscriber_id,
+        ))
+        if error is not None and is_hard_bounce(error):
+            self.suppressed.append(SuppressedAddress(
+                email=email.lower(),
+                owner_id=self.mailing.owner_id,
+                reason=SuppressedAddress.HARD_BOUNCE,
+                comment=server_mail_response,
+            ))
+        if error is not None and self.queue_failures:
+            if is_transient_error(error):
+                self.retries.append(MailingRetry(
+                    mailing=self.mailing,
+                    subscriber_id=subscriber_id,
+                    next_attempt_at=now + get_retry_delay(1),
+                    last_error=server_mail_response,
+                ))
+            else:
+                self.dead_letters.append(MailingDeadLetter(
+                    mailing=self.mailing,
+                    subscriber_id=subscriber_id,
+                    email=email,
+                    last_error=server_mail_response,
+                ))
+        if len(self.attempts) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.attempts:
+            MailingAttempt.objects.bulk_create(self.attempts)
+            statuses = defaultdict(int)
+            for attempt in self.attempts:
+                statuses[attempt.status] += 1
+            for status, count in statuses.items():
+                mailing_attempts.inc(status, amount=count)
+            self.attempts = []
+        if self.retries:
+            # Если получатель уже ждёт повторной отправки, вторая запись не нужна
+            MailingRetry.objects.bulk_create(self.retries, ignore_conflicts=True)
+            self.retries = []
+        if self.dead_letters:
+            MailingDeadLetter.objects.bulk_create(self.dead_letters)
+            self.dead_letters = []
+        if self.suppressed:
+            SuppressedAddress.objects.bulk_create(self.suppressed, ignore_conflicts=True)
+            self.suppressed = []
+
+
+def get_pending_recipients(mailing):
+    '''Получатели рассылки (ID подписчика, email, Ф.И.О.), которым письмо ещё не доставлено. Доставленные
+    отсекаются анти-соединением NOT EXISTS по индексу (mailing, subscriber, status) попыток рассылки,
+    поэтому повторный запуск после сбоя обрабатывает только оставшихся получателей'''
+    delivered = MailingAttempt.objects.filter(
+        mailing=mailing, subscriber=OuterRef('pk'), status=MailingAttempt.SUCCESSFULLY
+    )
+    return mailing.subscriber.filter(~Exists(delivered)).values_list(*RECIPIENT_FIELDS)
+
+
+def record_cancelled(mailing, since, suppressed=frozenset(), chunk_size=None):
+    '''Записывает попытку со статусом "Отменено" каждому получателю, которому отменённый запуск рассылки
+    (начатый в since) не успел отправить письмо. Получатели читаются из БД частями, попытки создаются
+    пачками по chunk_size через bulk_create. Адреса из списка подавления пропускаются.
+    Возвращает число отменённых писем'''
+    chunk_size = chunk_size or settings.MAILING_ATTEMPT_CHUNK_SIZE
+    attempted = MailingAttempt.objects.filter(mailing=mailing, subscriber=OuterRef('pk'), date_and_time__gte=since)
+    recipients = (
+        get_pending_recipients(mailing).filter(~Exists(attempted))
+        .iterator(chunk_size=settings.MAILING_RECIPIENT_CHUNK_SIZE)
+    )
+    now = timezone.now()
+    cancelled = 0
+    for batch in iter_batches(recipients, chunk_size):
+        attempts = [
+            MailingAttempt(
+                date_and_time=now,
+                status=MailingAttempt.CANCELLED,
+                server_mail_response='Отправка рассылки отменена',
+                mailing=mailing,
+                subscriber_id=subscriber_id,
+            )
+            for subscriber_id, email, *_ in batch
+            if not (suppressed and is_suppressed(email, suppressed))
+        ]
+        MailingAttempt.objects.bulk_create(attempts)
+        cancelled += len(attempts)
+    if cancelled:
+        mailing_attempts.inc(MailingAttempt.CANCELLED, amount=cancelled)
+    return cancelled
+
+
+def mark_started(mailing):
+    '''Переводит рассылку в статус "Запущена" одним условным UPDATE (без сохранения всей строки)'''
+    updated = MailingModel.objects.filter(pk=mailing.pk).exclude(status=MailingModel.STARTED).update(
+        status=MailingModel.STARTED
+    )
+    mailing.status = MailingModel.STARTED
+    if updated:
+        invalidate_mailing_caches([(mailing.pk, mailing.owner_id)])
+        add_mailing_stats(mailing.owner_id, active=1)
+
+
+def send_mailing(mailing, on_result=None, mode=None, workers=None, queued_at=None):
+    '''Отправляет рассылку всем получателям, которым она ещё не доставлена, и записывает попытку
+    рассылки по каждому получателю. Адреса из списка подавления отсеиваются до отправки. Ход отправки
+    передаётся в счётчики прогресса рассылки (mailing.progress). Если отправка отменена (флаг отмены
+    mailing.cancellation), новые транзакции не отправляются, а оставшимся получателям записывается попытка
+    со статусом "Отменено".
+    Возвращает число отправленных, не отправленных и отсеянных писем.
+    on_result - необязательная функция, вызываемая после отправки каждого письма с аргументами
+    (email, статус, ответ сервера),
+    mode - режим отправки (по умолчанию MAILING_SEND_MODE),
+    workers - число потоков отправки (по умолчанию MAILING_SEND_WORKERS),
+    queued_at - время постановки задания в очередь: отмена, запрошенная раньше, не учитывается
+    (по умолчанию - время запуска отправки)'''
+    # Получатели читаются из БД частями по MAILING_RECIPIENT_CHUNK_SIZE по мере отправки: отправка
+    # начинается сразу, а память не зависит от числа получателей
+    run_started = timezone.now()
+    pending = get_pending_recipients(mailing)
+    progress = ProgressTracker(mailing.pk, pending.count())
+    # Флаг отмены проверяется перед каждой транзакцией, не чаще раза в MAILING_CANCEL_CHECK_INTERVAL секунд
+    cancelled = CancellationCheck(mailing.pk, since=(queued_at or run_started).timestamp())
+    recipients = pending.iterator(chunk_size=settings.MAILING_RECIPIENT_CHUNK_SIZE)
+    sent = failed = suppressed_count = 0
+
+    # Список подавления загружается один раз за запуск, получатели проверяются по множеству в памяти
+    suppressed = get_suppressed_emails(mailing.owner_id)
+    if suppressed:
+        def allowed(recipients):
+            nonlocal suppressed_count
+            for recipient in recipients:
+                if is_suppressed(recipient[1], suppressed):
+                    suppressed_count += 1
+                else:
+                    yield recipient
+
+        recipients = allowed(recipients)
+
+    try:
+        # Если отправлять некому, SMTP-соединение не открывается
+        first = next(recipients, None)
+        if first is None:
+            progress.finish(sent, failed, suppressed_count)
+            return sent, failed, suppressed_count
+        recipients = chain([first], recipients)
+
+        # Письмо загружается и кодируется один раз в вызывающем потоке: потоки отправки не обращаются к БД
+        message = PreparedMessage(mailing.message)
+        started = False
+        with get_sender(mode=mode, workers=workers) as sender, AttemptRecorder(mailing) as recorder:
+            results = sender.send(message, recipients, cancelled=cancelled)
+            for recipient, status_mailing_attempt, server_mail_response, error in results:
+                if status_mailing_attempt == MailingAttempt.SUCCESSFULLY:
+                    sent += 1
+                    # Статус меняется один раз за запуск, при первом успешно отправленном письме
+                    if not started:
+                        mark_started(mailing)
+                        started = True
+                else:
+                    failed += 1
+
+                recorder.add(recipient, status_mailing_attempt, server_mail_response, error)
+                progress.update(sent, failed, suppressed_count)
+                if on_result is not None:
+                    on_result(recipient[1], status_mailing_attempt, server_mail_response)
+        if cancelled.cancelled:
+            # Попытки этого запуска уже записаны: отменёнными помечаются только оставшиеся получатели
+            cancelled_count = record_cancelled(mailing, run_started, suppressed)
+            progress.finish(sent, failed, suppressed_count, cancelled=cancelled_count)
+            return sent, failed, suppressed_count
+    except Exception as e:
+        progress.finish(sent, failed, suppressed_count, error=e)
+        raise
+    progress.finish(sent, failed, suppressed_count)
+    return sent, failed, suppressed_count
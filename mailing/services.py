@@ -1,106 +1,184 @@
+import time
 from config.settings import CACHE_ENABLED
+from django.conf import settings
 from django.core.cache import cache
-from django.contrib.auth.models import Group
+from mailing.detail_cache import delete_states
 from mailing.models import Subscriber, Message, MailingModel
+from users.access import user_in_group
 
+# Списки объектов, которые кешируются: имя списка и право на просмотр всех объектов
+LIST_SUBSCRIBERS = 'subscriber'
+LIST_MESSAGES = 'message'
+LIST_MAILINGS = 'mailing'
 
-def get_subscriber_list_from_cache(user):
-    '''Получает список получателей рассылки из кеша. Если кеш пуст, то получает данные из БД'''
+LIST_VIEW_PERMISSIONS = {
+    LIST_SUBSCRIBERS: 'mailing.view_subscriber',
+    LIST_MESSAGES: 'mailing.view_message',
+    LIST_MAILINGS: 'mailing.view_mailingmodel',
+}
 
-    def get_subscriber_list():
-        try:
-            # Получаем группу Owners
-            owners_group = Group.objects.get(name='Owners')
-            # Проверяем, состоит ли пользователь в группе Owners
-            if owners_group in user.groups.all():
-                # Если пользователь в группе Owners, возвращаем только его подписчиков
-                return Subscriber.objects.filter(owner=user)
-            # Если пользователь не в группе Owners, проверяем наличие права на просмотр всех подписчиков
-            elif user.has_perm('mailing.view_subscriber'):
-                # Если у пользователя есть разрешение, возвращаем всех подписчиков
-                return Subscriber.objects.all()
-        except Group.DoesNotExist:
-            # Если группа Owners не найдена, возвращаем пустой список
-            return Subscriber.objects.none()
-        # Если пользователь не попадает ни в одну категорию, возвращаем пустой список
-        return Subscriber.objects.none()
+# Область списка: все объекты (для пользователей с правом просмотра) или объекты одного владельца
+SCOPE_ALL = 'all'
 
-    if not CACHE_ENABLED:
-        return get_subscriber_list()
 
-    # Получаем данные из кеша. Если кеш пуст, то получает данные из БД
-    cache_key = f'subscriber_list_{user}'
-    subscriber_list = cache.get(cache_key)
-    if subscriber_list is not None:
-        return subscriber_list
-    subscriber_list = get_subscriber_list()
-    cache.set(cache_key, subscriber_list, 20)
-    return subscriber_list
+def get_list_scope(user, name):
+    '''Какие объекты списка name видит пользователь: владелец из группы Owners - только свои (ID владельца),
+    пользователь с правом просмотра - все (SCOPE_ALL), остальные - никакие (None)'''
+    if user_in_group(user, 'Owners'):
+        return user.pk
+    if user.has_perm(LIST_VIEW_PERMISSIONS[name]):
+        return SCOPE_ALL
+    return None
 
 
-def get_message_list_from_cache(user):
-    '''Получает список сообщений из кеша. Если кеш пуст, то получает данные из БД'''
+def get_list_version_key(name, scope):
+    return f'list_version:{name}:{scope}'
+
+
+def get_list_version(name, scope):
+    '''Номер версии списка name в области scope. Номер меняется при каждом изменении объектов области,
+    поэтому записи кеша старых версий больше не читаются'''
+    key = get_list_version_key(name, scope)
+    version = cache.get(key)
+    if version is None:
+        # Начальный номер - время в микросекундах: если счётчик вытеснен из кеша, номера не повторяются
+        cache.add(key, time.time_ns() // 1000, None)
+        version = cache.get(key)
+    return version
+
 
-    def get_message_list():
+def bump_list_versions(name, *owner_ids):
+    '''Меняет версии списка name: общего (SCOPE_ALL) и владельцев owner_ids'''
+    scopes = [SCOPE_ALL] + [owner_id for owner_id in set(owner_ids) if owner_id is not None]
+    for scope in scopes:
+        key = get_list_version_key(name, scope)
         try:
-            # Получаем группу Owners
-            owners_group = Group.objects.get(name='Owners')
-            # Проверяем, состоит ли пользователь в группе Owners
-            if owners_group in user.groups.all():
-                # Если пользователь в группе Owners, возвращаем только его сообщения
-                return Message.objects.filter(owner=user)
-            # Если пользователь не в группе Owners, проверяем наличие права на просмотр всех сообщений
-            elif user.has_perm('mailing.view_message'):
-                # Если у пользователя есть разрешение, возвращаем все сообщения
-                return Message.objects.all()
-        except Group.DoesNotExist:
-            # Если группа Owners не найдена, возвращаем пустой список
-            return Message.objects.none()
-        # Если пользователь не попадает ни в одну категорию, возвращаем пустой список
-        return Message.objects.none()
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns() // 1000, None)
+
+
+def get_subscriber_rows(queryset):
+    return [
+        {'pk': pk, 'full_name': full_name, 'email': email, 'comment': comment}
+        for pk, full_name, email, comment in queryset.values_list('pk', 'full_name', 'email', 'comment')
+    ]
+
+
+def get_message_rows(queryset):
+    return [
+        {'pk': pk, 'subject': subject, 'body': body}
+        for pk, subject, body in queryset.values_list('pk', 'subject', 'body')
+    ]
+
+
+def get_mailing_rows(queryset):
+    '''Строки списка рассылок с темой письма и получателями: два запроса вместо запроса на каждую рассылку'''
+    rows = [
+        {
+            'pk': pk, 'id': pk, 'beginning_sending': beginning_sending, 'end_sending': end_sending,
+            'status': status, 'message': subject, 'subscribers': [],
+        }
+        for pk, beginning_sending, end_sending, status, subject in queryset.values_list(
+            'pk', 'beginning_sending', 'end_sending', 'status', 'message__subject'
+        )
+    ]
+    by_pk = {row['pk']: row for row in rows}
+    recipients = MailingModel.subscriber.through.objects.filter(mailingmodel_id__in=by_pk).values_list(
+        'mailingmodel_id', 'subscriber__full_name', 'subscriber__email'
+    )
+    for mailing_pk, full_name, email in recipients.order_by('pk'):
+        by_pk[mailing_pk]['subscribers'].append(f'{full_name} <{email}>')
+    return rows
+
+
+LIST_SOURCES = {
+    LIST_SUBSCRIBERS: (Subscriber, get_subscriber_rows),
+    LIST_MESSAGES: (Message, get_message_rows),
+    LIST_MAILINGS: (MailingModel, get_mailing_rows),
+}
+
 
+def get_list_from_cache(user, name):
+    '''Строки списка name, которые видит пользователь. Строки хранятся в кеше готовыми (словари полей,
+    а не QuerySet) под ключом области списка и её версии: владельцы из группы Owners - по ID пользователя,
+    пользователи с правом просмотра всех объектов - под общим ключом. Изменение объекта меняет версию
+    области (сигналы post_save, post_delete), поэтому записи хранятся LIST_CACHE_TTL секунд без
+    показа устаревших данных'''
+    scope = get_list_scope(user, name)
+    if scope is None:
+        return []
+    model, get_rows = LIST_SOURCES[name]
+    queryset = model.objects.all() if scope == SCOPE_ALL else model.objects.filter(owner_id=scope)
     if not CACHE_ENABLED:
-        return get_message_list()
+        return get_rows(queryset)
 
-    # Получаем данные из кеша. Если кеш пуст, то получает данные из БД
-    cache_key = f'message_list_{user}'
-    message_list = cache.get(cache_key)
-    if message_list is not None:
-        return message_list
-    message_list = get_message_list()
-    cache.set(cache_key, message_list, 20)
-    return message_list
+    cache_key = f'{name}_list:{scope}:{get_list_version(name, scope)}'
+    rows = cache.get(cache_key)
+    if rows is None:
+        rows = get_rows(queryset)
+        cache.set(cache_key, rows, settings.LIST_CACHE_TTL)
+    return rows
+
+
+def get_subscriber_list_from_cache(user):
+    '''Получает список получателей рассылки из кеша. Если кеш пуст, то получает данные из БД'''
+    return get_list_from_cache(user, LIST_SUBSCRIBERS)
+
+
+def get_message_list_from_cache(user):
+    '''Получает список сообщений из кеша. Если кеш пуст, то получает данные из БД'''
+    return get_list_from_cache(user, LIST_MESSAGES)
 
 
 def get_mailing_list_from_cache(user):
     '''Получает список рассылок из кеша. Если кеш пуст, то получает данные из БД'''
+    return get_list_from_cache(user, LIST_MAILINGS)
 
-    def get_mailing_list():
-        try:
-            # Получаем группу Owners
-            owners_group = Group.objects.get(name='Owners')
-            # Проверяем, состоит ли пользователь в группе Owners
-            if owners_group in user.groups.all():
-                # Если пользователь в группе Owners, возвращаем только его рассылки
-                return MailingModel.objects.filter(owner=user)
-            # Если пользователь не в группе Owners, проверяем наличие права на просмотр всех рассылок
-            elif user.has_perm('mailing.view_mailingmodel'):
-                # Если у пользователя есть разрешение, возвращаем все рассылки
-                return MailingModel.objects.all()
-        except Group.DoesNotExist:
-            # Если группа Owners не найдена, возвращаем пустой список
-            return MailingModel.objects.none()
-        # Если пользователь не попадает ни в одну категорию, возвращаем пустой список
-        return MailingModel.objects.none()
 
-    if not CACHE_ENABLED:
-        return get_mailing_list()
-
-    # Получаем данные из кеша. Если кеш пуст, то получает данные из БД
-    cache_key = f'message_list_{user}'
-    mailing_list = cache.get(cache_key)
-    if mailing_list is not None:
-        return mailing_list
-    mailing_list = get_mailing_list()
-    cache.set(cache_key, mailing_list, 20)
-    return mailing_list
+def invalidate_mailing_caches(mailings):
+    '''Сбрасывает списки и карточки рассылок, изменённых запросом UPDATE без сигналов post_save.
+    mailings - пары (ID рассылки, ID владельца)'''
+    mailings = list(mailings)
+    for owner_id in {owner_id for _, owner_id in mailings}:
+        bump_list_versions(LIST_MAILINGS, owner_id)
+    delete_states('mailing', [pk for pk, _ in mailings])
+
+
+# Действия m2m_changed, после которых связи рассылок с получателями уже изменены
+M2M_CHANGED_ACTIONS = ('post_add', 'post_remove', 'post_clear')
+
+
+def get_mailing_owner_ids(instance):
+    '''Владельцы рассылок, в строках списка которых показан получатель или тема сообщения instance'''
+    if isinstance(instance, Subscriber):
+        mailings = MailingModel.objects.filter(subscriber=instance)
+    else:
+        mailings = MailingModel.objects.filter(message=instance)
+    return set(mailings.order_by().values_list('owner_id', flat=True).distinct())
+
+
+def remember_list_owners(sender, instance, **kwargs):
+    '''Сигнал pre_delete получателя: после удаления его связи с рассылками уже удалены, поэтому владельцы
+    рассылок, списки которых нужно сбросить, запоминаются заранее'''
+    instance._list_mailing_owner_ids = get_mailing_owner_ids(instance)
+
+
+def invalidate_list_cache(sender, instance, action=None, reverse=False, pk_set=None, **kwargs):
+    '''Сигналы post_save и post_delete получателей, сообщений и рассылок, m2m_changed получателей
+    рассылки: меняет версии списков владельца объекта и общего списка. Получатели и темы сообщений
+    показаны в строках списка рассылок, поэтому меняются и версии списков владельцев рассылок с ними'''
+    if action is not None and action not in M2M_CHANGED_ACTIONS:
+        return
+    if isinstance(instance, (Subscriber, Message)):
+        owner_ids = getattr(instance, '_list_mailing_owner_ids', None)
+        if owner_ids is None:
+            owner_ids = get_mailing_owner_ids(instance)
+        if reverse and pk_set:
+            # Рассылки, из которых получатель только что удалён
+            owner_ids |= set(MailingModel.objects.filter(pk__in=pk_set).values_list('owner_id', flat=True))
+        name = LIST_SUBSCRIBERS if isinstance(instance, Subscriber) else LIST_MESSAGES
+        bump_list_versions(name, instance.owner_id)
+        bump_list_versions(LIST_MAILINGS, instance.owner_id, *owner_ids)
+    elif isinstance(instance, MailingModel):
+        bump_list_versions(LIST_MAILINGS, instance.owner_id)
@@ -0,0 +1,47 @@
+import smtplib
+from django.core.mail.backends.smtp import EmailBackend as DjangoEmailBackend
+from mailing.metrics import smtp_command_seconds
+
+
+class TimedSMTPMixin:
+    '''Замеряет для метрик время установки соединения, STARTTLS, авторизации и команд транзакции'''
+
+    def connect(self, *args, **kwargs):
+        with smtp_command_seconds.time('connect'):
+            return super().connect(*args, **kwargs)
+
+    def starttls(self, *args, **kwargs):
+        with smtp_command_seconds.time('starttls'):
+            return super().starttls(*args, **kwargs)
+
+    def login(self, *args, **kwargs):
+        with smtp_command_seconds.time('auth'):
+            return super().login(*args, **kwargs)
+
+    def mail(self, *args, **kwargs):
+        with smtp_command_seconds.time('mail'):
+            return super().mail(*args, **kwargs)
+
+    def rcpt(self, *args, **kwargs):
+        with smtp_command_seconds.time('rcpt'):
+            return super().rcpt(*args, **kwargs)
+
+    def data(self, *args, **kwargs):
+        with smtp_command_seconds.time('data'):
+            return super().data(*args, **kwargs)
+
+
+class TimedSMTP(TimedSMTPMixin, smtplib.SMTP):
+    pass
+
+
+class TimedSMTP_SSL(TimedSMTPMixin, smtplib.SMTP_SSL):
+    pass
+
+
+class EmailBackend(DjangoEmailBackend):
+    '''SMTP-бэкенд Django, который передаёт время SMTP-команд в метрики (mailing.metrics)'''
+
+    @property
+    def connection_class(self):
+        return TimedSMTP_SSL if self.use_ssl else TimedSMTP
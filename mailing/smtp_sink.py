@@ -0,0 +1,173 @@
+import asyncio
+import random
+import threading
+import time
+from collections import Counter
+
+
+SINK_COMMANDS = ('MAIL', 'RCPT', 'DATA')
+
+
+def parse_command_values(values):
+    '''Разбирает значения параметров вида КОМАНДА=ЧИСЛО (например, RCPT=0.002) в словарь'''
+    result = {}
+    for value in values or ():
+        verb, _, number = value.partition('=')
+        verb = verb.strip().upper()
+        if verb not in SINK_COMMANDS:
+            raise ValueError(f'Неизвестная команда {verb!r}, допустимы: {", ".join(SINK_COMMANDS)}')
+        try:
+            result[verb] = float(number)
+        except ValueError:
+            raise ValueError(f'Ожидалось КОМАНДА=ЧИСЛО, получено {value!r}')
+    return result
+
+
+class SMTPSink:
+    '''Локальный SMTP-сервер на asyncio, который принимает и отбрасывает письма. Используется как
+    заглушка почтового сервера для проверки и сравнения скорости режимов отправки. Принимает почту
+    для любых доменов и считает соединения, транзакции и получателей по доменам. max_recipients
+    ограничивает число RCPT TO в одной транзакции, как это делают крупные почтовые сервисы.
+    latency - задержка ответа на команды MAIL, RCPT и DATA в секундах, например {'RCPT': 0.002, 'DATA': 0.01},
+    failure_rates - доля временных отказов (451) на команды MAIL, RCPT и DATA, например {'RCPT': 0.01}.
+    При track_latency сохраняется время каждой транзакции от MAIL FROM до ответа на DATA'''
+
+    def __init__(self, host='127.0.0.1', port=8025, max_recipients=None, latency=None, failure_rates=None,
+                 track_latency=False, seed=None):
+        self.host = host
+        self.port = port
+        self.max_recipients = max_recipients
+        self.latency = {verb.upper().encode(): delay for verb, delay in (latency or {}).items() if delay}
+        self.failure_rates = {verb.upper().encode(): rate for verb, rate in (failure_rates or {}).items() if rate}
+        # Отдельный генератор: при заданном seed отказы повторяются от запуска к запуску
+        self.random = random.Random(seed)
+        self.latencies = [] if track_latency else None
+        self.failures = 0
+        self.messages = 0
+        self.sessions = 0
+        self.connections = 0
+        self.recipients = 0
+        self.domains = Counter()
+        self.started_at = None
+        self.server = None
+        self.loop = None
+        self.thread = None
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        self.connections += 1
+        # Получатели и время начала текущей транзакции
+        rcpt = []
+        transaction_started = None
+
+        async def reply(line):
+            writer.write(line.encode() + b'\r\n')
+            await writer.drain()
+
+        async def delay(verb):
+            '''Выдерживает задержку ответа на команду и решает, отказать ли в ней временной ошибкой'''
+            if verb in self.latency:
+                await asyncio.sleep(self.latency[verb])
+            if verb in self.failure_rates and self.random.random() < self.failure_rates[verb]:
+                self.failures += 1
+                return True
+            return False
+
+        try:
+            await reply('220 smtp-sink ready')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                verb = line[:4].upper()
+                if verb in (b'EHLO', b'HELO'):
+                    await reply('250-smtp-sink\r\n250-PIPELINING\r\n250 AUTH PLAIN LOGIN')
+                elif verb == b'AUTH':
+                    await reply('235 Authentication successful')
+                elif verb == b'RSET':
+                    rcpt = []
+                    await reply('250 OK')
+                elif verb == b'MAIL':
+                    rcpt = []
+                    transaction_started = time.perf_counter()
+                    if await delay(verb):
+                        await reply('451 Temporary failure')
+                    else:
+                        await reply('250 OK')
+                elif verb == b'RCPT':
+                    if self.max_recipients and len(rcpt) >= self.max_recipients:
+                        await reply('452 Too many recipients')
+                    elif await delay(verb):
+                        await reply('451 Temporary failure')
+                    else:
+                        rcpt.append(line.partition(b'@')[2].partition(b'>')[0].lower().decode(errors='replace'))
+                        await reply('250 OK')
+                elif verb == b'DATA':
+                    await reply('354 End data with <CR><LF>.<CR><LF>')
+                    while await reader.readline() not in (b'.\r\n', b''):
+                        pass
+                    if await delay(verb):
+                        rcpt = []
+                        await reply('451 Temporary failure')
+                        continue
+                    self.messages += 1
+                    self.recipients += len(rcpt)
+                    self.domains.update(rcpt)
+                    rcpt = []
+                    await reply('250 Message accepted')
+                    if self.latencies is not None and transaction_started is not None:
+                        self.latencies.append(time.perf_counter() - transaction_started)
+                elif verb == b'QUIT':
+                    await reply('221 Bye')
+                    break
+                else:
+                    await reply('250 OK')
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started_at = time.perf_counter()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def start_in_thread(self):
+        '''Запускает сервер в фоновом потоке и возвращает управление, когда он готов принимать
+        соединения. Порт 0 выбирает свободный порт, фактический доступен в self.port'''
+        ready = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            ready.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name='smtp-sink', daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop = None
+
+    @property
+    def transactions_per_1k(self):
+        '''Число SMTP-транзакций (писем) на 1000 принятых получателей'''
+        return self.messages * 1000 / self.recipients if self.recipients else 0.0
+
+    @property
+    def rate(self):
+        '''Принято писем в секунду с момента запуска'''
+        elapsed = time.perf_counter() - self.started_at if self.started_at else 0
+        return self.messages / elapsed if elapsed else 0.0
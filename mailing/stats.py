@@ -0,0 +1,209 @@
+'''Счётчики главной страницы (MailingStats): всего рассылок, активных рассылок и уникальных получателей
+по владельцу и по всей системе.
+
+Счётчики меняются на разницу при каждом изменении рассылок и получателей (сигналы и явные вызовы там, где
+статус меняется запросом UPDATE), поэтому главная страница читает одну строку. Увеличение - UPDATE с F(),
+в той же транзакции, что и само изменение. Строка, которой ещё нет, пересчитывается целиком при первом
+чтении. Команда rebuild_mailing_stats пересчитывает все строки'''
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from mailing.models import MailingModel, MailingStats, Subscriber
+from mailing.services import LIST_MAILINGS, SCOPE_ALL, get_list_scope
+
+Recipient = MailingModel.subscriber.through
+
+STATS_FIELDS = ('total_mailings', 'active_mailings', 'unique_subscribers')
+
+
+def count_owner_stats(owner_id):
+    '''Счётчики владельца owner_id (None - по всей системе) по данным рассылок'''
+    if owner_id is None:
+        mailings = MailingModel.objects.all()
+        unique_subscribers = Subscriber.objects.count()
+    else:
+        mailings = MailingModel.objects.filter(owner_id=owner_id)
+        unique_subscribers = Recipient.objects.filter(mailingmodel__owner_id=owner_id).aggregate(
+            value=Count('subscriber_id', distinct=True)
+        )['value']
+    counts = mailings.aggregate(
+        total_mailings=Count('pk'), active_mailings=Count('pk', filter=Q(status=MailingModel.STARTED))
+    )
+    return {**counts, 'unique_subscribers': unique_subscribers}
+
+
+def rebuild_owner_stats(owner_id):
+    '''Пересчитывает строку владельца owner_id целиком и возвращает её'''
+    values = count_owner_stats(owner_id)
+    try:
+        with transaction.atomic():
+            stats, _ = MailingStats.objects.update_or_create(owner_id=owner_id, defaults=values)
+    except IntegrityError:
+        # Строку одновременно создал другой процесс: пересчитанные значения записываются в неё
+        MailingStats.objects.filter(owner_id=owner_id).update(**values)
+        stats = MailingStats.objects.get(owner_id=owner_id)
+    return stats
+
+
+def get_owner_stats(owner_id):
+    '''Строка счётчиков владельца owner_id (None - по всей системе). Если её нет, она пересчитывается'''
+    stats = MailingStats.objects.filter(owner_id=owner_id).first()
+    return stats if stats is not None else rebuild_owner_stats(owner_id)
+
+
+def get_home_stats(user):
+    '''Счётчики главной страницы пользователя: у владельца - по его рассылкам, у пользователя с правом
+    просмотра всех рассылок - по всей системе, у остальных - None'''
+    scope = get_list_scope(user, LIST_MAILINGS)
+    if scope is None:
+        return None
+    return get_owner_stats(None if scope == SCOPE_ALL else scope)
+
+
+def add_stats(owner_id, **deltas):
+    '''Меняет счётчики строки владельца owner_id (None - по всей системе) на deltas. Строки, которой
+    ещё нет, изменение не касается: она будет пересчитана целиком при первом чтении'''
+    deltas = {field: value for field, value in deltas.items() if value}
+    if deltas:
+        MailingStats.objects.filter(owner_id=owner_id).update(
+            **{field: F(field) + value for field, value in deltas.items()}
+        )
+
+
+def add_mailing_stats(owner_id, total=0, active=0):
+    '''Изменение числа рассылок и активных рассылок владельца и всей системы'''
+    if owner_id is not None:
+        add_stats(owner_id, total_mailings=total, active_mailings=active)
+    add_stats(None, total_mailings=total, active_mailings=active)
+
+
+def count_new_subscribers(owner_id, mailing_pks, subscriber_pks):
+    '''Сколько получателей из subscriber_pks нет в рассылках владельца, кроме рассылок mailing_pks'''
+    subscriber_pks = set(subscriber_pks)
+    if owner_id is None or not subscriber_pks:
+        return 0
+    elsewhere = Recipient.objects.filter(
+        subscriber_id__in=subscriber_pks, mailingmodel__owner_id=owner_id
+    ).exclude(mailingmodel_id__in=mailing_pks).values_list('subscriber_id', flat=True).distinct()
+    return len(subscriber_pks - set(elsewhere))
+
+
+def is_active(status):
+    return int(status == MailingModel.STARTED)
+
+
+def update_status_stats(changes):
+    '''Статусы рассылок изменены запросом UPDATE без сигналов. changes - тройки
+    (ID владельца, прежний статус, новый статус)'''
+    by_owner = {}
+    for owner_id, old_status, new_status in changes:
+        delta = is_active(new_status) - is_active(old_status)
+        if delta:
+            by_owner[owner_id] = by_owner.get(owner_id, 0) + delta
+    for owner_id, delta in by_owner.items():
+        add_mailing_stats(owner_id, active=delta)
+
+
+def remember_mailing_state(sender, instance, **kwargs):
+    '''pre_save рассылки: запоминает прежние владельца и статус, чтобы post_save учёл их изменение'''
+    instance._stats_previous = None
+    if instance.pk is not None:
+        instance._stats_previous = MailingModel.objects.filter(pk=instance.pk).values_list(
+            'owner_id', 'status'
+        ).first()
+
+
+def mailing_saved(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_stats_previous', None)
+    if created or previous is None:
+        add_mailing_stats(instance.owner_id, total=1, active=is_active(instance.status))
+        return
+    old_owner_id, old_status = previous
+    if old_owner_id != instance.owner_id:
+        # Рассылка передана другому владельцу: строки обоих владельцев пересчитываются целиком
+        for owner_id in (old_owner_id, instance.owner_id):
+            if owner_id is not None:
+                rebuild_owner_stats(owner_id)
+        add_stats(None, active_mailings=is_active(instance.status) - is_active(old_status))
+        return
+    add_mailing_stats(instance.owner_id, active=is_active(instance.status) - is_active(old_status))
+
+
+def mailing_deleting(sender, instance, **kwargs):
+    '''pre_delete рассылки: пока связи с получателями ещё есть, вычитает получателей, которых нет
+    в других рассылках владельца'''
+    subscriber_pks = Recipient.objects.filter(mailingmodel_id=instance.pk).values_list('subscriber_id', flat=True)
+    removed = count_new_subscribers(instance.owner_id, [instance.pk], subscriber_pks)
+    if instance.owner_id is not None:
+        add_stats(instance.owner_id, unique_subscribers=-removed)
+    add_mailing_stats(instance.owner_id, total=-1, active=-is_active(instance.status))
+
+
+def subscriber_saved(sender, instance, created, **kwargs):
+    if created:
+        add_stats(None, unique_subscribers=1)
+
+
+def subscriber_deleting(sender, instance, **kwargs):
+    '''pre_delete получателя: вычитает его у каждого владельца, в рассылках которого он есть'''
+    owner_ids = Recipient.objects.filter(subscriber_id=instance.pk).exclude(
+        mailingmodel__owner_id=None
+    ).values_list('mailingmodel__owner_id', flat=True).distinct()
+    for owner_id in owner_ids:
+        add_stats(owner_id, unique_subscribers=-1)
+    add_stats(None, unique_subscribers=-1)
+
+
+def recipients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    '''m2m_changed получателей рассылки: добавленные получатели, которых не было в других рассылках
+    владельца, увеличивают счётчик уникальных получателей, удалённые - уменьшают'''
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if action == 'pre_clear':
+        if reverse:
+            pk_set = set(Recipient.objects.filter(subscriber_id=instance.pk).values_list('mailingmodel_id', flat=True))
+        else:
+            pk_set = set(Recipient.objects.filter(mailingmodel_id=instance.pk).values_list('subscriber_id', flat=True))
+    # Тройки (владелец, его рассылки, получатели): со стороны получателя рассылки группируются по владельцу
+    if reverse:
+        by_owner = {}
+        for mailing_pk, owner_id in MailingModel.objects.filter(pk__in=pk_set).values_list('pk', 'owner_id'):
+            by_owner.setdefault(owner_id, []).append(mailing_pk)
+        changes = [(owner_id, mailing_pks, {instance.pk}) for owner_id, mailing_pks in by_owner.items()]
+    else:
+        changes = [(instance.owner_id, [instance.pk], pk_set)]
+    sign = 1 if action == 'post_add' else -1
+    for owner_id, mailing_pks, subscriber_pks in changes:
+        if owner_id is not None:
+            add_stats(owner_id, unique_subscribers=sign * count_new_subscribers(owner_id, mailing_pks, subscriber_pks))
+
+
+def rebuild_all_stats():
+    '''Пересчитывает все строки счётчиков тремя агрегирующими запросами и записывает их одним bulk_create.
+    Возвращает число строк'''
+    rows = {}
+    for row in MailingModel.objects.values('owner_id').annotate(
+        total_mailings=Count('pk'), active_mailings=Count('pk', filter=Q(status=MailingModel.STARTED))
+    ).order_by():
+        rows.setdefault(row['owner_id'], dict.fromkeys(STATS_FIELDS, 0)).update(
+            total_mailings=row['total_mailings'], active_mailings=row['active_mailings']
+        )
+    for owner_id, unique_subscribers in Recipient.objects.values_list('mailingmodel__owner_id').annotate(
+        unique_subscribers=Count('subscriber_id', distinct=True)
+    ).order_by():
+        rows.setdefault(owner_id, dict.fromkeys(STATS_FIELDS, 0))['unique_subscribers'] = unique_subscribers
+
+    # Строка по всей системе: рассылки всех владельцев, в том числе без владельца, и все получатели
+    system = dict.fromkeys(STATS_FIELDS, 0)
+    for owner_id, values in rows.items():
+        system['total_mailings'] += values['total_mailings']
+        system['active_mailings'] += values['active_mailings']
+    system['unique_subscribers'] = Subscriber.objects.count()
+    rows.pop(None, None)
+
+    with transaction.atomic():
+        MailingStats.objects.all().delete()
+        MailingStats.objects.bulk_create(
+            [MailingStats(owner_id=None, **system)]
+            + [MailingStats(owner_id=owner_id, **values) for owner_id, values in rows.items()]
+        )
+    return len(rows) + 1
@@ -0,0 +1,15 @@
+from django.db.models import Q
+from mailing.models import SuppressedAddress
+
+
+def get_suppressed_emails(owner_id=None):
+    '''Загружает одним запросом адреса из списка подавления, действующие для рассылок владельца
+    owner_id (глобальные и его собственные), во множество для проверки получателя за O(1)'''
+    condition = Q(owner__isnull=True)
+    if owner_id is not None:
+        condition |= Q(owner_id=owner_id)
+    return set(SuppressedAddress.objects.filter(condition).values_list('email', flat=True).iterator())
+
+
+def is_suppressed(email, suppressed):
+    return email.lower() in suppressed
@@ -1,10 +1,11 @@
 from django import template
-# from django.contrib.auth.models import Group
+from users.access import user_in_group
 
 register = template.Library()
 
 
 @register.filter(name='in_group')
 def in_group(user, group_name):
-    """Возвращает True, если пользователь входит в указанную группу."""
-    return user.groups.filter(name=group_name).exists()
+    """Возвращает True, если пользователь входит в указанную группу. Группы пользователя загружаются
+    один раз за запрос (users.access)."""
+    return user_in_group(user, group_name)
@@ -1,3 +1,166 @@
-# from django.test import TestCase
+import threading
+import time
+from django.test import TestCase, override_settings
+from mailing.benchmark import create_benchmark_mailing
+from mailing.cancellation import request_cancel
+from mailing.models import MailingAttempt, MailingJob, Message, Subscriber
+from mailing.scheduler import get_due_mailings
+from mailing.sending import send_mailing
+from mailing.services import LIST_MAILINGS, get_list_version
+from mailing.smtp_sink import SMTPSink
+from users.models import CustomUser
 
-# Create your tests here.
+
+class RecipientLimitTests(TestCase):
+    '''Отправка одной транзакцией многим получателям на сервер, который ограничивает число RCPT TO (452)
+    и временно отказывает в MAIL FROM (451). Получатели, которым письмо доставлено первыми транзакциями,
+    не должны записываться неудачными, если не удалась следующая транзакция'''
+    recipients = 300
+
+    def setUp(self):
+        self.sink = SMTPSink(port=0, max_recipients=7, failure_rates={'MAIL': 0.2}, seed=1).start_in_thread()
+        self.addCleanup(self.sink.stop)
+
+    def send(self, mode):
+        with override_settings(
+            EMAIL_BACKEND='mailing.smtp_backend.EmailBackend',
+            EMAIL_HOST=self.sink.host,
+            EMAIL_PORT=self.sink.port,
+            EMAIL_HOST_USER='tests@example.com',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            MAILING_RELAYS=[],
+            MAILING_RELAY_RATE_LIMIT=0,
+            MAILING_DOMAIN_RATE_LIMITS={},
+            MAILING_MULTI_RCPT_DOMAINS=['*'],
+            MAILING_MAX_RCPT_PER_TRANSACTION=50,
+        ):
+            mailing = create_benchmark_mailing(self.recipients)
+            sent, failed, _ = send_mailing(mailing, mode=mode)
+        return mailing, sent, failed
+
+    def assert_results_match_sink(self, mode):
+        mailing, sent, failed = self.send(mode)
+        self.assertGreater(failed, 0)
+        self.assertEqual(sent + failed, self.recipients)
+        self.assertEqual(sent, self.sink.recipients)
+        attempts = MailingAttempt.objects.filter(mailing=mailing)
+        self.assertEqual(attempts.filter(status=MailingAttempt.SUCCESSFULLY).count(), self.sink.recipients)
+        self.assertEqual(attempts.filter(status=MailingAttempt.NOT_SUCCESSFULL).count(), failed)
+
+    def test_sequential(self):
+        self.assert_results_match_sink('sequential')
+
+    def test_threads(self):
+        self.assert_results_match_sink('threads')
+
+    def test_async(self):
+        self.assert_results_match_sink('async')
+
+
+class CancelMidSendTests(TestCase):
+    '''Отмена во время отправки с размером пачки и числом потоков и соединений по умолчанию: потоки
+    и сессии останавливаются после начатой транзакции, а не после всех выданных им пачек и транзакций'''
+    recipients = 1000
+    cancel_after = 20
+
+    def setUp(self):
+        self.sink = SMTPSink(port=0, latency={'DATA': 0.005}).start_in_thread()
+        self.addCleanup(self.sink.stop)
+
+    def cancel_when_received(self, mailing, stop):
+        '''Отменяет отправку из другого потока, как модератор, когда сервер принял cancel_after писем'''
+        while not stop.is_set():
+            if self.sink.messages >= self.cancel_after:
+                request_cancel(mailing.pk)
+                return
+            time.sleep(0.001)
+
+    def assert_cancelled_mid_send(self, mode):
+        with override_settings(
+            EMAIL_BACKEND='mailing.smtp_backend.EmailBackend',
+            EMAIL_HOST=self.sink.host,
+            EMAIL_PORT=self.sink.port,
+            EMAIL_HOST_USER='tests@example.com',
+            EMAIL_HOST_PASSWORD='',
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            MAILING_RELAYS=[],
+            MAILING_RELAY_RATE_LIMIT=0,
+            MAILING_DOMAIN_RATE_LIMITS={},
+            MAILING_MULTI_RCPT_DOMAINS=[],
+            MAILING_CANCEL_CHECK_INTERVAL=0,
+        ):
+            mailing = create_benchmark_mailing(self.recipients)
+            stop = threading.Event()
+            watcher = threading.Thread(target=self.cancel_when_received, args=(mailing, stop))
+            watcher.start()
+            try:
+                sent, failed, _ = send_mailing(mailing, mode=mode)
+            finally:
+                stop.set()
+                watcher.join()
+        # Без проверки в потоках и сессиях отправлялись все выданные до отмены пачки (по две на поток)
+        # и транзакции (по две на соединение в очереди)
+        self.assertLess(sent + failed, self.recipients * 3 // 10)
+        self.assertEqual(self.sink.recipients, sent)
+        attempts = MailingAttempt.objects.filter(mailing=mailing, status=MailingAttempt.CANCELLED)
+        self.assertEqual(attempts.count(), self.recipients - sent - failed)
+
+    def test_threads(self):
+        self.assert_cancelled_mid_send('threads')
+
+    def test_async(self):
+        self.assert_cancelled_mid_send('async')
+
+
+class ListCacheVersionTests(TestCase):
+    '''Получатели и письма других владельцев, показанные в строках списка рассылок: их изменение
+    меняет версию списка рассылок владельца рассылки'''
+
+    def setUp(self):
+        self.mailing = create_benchmark_mailing(1)
+        self.other = CustomUser.objects.create(username='other', email='other@example.com')
+        self.subscriber = Subscriber.objects.create(email='other-subscriber@example.com', owner=self.other)
+        self.mailing.subscriber.add(self.subscriber)
+
+    def assert_bumps_mailing_list(self, change):
+        owner_id = self.mailing.owner_id
+        version = get_list_version(LIST_MAILINGS, owner_id)
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+        self.assertNotEqual(get_list_version(LIST_MAILINGS, owner_id), version)
+
+    def test_subscriber_saved(self):
+        self.subscriber.full_name = 'Новое имя'
+        self.assert_bumps_mailing_list(self.subscriber.save)
+
+    def test_subscriber_deleted(self):
+        self.assert_bumps_mailing_list(self.subscriber.delete)
+
+    def test_message_saved(self):
+        message = Message.objects.get(pk=self.mailing.message_id)
+        message.owner = self.other
+        message.save()
+        message.subject = 'Новая тема'
+        self.assert_bumps_mailing_list(message.save)
+
+
+class DueMailingsTests(TestCase):
+    '''Рассылки с невыполненным заданием отправляет обработчик очереди, send_mailing --all-due их пропускает'''
+
+    def setUp(self):
+        self.mailing = create_benchmark_mailing(1)
+
+    def test_without_job(self):
+        self.assertIn(self.mailing, get_due_mailings())
+
+    def test_unfinished_job(self):
+        for status in (MailingJob.QUEUED, MailingJob.RUNNING):
+            MailingJob.objects.update_or_create(mailing=self.mailing, defaults={'status': status})
+            self.assertNotIn(self.mailing, get_due_mailings())
+
+    def test_finished_job(self):
+        MailingJob.objects.create(mailing=self.mailing, status=MailingJob.DONE)
+        self.assertIn(self.mailing, get_due_mailings())
@@ -5,7 +5,8 @@ from mailing.views import (HomeView, SubscriberListView, SubscriberDetailView, S
                            MessageCreateView, MessageUpdateView, MessageDeleteView, MailingModelListView,
                            MailingModelCreateView, MailingModelDetailView, MailingModelUpdateView,
                            MailingModelDeleteView, SendingMailingView, MailingAttemptListView,
-                           DisableMailingView, MailingAttemptAllListView)
+                           DisableMailingView, MailingAttemptAllListView, MailingProgressView,
+                           MailingProgressDataView)
 
 app_name = MailingConfig.name
 
@@ -29,6 +30,8 @@ urlpatterns = [
     path("mailing/<int:pk>/sending-mailing/", SendingMailingView.as_view(), name="sending_mailing"),
     path('mailing/<int:pk>/attempts/', MailingAttemptListView.as_view(), name='mailing_attempts'),
     path('mailing/<int:pk>/disable-mailing/', DisableMailingView.as_view(), name='disable_mailing'),
+    path('mailing/<int:pk>/progress/', MailingProgressView.as_view(), name='mailing_progress'),
+    path('mailing/<int:pk>/progress/data/', MailingProgressDataView.as_view(), name='mailing_progress_data'),
     path('mailing/attempt-list/', MailingAttemptAllListView.as_view(), name='attempt_list'),
 
 ]
@@ -1,17 +1,25 @@
+import ipaddress
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.core.mail import send_mail
 from django.shortcuts import render, get_object_or_404, redirect
 from django.urls import reverse_lazy
-from django.utils.decorators import method_decorator
 from django.views import View
 from django.contrib import messages
-from django.views.decorators.cache import cache_page
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.utils.crypto import constant_time_compare
 from django.views.generic import TemplateView, ListView, DetailView, CreateView, UpdateView, DeleteView
+from mailing.cancellation import request_cancel
+from mailing.detail_cache import CachedDetailMixin
 from mailing.forms import SubscriberForm, MessageForm, MailingModelForm
 from mailing.models import Subscriber, Message, MailingModel, MailingAttempt
-from django.conf import settings
 from django.utils import timezone
+from mailing.jobs import enqueue_mailing
+from mailing.metrics import registry
+from mailing.progress import get_progress, mark_queued
+from mailing.scheduler import finish_mailings
+from mailing.sending import get_pending_recipients
+from mailing.stats import get_home_stats
 from mailing.services import get_subscriber_list_from_cache, get_message_list_from_cache, get_mailing_list_from_cache
 # from django.contrib.auth.models import Group
 
@@ -20,32 +28,15 @@ class HomeView(LoginRequiredMixin, TemplateView):
     template_name = 'mailing/home.html'
 
     # На главной странице отображаем количество рассылок, активных и уникальных получателей
-    # по вошедшему пользователю
+    # по вошедшему пользователю (менеджеру - всего в системе). Счётчики читаются одной строкой MailingStats
     def get_context_data(self, **kwargs):
-        user = self.request.user  # Получаем текущего пользователя
         context = super().get_context_data(**kwargs)
-        # Фильтруем объекты MailingModel по владельцу (текущему пользователю)
-        mailings = MailingModel.objects.filter(owner=user)
-        # Всего рассылок
-        context['total_mailings'] = mailings.count()
-        # Активных рассылок
-        context['active_mailings'] = mailings.filter(status=MailingModel.STARTED).count()
-        # Уникальных получателей
-        # Подписчиков, связанных с любыми рассылками пользователя
-        unique_subscribers = Subscriber.objects.filter(
-            subscribers__in=mailings
-        ).distinct().count()
-        context['unique_subscribers'] = unique_subscribers
+        stats = get_home_stats(self.request.user)
+        context['total_mailings'] = stats.total_mailings if stats else 0
+        context['active_mailings'] = stats.active_mailings if stats else 0
+        context['unique_subscribers'] = stats.unique_subscribers if stats else 0
         return context
 
-    # # если нужно всего в системе
-    # def get_context_data(self, **kwargs):
-    #     context = super().get_context_data(**kwargs)
-    #     context['total_mailings'] = MailingModel.objects.count()
-    #     context['active_mailings'] = MailingModel.objects.filter(status=MailingModel.STARTED).count()
-    #     context['unique_subscribers'] = Subscriber.objects.count()
-    #     return context
-
 
 class SubscriberListView(LoginRequiredMixin, ListView):
     '''Список получателей рассылки (подписчиков)'''
@@ -81,12 +72,16 @@ class SubscriberListView(LoginRequiredMixin, ListView):
     #     return Subscriber.objects.none()
 
 
-@method_decorator(cache_page(20), name='dispatch')
-class SubscriberDetailView(LoginRequiredMixin, DetailView):
+class SubscriberDetailView(LoginRequiredMixin, CachedDetailMixin, DetailView):
     '''Детальная информация по получателю рассылки (подписчику)'''
     model = Subscriber
     template_name = 'mailing/subscriber_detail.html'  # можно не указывать, это стандартный путь
     context_object_name = 'subscriber'  # можно не указывать, стандартное название в шаблоне 'subscriber'
+    # Карточка получателя кешируется, повторный просмотр без изменений получает ответ 304
+    detail_cache_name = 'subscriber'
+    card_template_name = 'mailing/includes/subscriber_card.html'
+    view_permission = 'mailing.view_subscriber'
+    card_permissions = ('mailing.change_subscriber', 'mailing.delete_subscriber')
 
     def get_object(self, queryset=None):
         obj = super().get_object(queryset)
@@ -198,12 +193,15 @@ class MessageListView(LoginRequiredMixin, ListView):
     #     return Message.objects.none()
 
 
-@method_decorator(cache_page(20), name='dispatch')
-class MessageDetailView(LoginRequiredMixin, DetailView):
+class MessageDetailView(LoginRequiredMixin, CachedDetailMixin, DetailView):
     '''Детальная информация о сообщении'''
     model = Message
     template_name = 'mailing/message_detail.html'
     context_object_name = 'message'
+    detail_cache_name = 'message'
+    card_template_name = 'mailing/includes/message_card.html'
+    view_permission = 'mailing.view_message'
+    card_permissions = ('mailing.change_message', 'mailing.delete_message')
 
     def get_object(self, queryset=None):
         obj = super().get_object(queryset)
@@ -315,12 +313,15 @@ class MailingModelListView(LoginRequiredMixin, ListView):
     #     return MailingModel.objects.none()
 
 
-@method_decorator(cache_page(20), name='dispatch')
-class MailingModelDetailView(LoginRequiredMixin, DetailView):
+class MailingModelDetailView(LoginRequiredMixin, CachedDetailMixin, DetailView):
     '''Детальная информация о рассылке'''
     model = MailingModel
     template_name = 'mailing/mailingmodel_detail.html'
     context_object_name = 'mailingmodel'
+    detail_cache_name = 'mailing'
+    card_template_name = 'mailing/includes/mailingmodel_card.html'
+    view_permission = 'mailing.view_mailingmodel'
+    card_permissions = ('mailing.change_mailingmodel', 'mailing.delete_mailingmodel')
 
     def get_object(self, queryset=None):
         obj = super().get_object(queryset)
@@ -428,6 +429,8 @@ class DisableMailingView(LoginRequiredMixin, View):
             # Если пользователь обладает правом отключения рассылки, деактивируем рассылку
             mailing.is_active = False
             mailing.save()
+            # Идущая отправка рассылки останавливается после текущих пачек получателей
+            request_cancel(mailing.pk)
             # Подтверждение успешной операции
             messages.success(request, "Рассылка успешно отключена!")
         else:
@@ -437,8 +440,8 @@ class DisableMailingView(LoginRequiredMixin, View):
 
 
 class SendingMailingView(LoginRequiredMixin, View):
-    '''Класс осуществляющий отправку рассылки и формирующий попытку рассылки (запись в БД о каждой
-    попытке отправки сообщения по рассылке по каждому подписчику)'''
+    '''Класс, ставящий рассылку в очередь на отправку. Отправку и запись попыток рассылки по каждому
+    подписчику выполняет обработчик очереди (команда run_mail_workers)'''
 
     def get(self, request, pk):
         mailing = get_object_or_404(MailingModel, pk=pk)
@@ -448,16 +451,17 @@ class SendingMailingView(LoginRequiredMixin, View):
             messages.warning(request, 'У вас нет прав на управление этой рассылкой.')
             return redirect('mailing:mailingmodel_list')
         date_and_time_now = timezone.now()
-        if date_and_time_now > mailing.end_sending:
+        if mailing.status != MailingModel.FINISHED and date_and_time_now > mailing.end_sending:
             messages.warning(request, 'Время отправки рассылки закончилось! '
                                       'Статус рассылки будет изменен!')
-            mailing.status = MailingModel.FINISHED
-            mailing.save()
-        if not mailing.is_active:
+        if mailing.status != MailingModel.FINISHED and not mailing.is_active:
             messages.warning(request, 'Данная рассылка деактивирована модератором! '
                                       'Статус рассылки будет изменен!')
+        if date_and_time_now > mailing.end_sending or not mailing.is_active:
+            # Статус меняется так же, как в планировщике: идущая отправка останавливается, а счётчики
+            # и кеш рассылки обновляются один раз, даже если планировщик завершает её одновременно
+            finish_mailings(date_and_time_now, mailing_pks=[mailing.pk])
             mailing.status = MailingModel.FINISHED
-            mailing.save()
         if mailing.status == MailingModel.FINISHED:
             messages.warning(request, 'Нельзя отправить завершённую рассылку!')
             return redirect('mailing:mailingmodel_list')
@@ -465,45 +469,46 @@ class SendingMailingView(LoginRequiredMixin, View):
 
     def post(self, request, pk):
         mailing = get_object_or_404(MailingModel, pk=pk)
-        subject = mailing.message.subject
-        body = mailing.message.body
-        subscriber = mailing.subscriber.all()
-
-        emails = [p.email for p in subscriber]
-
-        if emails:
-            for email in emails:
-                try:
-                    send_mail(
-                        subject=subject,
-                        message=body,
-                        from_email=settings.EMAIL_HOST_USER,
-                        recipient_list=[email],
-                        fail_silently=False,
-                    )
-                    messages.success(request, f'Рассылка отправлена получателю {email}.')
-                    mailing.status = MailingModel.STARTED
-                    mailing.save()
-
-                    status_mailing_attempt = MailingAttempt.SUCCESSFULLY
-                    server_mail_response = 'Письмо отправлено'
-
-                except Exception as e:
-                    status_mailing_attempt = MailingAttempt.NOT_SUCCESSFULL
-                    server_mail_response = str(e)
-
-                MailingAttempt.objects.create(
-                    date_and_time=timezone.now(),
-                    status=status_mailing_attempt,
-                    server_mail_response=server_mail_response,
-                    mailing=mailing
-                )
+        if not get_pending_recipients(mailing).exists():
+            messages.warning(request, 'У рассылки нет получателей, которым она ещё не доставлена.')
         else:
-            messages.warning(request, 'У рассылки нет получателей.')
-
+            # Письма отправляет обработчик очереди (run_mail_workers), запрос не ждёт окончания отправки
+            _, created = enqueue_mailing(mailing)
+            # Повторное нажатие во время отправки не сбрасывает счётчики идущего задания
+            if created:
+                mark_queued(mailing.pk)
+            messages.success(request, 'Рассылка поставлена в очередь на отправку.')
+            return redirect('mailing:mailing_progress', pk=mailing.pk)
         return redirect('mailing:mailingmodel_list')
 
 
+class MailingProgressView(LoginRequiredMixin, DetailView):
+    '''Страница хода отправки рассылки. Страница опрашивает счётчики прогресса через MailingProgressDataView'''
+    model = MailingModel
+    template_name = 'mailing/mailing_progress.html'
+    context_object_name = 'mailing'
+
+    def get_object(self, queryset=None):
+        obj = super().get_object(queryset)
+        user = self.request.user
+        # Ход отправки видят владелец рассылки и пользователи с правом просмотра всех рассылок
+        if user == obj.owner or user.has_perm('mailing.view_mailingmodel'):
+            return obj
+        raise PermissionDenied("У Вас недостаточно прав для просмотра.")
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['progress'] = get_progress(self.object.pk)
+        return context
+
+
+class MailingProgressDataView(MailingProgressView):
+    '''Счётчики прогресса отправки рассылки в JSON: читаются из Redis, без запросов к таблице попыток'''
+
+    def render_to_response(self, context, **response_kwargs):
+        return JsonResponse(context['progress'])
+
+
 class MailingAttemptAllListView(LoginRequiredMixin, ListView):
     model = MailingAttempt
     template_name = 'mailing/mailing_attempt_all_list.html'
@@ -522,3 +527,23 @@ class MailingAttemptListView(LoginRequiredMixin, ListView):
         context = super().get_context_data(**kwargs)
         context['mailing'] = MailingModel.objects.get(pk=self.kwargs['pk'])
         return context
+
+
+class MetricsView(View):
+    '''Метрики в формате Prometheus, суммарные по всем процессам приложения. Доступны с заголовком
+    Authorization: Bearer <токен> из METRICS_TOKEN или без токена с адресов из METRICS_ALLOWED_IPS
+    (по умолчанию таких нет: за обратным прокси адрес клиента - адрес прокси)'''
+
+    def is_allowed_address(self, request):
+        try:
+            address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+        except ValueError:
+            return False
+        return any(address in ipaddress.ip_network(network, strict=False) for network in settings.METRICS_ALLOWED_IPS)
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        authorized = bool(token) and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+        if not authorized and not self.is_allowed_address(request):
+            return HttpResponse('Unauthorized', status=401, content_type='text/plain')
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
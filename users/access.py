@@ -0,0 +1,120 @@
+'''Группы и права пользователя, загруженные одним запросом к БД.
+
+Набор хранится на объекте пользователя (request.user живёт один запрос) и в памяти процесса. Запись
+процесса действительна, пока не изменились номера версий в общем кеше: общий номер меняется при изменении
+групп и их прав, номер пользователя - при изменении его групп, прав или самого пользователя'''
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Value
+
+UserAccess = namedtuple('UserAccess', ['groups', 'user_permissions', 'group_permissions'])
+
+NO_ACCESS = UserAccess(frozenset(), frozenset(), frozenset())
+
+ACCESS_VERSION_KEY = 'access_version'
+
+# Наборы прав, загруженные процессом: ID пользователя -> (номера версий, набор). Старые записи вытесняются
+process_access = OrderedDict()
+process_access_lock = threading.Lock()
+
+
+def get_user_access_version_key(user_pk):
+    return f'{ACCESS_VERSION_KEY}:{user_pk}'
+
+
+def get_initial_version():
+    # Начальный номер - время в микросекундах: если номер вытеснен из кеша, номера не повторяются
+    return time.time_ns() // 1000
+
+
+def get_access_versions(user_pk):
+    '''Общий номер версии и номер версии пользователя или None, если кеш недоступен'''
+    keys = (ACCESS_VERSION_KEY, get_user_access_version_key(user_pk))
+    try:
+        versions = cache.get_many(keys)
+        if len(versions) < len(keys):
+            for key in keys:
+                if key not in versions:
+                    cache.add(key, get_initial_version(), None)
+            versions = cache.get_many(keys)
+    except Exception:
+        return None
+    if len(versions) < len(keys):
+        return None
+    return tuple(versions[key] for key in keys)
+
+
+def bump_access_version(user_pk=None):
+    '''Меняет номер версии пользователя user_pk или, если он не указан, общий номер версии'''
+    key = ACCESS_VERSION_KEY if user_pk is None else get_user_access_version_key(user_pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, get_initial_version(), None)
+
+
+def invalidate_user_access(sender, instance, action=None, **kwargs):
+    '''Сигналы изменения пользователей, групп и прав: меняет номер версии пользователя, а при изменении
+    группы или права - общий номер версии. Номер меняется после фиксации транзакции, чтобы другой процесс
+    не загрузил под новым номером ещё не зафиксированные данные'''
+    if action is not None and action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    user_pk = instance.pk if isinstance(instance, get_user_model()) else None
+    transaction.on_commit(lambda: bump_access_version(user_pk))
+
+
+def load_user_access(user):
+    '''Группы пользователя и его права (свои и через группы) одним запросом UNION ALL'''
+    groups = Group.objects.filter(user=user).annotate(
+        kind=Value('group'), app_label=Value(''), codename=F('name')
+    ).order_by().values_list('kind', 'app_label', 'codename')
+    user_permissions = Permission.objects.filter(user=user).annotate(
+        kind=Value('user'), app_label=F('content_type__app_label')
+    ).order_by().values_list('kind', 'app_label', 'codename')
+    group_permissions = Permission.objects.filter(group__user=user).annotate(
+        kind=Value('group_permission'), app_label=F('content_type__app_label')
+    ).order_by().values_list('kind', 'app_label', 'codename')
+
+    values = {'group': set(), 'user': set(), 'group_permission': set()}
+    for kind, app_label, codename in groups.union(user_permissions, group_permissions, all=True):
+        values[kind].add(codename if kind == 'group' else f'{app_label}.{codename}')
+    return UserAccess(
+        frozenset(values['group']), frozenset(values['user']), frozenset(values['group_permission'])
+    )
+
+
+def get_user_access(user):
+    '''Группы и права пользователя. Загружаются из БД не больше одного раза за запрос и не загружаются
+    вовсе, если набор пользователя уже есть в памяти процесса и его версии не изменились'''
+    if not user.is_authenticated:
+        return NO_ACCESS
+    access = getattr(user, '_access_cache', None)
+    if access is not None:
+        return access
+
+    versions = get_access_versions(user.pk)
+    with process_access_lock:
+        cached = process_access.get(user.pk)
+        if cached is not None and versions is not None and cached[0] == versions:
+            process_access.move_to_end(user.pk)
+            access = cached[1]
+    if access is None:
+        access = load_user_access(user)
+        # Без общего кеша изменения прав не были бы видны другим процессам: набор хранится только в запросе
+        if versions is not None:
+            with process_access_lock:
+                process_access[user.pk] = (versions, access)
+                while len(process_access) > settings.USER_ACCESS_CACHE_SIZE:
+                    process_access.popitem(last=False)
+    user._access_cache = access
+    return access
+
+
+def user_in_group(user, group_name):
+    return group_name in get_user_access(user).groups
@@ -4,3 +4,19 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "users"
+
+    def ready(self):
+        from django.contrib.auth.models import Group, Permission
+        from django.db.models.signals import m2m_changed, post_delete, post_save
+        from users.access import invalidate_user_access
+        from users.models import CustomUser
+
+        # Изменение пользователя, его групп и прав или прав групп сбрасывает загруженные наборы прав
+        post_save.connect(invalidate_user_access, sender=CustomUser, dispatch_uid='user_access_user_save')
+        # Переименование группы или права тоже меняет наборы: проверки идут по именам групп и кодам прав
+        for model in (Group, Permission):
+            uid = f'user_access_{model.__name__}'
+            post_save.connect(invalidate_user_access, sender=model, dispatch_uid=f'{uid}_save')
+            post_delete.connect(invalidate_user_access, sender=model, dispatch_uid=f'{uid}_delete')
+        for through in (CustomUser.groups.through, CustomUser.user_permissions.through, Group.permissions.through):
+            m2m_changed.connect(invalidate_user_access, sender=through, dispatch_uid=f'user_access_{through.__name__}')
@@ -0,0 +1,27 @@
+from django.contrib.auth.backends import ModelBackend
+from users.access import get_user_access
+
+
+class CachedModelBackend(ModelBackend):
+    '''ModelBackend, который берёт права пользователя из users.access: права всех проверок запроса
+    (user.has_perm в представлениях, perms в шаблонах) загружаются одним запросом к БД или из памяти
+    процесса. Права суперпользователя и права на отдельные объекты проверяются как в ModelBackend'''
+
+    def uses_access_cache(self, user_obj, obj):
+        return user_obj.is_active and not user_obj.is_anonymous and not user_obj.is_superuser and obj is None
+
+    def get_user_permissions(self, user_obj, obj=None):
+        if not self.uses_access_cache(user_obj, obj):
+            return super().get_user_permissions(user_obj, obj)
+        return set(get_user_access(user_obj).user_permissions)
+
+    def get_group_permissions(self, user_obj, obj=None):
+        if not self.uses_access_cache(user_obj, obj):
+            return super().get_group_permissions(user_obj, obj)
+        return set(get_user_access(user_obj).group_permissions)
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if not self.uses_access_cache(user_obj, obj):
+            return super().get_all_permissions(user_obj, obj)
+        access = get_user_access(user_obj)
+        return access.user_permissions | access.group_permissions